@@ -0,0 +1,168 @@
+"""Пакетный экспорт проектов .pep в JPG без окна редактора.
+
+Пример:
+    python batch_export.py проекты/ открытка.pep -o jpg/ -s 50% -q 90 -j 8
+
+Файлы распределяются между процессами; для каждого выводится время
+экспорта. Размеры задаются теми же вариантами, что и в диалоге экспорта.
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import multiprocessing.util
+
+# Отрисовка без экрана: задается до создания QApplication в процессах
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtWidgets import QApplication
+from postcard_editor import (EXPORT_SIZE_PRESETS, JPEG_SUBSAMPLING_NAMES, asset_store, export_target_size, fit_jpeg,
+                             load_custom_fonts, load_project, render_export, save_jpeg)
+
+_app = None  # QApplication процесса-исполнителя
+_options = None  # (размер, качество, предел размера файла, варианты субдискретизации)
+
+
+def collect_projects(paths):
+    """Файлы проектов из списка файлов и каталогов (каталоги просматриваются рекурсивно).
+
+    Возвращает пары (проект, путь относительно указанного каталога), по
+    которым строятся имена JPG: одноименные проекты из разных подкаталогов
+    не записываются в один файл.
+    """
+    projects = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                projects.extend((os.path.join(root, name), os.path.relpath(os.path.join(root, name), path))
+                                for name in sorted(files) if name.endswith('.pep'))
+        else:
+            projects.append((path, os.path.basename(path)))
+    return projects
+
+
+def output_paths(projects, output_dir):
+    """Пути JPG для пар (проект, относительный путь): в output_dir с подкаталогами или рядом с проектом"""
+    paths = []
+    for file_path, relative in projects:
+        name = os.path.splitext(relative)[0] + '.jpg'
+        if output_dir:
+            paths.append(os.path.join(output_dir, name))
+        else:
+            paths.append(os.path.join(os.path.dirname(file_path), os.path.basename(name)))
+    return paths
+
+
+def int_range(low, high=None):
+    """Тип аргумента argparse: целое число от low до high (без high - не меньше low)"""
+    def parse(text):
+        try:
+            value = int(text)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"ожидается целое число: {text}")
+        if high is None and value < low:
+            raise argparse.ArgumentTypeError(f"ожидается число не меньше {low}: {value}")
+        if high is not None and not low <= value <= high:
+            raise argparse.ArgumentTypeError(f"ожидается число от {low} до {high}: {value}")
+        return value
+    return parse
+
+
+def init_worker(size, quality, max_bytes, subsamplings):
+    global _app, _options
+    _app = QApplication.instance() or QApplication([])
+    load_custom_fonts(verbose=False)
+    _options = (size, quality, max_bytes, subsamplings)
+    # Процессы пула завершаются без atexit: каталог ресурсов удаляется при выходе процесса
+    multiprocessing.util.Finalize(None, asset_store.close, exitpriority=10)
+
+
+def export_project(task):
+    """Экспорт пары (проект, файл JPG); возвращает (проект, файл JPG, время, ошибка, подобранные параметры)"""
+    file_path, output_path = task
+    size, quality, max_bytes, subsamplings = _options
+    start = time.perf_counter()
+    fitted = None
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        document = load_project(file_path)
+        target_size = export_target_size(size, (document.canvas_size.width(), document.canvas_size.height()))
+        pixels = render_export(document.canvas_size, document.layers, target_size,
+                               directory=os.path.dirname(os.path.abspath(output_path)))
+        if max_bytes is None:
+            save_jpeg(pixels, output_path, quality)
+        else:
+            data, fitted_quality, subsampling = fit_jpeg(pixels, max_bytes, quality, subsamplings)
+            with open(output_path, 'wb') as f:
+                f.write(data)
+            fitted = (f"качество {fitted_quality}%, {JPEG_SUBSAMPLING_NAMES[subsampling]}, "
+                      f"{len(data) // 1024} КБ")
+        error = None
+    except Exception as e:
+        error = str(e)
+    finally:
+        # Извлеченные изображения проекта больше не нужны
+        asset_store.purge()
+    return file_path, output_path, time.perf_counter() - start, error, fitted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетный экспорт проектов редактора открыток в JPG")
+    parser.add_argument('paths', nargs='+', help="файлы .pep или каталоги с ними")
+    parser.add_argument('-o', '--output',
+                        help="каталог для JPG с подкаталогами как во входных каталогах (по умолчанию рядом с проектом)")
+    parser.add_argument('-s', '--size', default='original', choices=[key for key, label, size in EXPORT_SIZE_PRESETS],
+                        help="размер изображения (по умолчанию original)")
+    parser.add_argument('-q', '--quality', type=int_range(1, 100), default=95,
+                        help="качество JPEG, 1-100 (по умолчанию 95)")
+    parser.add_argument('-m', '--max-kb', type=int_range(1),
+                        help="предел размера файла (КБ): качество подбирается не выше -q")
+    parser.add_argument('-c', '--fit-subsampling', action='store_true',
+                        help="с -m подбирать и субдискретизацию цвета (по умолчанию 4:2:0, как в диалоге экспорта)")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="число процессов (по умолчанию по числу ядер)")
+    args = parser.parse_args(argv)
+
+    projects = collect_projects(args.paths)
+    if not projects:
+        print("Нет проектов для экспорта")
+        return 1
+
+    # Два проекта с одним файлом JPG записывали бы его одновременно из разных процессов
+    tasks = list(zip((file_path for file_path, _ in projects), output_paths(projects, args.output)))
+    targets = {}
+    for file_path, output_path in tasks:
+        key = os.path.normcase(os.path.abspath(output_path))
+        if key in targets:
+            print(f"Проекты {targets[key]} и {file_path} экспортируются в один файл {output_path}", file=sys.stderr)
+            return 1
+        targets[key] = file_path
+
+    failed = 0
+    start = time.perf_counter()
+    max_bytes = args.max_kb * 1024 if args.max_kb else None
+    subsamplings = (0, 1, 2) if args.fit_subsampling else (2,)
+    pool = multiprocessing.Pool(max(1, args.jobs), init_worker, (args.size, args.quality, max_bytes, subsamplings))
+    try:
+        for file_path, output_path, seconds, error, fitted in pool.imap_unordered(export_project, tasks):
+            if error is None:
+                print(f"{file_path} -> {output_path}: {seconds:.2f} с" + (f" ({fitted})" if fitted else ""))
+            else:
+                failed += 1
+                print(f"{file_path}: ошибка: {error} ({seconds:.2f} с)", file=sys.stderr)
+    finally:
+        # Обычное завершение процессов (а не terminate), чтобы они удалили свои временные файлы
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"Готово: {len(projects) - failed} из {len(projects)} за {elapsed:.1f} с")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
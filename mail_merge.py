@@ -0,0 +1,114 @@
+"""Слияние шаблона открытки с данными: одна JPG на строку CSV или JSON Lines.
+
+Пример:
+    python mail_merge.py шаблон.pep адресаты.csv -o открытки/ -n "{фамилия}_{имя}.jpg" -j 8
+
+Текстовые слои шаблона могут содержать поля {имя}, значения берутся из
+одноименных столбцов CSV (первая строка - заголовок) или ключей объектов
+JSON Lines. Строки читаются по мере обработки, а в работе одновременно
+находится не больше нескольких открыток на поток, поэтому объем памяти не
+зависит от размера файла данных.
+"""
+
+import os
+import re
+import csv
+import sys
+import json
+import time
+import argparse
+import concurrent.futures
+
+# Отрисовка без экрана: задается до создания QApplication
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtWidgets import QApplication
+from batch_export import int_range
+from postcard_editor import (EXPORT_SIZE_PRESETS, MergeTemplate, export_target_size, fill_placeholders, image_pixels,
+                             load_custom_fonts, load_project, save_jpeg)
+
+
+def read_rows(file_path):
+    """Строки данных по одной: словари поле -> значение"""
+    with open(file_path, 'r', encoding='utf-8-sig', newline='') as f:
+        if file_path.lower().endswith(('.jsonl', '.json')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+def output_name(pattern, number, row):
+    """Имя файла открытки: поля шаблона имени заменяются значениями строки, {n} - номером"""
+    name = fill_placeholders(pattern, dict(row, n=f"{number:05d}"))
+    return re.sub(r'[\\/:*?"<>|]', '_', name)
+
+
+def render_card(template, row, output_path, quality):
+    save_jpeg(image_pixels(template.render(row)), output_path, quality)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Слияние шаблона открытки с данными из CSV или JSON Lines")
+    parser.add_argument('template', help="проект .pep с полями {имя} в текстовых слоях")
+    parser.add_argument('data', help="файл данных: CSV с заголовком или JSON Lines (.jsonl)")
+    parser.add_argument('-o', '--output', default='.', help="каталог для JPG (по умолчанию текущий)")
+    parser.add_argument('-n', '--name', default='{n}.jpg',
+                        help="шаблон имени файла, {n} - номер строки (по умолчанию {n}.jpg)")
+    parser.add_argument('-s', '--size', default='original', choices=[key for key, label, size in EXPORT_SIZE_PRESETS],
+                        help="размер изображения (по умолчанию original)")
+    parser.add_argument('-q', '--quality', type=int_range(1, 100), default=95, help="качество JPEG, 1-100 (по умолчанию 95)")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="число потоков (по умолчанию по числу ядер)")
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication([])
+    load_custom_fonts(verbose=False)
+
+    document = load_project(args.template)
+    target_size = export_target_size(args.size, (document.canvas_size.width(), document.canvas_size.height()))
+    template = MergeTemplate(document.canvas_size, document.layers, target_size)
+    if not template.fields:
+        print("В шаблоне нет полей {имя}: все открытки будут одинаковыми", file=sys.stderr)
+    os.makedirs(args.output, exist_ok=True)
+
+    jobs = max(1, args.jobs)
+    pending = {}  # задача -> номер строки
+    done = failed = 0
+    start = time.perf_counter()
+
+    def collect(wait_for):
+        nonlocal done, failed
+        finished, _ = concurrent.futures.wait(pending, return_when=wait_for)
+        for future in finished:
+            number = pending.pop(future)
+            error = future.exception()
+            if error is None:
+                done += 1
+            else:
+                failed += 1
+                print(f"Строка {number}: ошибка: {error}", file=sys.stderr)
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        for number, row in enumerate(read_rows(args.data), 1):
+            missing = template.fields - row.keys()
+            if missing:
+                failed += 1
+                print(f"Строка {number}: нет полей {', '.join(sorted(missing))}", file=sys.stderr)
+                continue
+            output_path = os.path.join(args.output, output_name(args.name, number, row))
+            pending[executor.submit(render_card, template, row, output_path, args.quality)] = number
+            # Ограничение числа открыток в работе: чтение данных ждет освобождения потоков
+            if len(pending) >= jobs * 2:
+                collect(concurrent.futures.FIRST_COMPLETED)
+        if pending:
+            collect(concurrent.futures.ALL_COMPLETED)
+    elapsed = time.perf_counter() - start
+
+    print(f"Готово: {done} из {done + failed} за {elapsed:.1f} с ({elapsed / max(1, done + failed) * 1000:.1f} мс на открытку)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,1729 @@
 CODE_VERSION = "1.23"
 
 import os
+import io
+import re
 import json
 import sys
-from PyQt5.QtGui import QFontDatabase, QWheelEvent
+import time
+import math
+import pickle
+import tempfile
+import zlib
+import zipfile
+import shutil
+import base64
+import hashlib
+import atexit
+import queue
+from itertools import count
+from collections import OrderedDict
+from PyQt5.QtGui import QFontDatabase
+from PyQt5 import sip
 from PIL import Image, ImageFont, ImageDraw
 import numpy as np
-from PyQt5.QtCore import Qt, QPoint, QRect, QSize, pyqtSignal, QTimer, QPointF
+from PyQt5.QtCore import Qt, QPoint, QRect, QRectF, QSize, pyqtSignal, QTimer, QPointF, QSettings, \
+    QAbstractListModel, QModelIndex, QObject, QRunnable, QThreadPool, QLockFile
 from PyQt5.QtGui import QImage, QPixmap, QPainter, QColor, QFont, QPen, QTransform, QCursor, QKeyEvent, QTextOption, \
     QIcon
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                              QLabel, QPushButton, QSpinBox, QColorDialog, QFontDialog,
-                             QFileDialog, QListWidget, QToolBar, QAction, QDockWidget,
-                             QScrollArea, QSizePolicy, QTextEdit, QMessageBox, QInputDialog,
-                             QDialog, QGridLayout, QLineEdit, QCheckBox, QComboBox, QStyle, QShortcut)
+                             QFileDialog, QToolBar, QAction, QDockWidget,
+                             QScrollArea, QScrollBar, QSizePolicy, QTextEdit, QMessageBox, QInputDialog,
+                             QDialog, QGridLayout, QLineEdit, QCheckBox, QComboBox, QStyle, QShortcut,
+                             QListView, QGraphicsScene, QGraphicsView, QGraphicsItem, QProgressBar)
+
+
+def app_settings():
+    """Настройки приложения (хранятся средствами QSettings)"""
+    return QSettings("DRNU", "postcard_editor")
+
+
+def load_custom_fonts(verbose=True):
+    """Регистрация шрифтов из комплекта программы (нужен экземпляр QApplication)"""
+    font_db = QFontDatabase()
+    font_files = [
+        "Monotype-Corsiva-Bold.ttf",
+        "Monotype-Corsiva-Bold-Italic.ttf",
+        "Monotype-Corsiva-Regular.ttf",
+        "Monotype-Corsiva-Regular-Italic.ttf"
+    ]
+
+    # Проверяем несколько возможных путей
+    search_paths = []
+
+    # 1. Путь в собранном приложении (onefile)
+    if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
+        search_paths.append(os.path.join(sys._MEIPASS, 'fonts/Monotype-Corsiva'))
+
+    # 2. Путь в собранном приложении (onedir)
+    search_paths.append(os.path.join(os.path.dirname(sys.executable), 'fonts/Monotype-Corsiva'))
+
+    # 3. Путь в режиме разработки
+    search_paths.append(os.path.join(os.path.dirname(__file__), 'fonts/Monotype-Corsiva'))
+
+    # 4. Системные пути
+    search_paths.extend([
+        '/usr/share/fonts/truetype/postcard-editor',
+        '/usr/local/share/fonts',
+        os.path.expanduser('~/.local/share/fonts')
+    ])
+
+    for font_file in font_files:
+        loaded = False
+        for path in search_paths:
+            font_path = os.path.join(path, font_file)
+            if os.path.exists(font_path):
+                font_id = font_db.addApplicationFont(font_path)
+                if font_id != -1:
+                    if verbose:
+                        print(f"Successfully loaded font: {font_path}")
+                    loaded = True
+                    break
+        if not loaded:
+            print(f"Warning: Font not found: {font_file}")
+
+
+class ImageCache:
+    """Общий кэш декодированных изображений с вытеснением по LRU.
+
+    Ключ записи - путь к файлу, время его изменения и целевой размер,
+    поэтому при замене файла на диске старые записи просто перестают
+    использоваться и со временем вытесняются.
+    """
+
+    DEFAULT_BUDGET_MB = 256
+    MIPMAP_MIN_SIZE = 64  # Минимальная сторона самого мелкого уровня пирамиды
+
+    def __init__(self, max_bytes=DEFAULT_BUDGET_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()  # ключ -> (объект, размер в байтах)
+        self._pyramids = {}  # (путь, mtime) -> размеры уровней, начиная с оригинала
+
+    def set_max_bytes(self, max_bytes):
+        """Изменение бюджета памяти с немедленным вытеснением лишнего"""
+        self.max_bytes = max(0, int(max_bytes))
+        self._evict()
+
+    def clear(self):
+        self._entries.clear()
+        self._pyramids.clear()
+        self.current_bytes = 0
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _store(self, key, value, nbytes):
+        # Объект больше всего бюджета не кэшируем, чтобы не вытеснить всё остальное
+        if nbytes > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.current_bytes -= old[1]
+        self._entries[key] = (value, nbytes)
+        self.current_bytes += nbytes
+        self._evict()
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.current_bytes -= nbytes
+
+    def peek_image(self, path):
+        """Исходное изображение, если оно уже декодировано и есть в кэше, иначе None"""
+        return self._lookup(('image', path, self._mtime(path), None))
+
+    def get_image(self, path):
+        """Исходное изображение в полном размере (QImage)"""
+        key = ('image', path, self._mtime(path), None)
+        image = self._lookup(key)
+        if image is None:
+            image = QImage(path)
+            if image.isNull():
+                return image
+            self._store(key, image, image.sizeInBytes())
+        return image
+
+    def build_pyramid(self, path, image=None):
+        """Построение пирамиды уменьшенных копий изображения (1/2, 1/4, 1/8...)
+
+        Уровни используются только для отображения на холсте, экспорт
+        всегда работает с оригиналом.
+        """
+        if image is None:
+            image = self.get_image(path)
+        self.store_pyramid(path, image, self.make_pyramid(image))
+
+    @classmethod
+    def make_pyramid(cls, image):
+        """Уровни пирамиды без оригинала (можно вызывать из потоков пула)"""
+        levels = []
+        level = image
+        while not level.isNull() and min(level.width(), level.height()) // 2 >= cls.MIPMAP_MIN_SIZE:
+            level = level.scaled(level.width() // 2, level.height() // 2,
+                                 Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            levels.append(level)
+        return levels
+
+    def store_pyramid(self, path, image, levels):
+        """Запись оригинала и готовых уровней пирамиды в кэш"""
+        if image.isNull():
+            return
+        mtime = self._mtime(path)
+        self._store(('image', path, mtime, None), image, image.sizeInBytes())
+        for number, level in enumerate(levels, 1):
+            self._store(('mip', path, mtime, number), level, level.sizeInBytes())
+        self._pyramids[(path, mtime)] = [image.size()] + [level.size() for level in levels]
+
+    def _source_image(self, path, mtime, size):
+        """Ближайший уровень пирамиды, не меньший требуемого размера"""
+        sizes = self._pyramids.get((path, mtime))
+        if sizes:
+            fitted = sizes[0].scaled(size, Qt.KeepAspectRatio)
+            for level in reversed(range(1, len(sizes))):
+                if sizes[level].width() >= fitted.width() and sizes[level].height() >= fitted.height():
+                    image = self._lookup(('mip', path, mtime, level))
+                    if image is None:
+                        # Уровень вытеснен из кэша - строим пирамиду заново
+                        self.build_pyramid(path)
+                        image = self._lookup(('mip', path, mtime, level))
+                    if image is not None:
+                        return image
+                    break
+        return self.get_image(path)
+
+    def get_pixmap(self, path, size):
+        """Изображение, масштабированное под размер на экране (QPixmap)"""
+        if size.width() <= 0 or size.height() <= 0:
+            return QPixmap()
+
+        mtime = self._mtime(path)
+        key = ('pixmap', path, mtime, (size.width(), size.height()))
+        pixmap = self._lookup(key)
+        if pixmap is None:
+            image = self._source_image(path, mtime, size)
+            if image.isNull():
+                return QPixmap()
+            pixmap = QPixmap.fromImage(image.scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+            self._store(key, pixmap, pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8)
+        return pixmap
+
+
+# Кэш изображений, общий для холста и экспорта
+image_cache = ImageCache()
+
+
+class _HashingWriter:
+    """Файловая обертка, считающая SHA-256 записываемых данных"""
+
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+
+class AssetStore:
+    """Хранилище изображений проекта с адресацией по содержимому.
+
+    Каждый файл копируется во временный каталог один раз под именем, равным
+    SHA-256 его содержимого, поэтому одинаковые изображения (вставленные
+    копии, повторы в проекте) занимают место на диске, в файле проекта и в
+    кэше декодирования один раз. Слои ссылаются на ресурс по хэшу.
+
+    Ссылки считают слои документа и буфер обмена. Ресурсы без ссылок
+    удаляются при сбросе истории (purge): до этого на них могут ссылаться
+    команды отмены. Каталог целиком удаляется при закрытии (close).
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self):
+        self._directory = None
+        self._paths = {}  # хэш -> путь к файлу
+        self._refcounts = {}  # хэш -> число ссылок
+
+    def __contains__(self, asset):
+        return asset in self._paths
+
+    def path(self, asset):
+        """Путь к файлу ресурса (None для неизвестного хэша)"""
+        return self._paths.get(asset)
+
+    def add_file(self, file_path):
+        """Добавление файла изображения; возвращает хэш ресурса"""
+        with open(file_path, 'rb') as source:
+            return self.add_stream(lambda target: shutil.copyfileobj(source, target, self.CHUNK_SIZE),
+                                   os.path.splitext(file_path)[1])
+
+    def add_stream(self, write, extension):
+        """Добавление ресурса, содержимое которого записывает write(файл); возвращает хэш"""
+        self.ensure_directory()
+        temp_path, asset = self.write_temp(write)
+        return self.commit(temp_path, asset, extension)
+
+    def ensure_directory(self):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix='postcard_assets_')
+
+    def write_temp(self, write):
+        """Запись содержимого во временный файл с подсчетом хэша; возвращает (путь, хэш).
+
+        Не меняет состояние хранилища, поэтому может выполняться в потоках
+        пула (каталог должен быть заранее создан вызовом ensure_directory).
+        """
+        writer = _HashingWriter(tempfile.NamedTemporaryFile(dir=self._directory, delete=False))
+        try:
+            with writer.file:
+                write(writer)
+        except Exception:
+            os.remove(writer.file.name)
+            raise
+        return writer.file.name, writer.hash.hexdigest()
+
+    def commit(self, temp_path, asset, extension):
+        """Регистрация файла, записанного write_temp (повторное содержимое удаляется)"""
+        if asset in self._paths:
+            os.remove(temp_path)
+        else:
+            path = os.path.join(self._directory, asset + extension.lower())
+            os.replace(temp_path, path)
+            self._paths[asset] = path
+        return asset
+
+    def retain(self, asset):
+        if asset is not None:
+            self._refcounts[asset] = self._refcounts.get(asset, 0) + 1
+
+    def release(self, asset):
+        if asset is None:
+            return
+        refcount = self._refcounts.get(asset, 0) - 1
+        if refcount > 0:
+            self._refcounts[asset] = refcount
+        else:
+            self._refcounts.pop(asset, None)
+
+    def purge(self):
+        """Удаление файлов ресурсов, на которые ничто не ссылается"""
+        for asset in [asset for asset in self._paths if asset not in self._refcounts]:
+            try:
+                os.remove(self._paths.pop(asset))
+            except OSError:
+                pass
+
+    def close(self):
+        """Удаление временного каталога со всеми ресурсами"""
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+        self._paths.clear()
+        self._refcounts.clear()
+
+
+asset_store = AssetStore()
+atexit.register(asset_store.close)
+
+
+_layer_versions = count(1)  # Общий счетчик, версии разных слоев не совпадают
+
+
+class Layer:
+    """Базовый слой открытки.
+
+    Поля хранятся в слотах: объект занимает меньше памяти, чем словарь, а
+    доступ к полям быстрее. Версия меняется при каждом изменении слоя (см.
+    touch) и служит ключом для кэшей, построенных по его содержимому.
+    """
+
+    type = None
+    asset = None  # Хэш ресурса в asset_store (только у слоев с изображением)
+    __slots__ = ('rect', 'visible', 'rotation', 'version')
+
+    def __init__(self, rect, visible=True, rotation=0):
+        self.rect = rect
+        self.visible = visible
+        self.rotation = rotation
+        self.version = next(_layer_versions)
+
+    def touch(self):
+        """Отметка об изменении слоя"""
+        self.version = next(_layer_versions)
+
+    def copy(self):
+        """Независимая копия слоя (изменяемая рамка копируется отдельно)"""
+        raise NotImplementedError
+
+    def to_dict(self):
+        """Описание слоя простыми типами для файла проекта"""
+        rect = self.rect
+        return {
+            'type': self.type,
+            'rect': {'x': rect.x(), 'y': rect.y(), 'width': rect.width(), 'height': rect.height()},
+            'visible': self.visible,
+            'rotation': self.rotation
+        }
+
+    @staticmethod
+    def from_dict(data):
+        """Слой по описанию из файла проекта (ресурс изображения добавляется отдельно)"""
+        rect = QRect(data['rect']['x'], data['rect']['y'], data['rect']['width'], data['rect']['height'])
+        if data['type'] == 'image':
+            return ImageLayer(rect, data.get('asset'), data.get('name', ''), data['visible'], data['rotation'])
+        return TextLayer(rect, data['text'], data['font'], data['font_size'], data['color'],
+                         data.get('alignment', int(Qt.AlignLeft | Qt.AlignTop)),
+                         data['visible'], data['rotation'])
+
+
+class ImageLayer(Layer):
+    """Слой с изображением из хранилища ресурсов"""
+
+    type = 'image'
+    __slots__ = ('asset', 'name', 'source')
+
+    def __init__(self, rect, asset, name='', visible=True, rotation=0, source=None):
+        super().__init__(rect, visible, rotation)
+        self.asset = asset
+        self.name = name  # Имя исходного файла для подписи слоя
+        # (расширение, write(файл)) - откуда скопировать изображение, еще не попавшее в хранилище
+        # ресурсов (загружается в фоне или не загрузилось), чтобы сохранение его не потеряло
+        self.source = source
+
+    @property
+    def path(self):
+        """Путь к файлу изображения в хранилище ресурсов"""
+        return asset_store.path(self.asset)
+
+    def copy(self):
+        return ImageLayer(QRect(self.rect), self.asset, self.name, self.visible, self.rotation, self.source)
+
+    def to_dict(self):
+        data = super().to_dict()
+        data.update({'asset': self.asset, 'name': self.name})
+        return data
+
+
+class TextLayer(Layer):
+    """Текстовый слой (выравнивание хранится как int: Qt.Alignment не сериализуется)"""
+
+    type = 'text'
+    __slots__ = ('text', 'font', 'font_size', 'color', 'alignment')
+
+    def __init__(self, rect, text, font="Monotype Corsiva Bold", font_size=24, color="#000000",
+                 alignment=int(Qt.AlignLeft | Qt.AlignTop), visible=True, rotation=0):
+        super().__init__(rect, visible, rotation)
+        self.text = text
+        self.font = font
+        self.font_size = font_size
+        self.color = color
+        self.alignment = alignment
+
+    def copy(self):
+        return TextLayer(QRect(self.rect), self.text, self.font, self.font_size, self.color,
+                         self.alignment, self.visible, self.rotation)
+
+    def to_dict(self):
+        data = super().to_dict()
+        data.update({
+            'text': self.text,
+            'font': self.font,
+            'font_size': self.font_size,
+            'color': self.color,
+            'alignment': int(self.alignment)
+        })
+        return data
+
+
+PROJECT_FORMAT_VERSION = 2  # Контейнер zip: manifest.json и файлы изображений без перекодирования
+PROJECT_MANIFEST = 'manifest.json'
+
+
+def write_project(file_path, canvas_size, layers, progress=None, journal=None):
+    """Запись проекта в контейнер .pep.
+
+    Изображения копируются в архив потоком, без сжатия (JPEG и PNG уже сжаты)
+    и без чтения целиком в память. Каждый ресурс сохраняется один раз.
+    Архив пишется во временный файл рядом с целевым и заменяет его только
+    после успешной записи, поэтому сбой не портит прежний файл проекта.
+    progress(готово, всего) вызывается после каждого слоя. journal - метка
+    журнала правок, который продолжает этот снимок (см. ProjectJournal).
+    """
+    manifest = {
+        'format_version': PROJECT_FORMAT_VERSION,
+        'canvas_size': {'width': canvas_size.width(), 'height': canvas_size.height()},
+        'layers': []
+    }
+    if journal is not None:
+        manifest['journal'] = journal
+    blobs = {}  # хэш ресурса -> имя в архиве
+
+    directory = os.path.dirname(os.path.abspath(file_path))
+    handle, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(file_path)}.", suffix='.tmp', dir=directory)
+    os.close(handle)
+    try:
+        with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            _write_project_entries(archive, manifest, blobs, layers, progress)
+
+        # mkstemp создает файл с правами только для владельца
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, temp_path)
+        else:
+            os.chmod(temp_path, 0o644)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _write_project_entries(archive, manifest, blobs, layers, progress):
+    for number, layer in enumerate(layers, 1):
+        layer_data = layer.to_dict()
+        if layer.type == 'image':
+            name = blobs.get(layer.asset) if layer.asset is not None else None
+            if name is None and layer.path is not None:
+                name = f"images/{layer.asset}{os.path.splitext(layer.path)[1].lower()}"
+                archive.write(layer.path, name)
+            elif name is None and layer.source is not None:
+                # Изображение не загрузилось при открытии: копируется из прежнего файла как есть
+                name = _copy_image_source(archive, layer.source,
+                                          f"images/{layer.asset or f'layer{number}'}{layer.source[0].lower()}")
+            if name is not None:
+                if layer.asset is not None:
+                    blobs[layer.asset] = name
+                layer_data['image'] = name
+                layer_data['image_format'] = os.path.splitext(name)[1][1:]
+        manifest['layers'].append(layer_data)
+        if progress is not None:
+            progress(number, len(layers))
+
+    # Манифест записывается последним, но читается первым через каталог архива
+    archive.writestr(PROJECT_MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=1),
+                     zipfile.ZIP_DEFLATED)
+
+
+def _copy_image_source(archive, source, name):
+    """Копирование незагруженного изображения (расширение, источник) в архив под именем name.
+
+    Возвращает имя записи или None, если источник не открывается: тогда слой
+    сохраняется без изображения. Поврежденное содержимое копируется в том
+    виде, в каком читается, - так его еще можно восстановить вручную.
+    """
+    try:
+        stream = source[1].open()
+    except Exception:
+        return None
+    with stream, archive.open(name, 'w', force_zip64=True) as target:
+        try:
+            shutil.copyfileobj(stream, target)
+        except Exception:
+            pass
+    return name
+
+
+class ProjectReader:
+    """Чтение проекта .pep: сначала манифест, изображения - по запросу.
+
+    Поддерживается и прежний формат (JSON с изображениями в base64): такой
+    файл разбирается целиком, но интерфейс чтения остается тем же.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._archive = None
+        if zipfile.is_zipfile(file_path):
+            self._archive = zipfile.ZipFile(file_path, 'r')
+            try:
+                manifest = json.loads(self._archive.read(PROJECT_MANIFEST).decode('utf-8'))
+            except Exception:
+                # Читатель не будет создан, и закрыть архив больше некому
+                self._archive.close()
+                raise
+        else:
+            with open(file_path, 'r') as f:
+                manifest = json.load(f)
+        self.canvas_size = QSize(manifest['canvas_size']['width'], manifest['canvas_size']['height'])
+        self.layers = manifest['layers']
+        self.journal = manifest.get('journal')  # Метка журнала правок к этому снимку
+
+    def close(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def image_source(self, layer_data):
+        """Функция write(target), копирующая изображение слоя в двоичный файл
+        (None, если изображение слоя не сохранилось в проекте).
+
+        Функция не зависит от открытого читателя и может вызываться из потоков
+        пула после его закрытия: архив каждый раз открывается заново.
+        """
+        if 'image' in layer_data:
+            return _ArchiveImageSource(self.file_path, layer_data['image'])
+        if 'image_data' in layer_data:
+            return _EmbeddedImageSource(layer_data['image_data'])
+        return None
+
+
+class _ImageSource:
+    """Изображение слоя в файле проекта (сериализуется вместе со слоем в истории).
+
+    Вызов source(target) копирует изображение в двоичный файл, open()
+    возвращает поток для чтения.
+    """
+
+    def open(self):
+        raise NotImplementedError
+
+    def __call__(self, target):
+        with self.open() as source:
+            shutil.copyfileobj(source, target)
+
+
+class _ArchiveImageSource(_ImageSource):
+    """Изображение в архиве проекта"""
+
+    def __init__(self, file_path, name):
+        self.file_path = file_path
+        self.name = name
+
+    def open(self):
+        # Поток чтения записи держит файл открытым и после закрытия ZipFile
+        with zipfile.ZipFile(self.file_path, 'r') as archive:
+            return archive.open(self.name)
+
+
+class _EmbeddedImageSource(_ImageSource):
+    """Изображение из проекта прежнего формата (base64 в JSON)"""
+
+    def __init__(self, image_data):
+        self.image_data = image_data
+
+    def open(self):
+        return io.BytesIO(base64.b64decode(self.image_data))
+
+
+class _JournalImageSource(_ImageSource):
+    """Изображение, дописанное в журнал правок: size байт со смещения offset"""
+
+    def __init__(self, path, offset, size):
+        self.path = path
+        self.offset = offset
+        self.size = size
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return io.BytesIO(f.read(self.size))
+
+    def __call__(self, target):
+        with open(self.path, 'rb') as source:
+            source.seek(self.offset)
+            remaining = self.size
+            while remaining:
+                chunk = source.read(min(remaining, AssetStore.CHUNK_SIZE))
+                if not chunk:
+                    raise EOFError("журнал правок оборван")
+                target.write(chunk)
+                remaining -= len(chunk)
+
+
+class _ImageLoadTask(QRunnable):
+    """Извлечение и декодирование одного изображения в потоке пула"""
+
+    def __init__(self, loader, key, write):
+        super().__init__()
+        self.loader = loader
+        self.key = key
+        self.write = write
+
+    def run(self):
+        if self.loader.cancelled:
+            return
+        try:
+            temp_path, asset = asset_store.write_temp(self.write)
+            image = QImage(temp_path)
+            if image.isNull():
+                os.remove(temp_path)
+                raise ValueError("файл поврежден или имеет неизвестный формат")
+            result = (self.key, temp_path, asset, image, ImageCache.make_pyramid(image), None)
+        except Exception as e:
+            result = (self.key, None, None, None, None, e)
+        self.loader.results.put(result)
+        self.loader.ready.emit()
+
+
+class ProjectImageLoader(QObject):
+    """Фоновая загрузка изображений открытого проекта.
+
+    Потоки пула извлекают файлы во временный каталог хранилища ресурсов и
+    декодируют их вместе с пирамидой уменьшенных копий. Регистрация ресурса
+    и запись в кэш выполняются в основном потоке (drain), после чего
+    сигнал image_loaded сообщает хэш ресурса и ожидавшие его слои. Порядок
+    задается приоритетом: чем больше число, тем раньше начнется загрузка.
+    """
+
+    ready = pyqtSignal()
+    image_loaded = pyqtSignal(str, object)  # хэш ресурса, список слоев
+    image_failed = pyqtSignal(str, object, object)  # ключ загрузки, список слоев, исключение
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.results = queue.Queue()
+        self.pending = {}  # ключ загрузки -> (расширение файла, ожидающие слои)
+        self.cancelled = False
+        self.ready.connect(self.drain)
+        asset_store.ensure_directory()
+
+    def add(self, key, extension, write, layer, priority=0):
+        """Постановка изображения в очередь (слои с одинаковым ключом ждут одну загрузку).
+
+        layer=None - изображение, которого пока не ждет ни один слой документа
+        (например, нужное только для отмены правок из журнала).
+        """
+        if key in self.pending:
+            if layer is not None:
+                self.pending[key][1].append(layer)
+            return
+        self.pending[key] = (extension, [layer] if layer is not None else [])
+        self.pool.start(_ImageLoadTask(self, key, write), priority)
+
+    def is_done(self):
+        return not self.pending
+
+    def drain(self):
+        """Обработка готовых результатов в основном потоке"""
+        while True:
+            try:
+                key, temp_path, asset, image, levels, error = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if self.cancelled:
+                if temp_path is not None:
+                    os.remove(temp_path)
+                continue
+
+            extension, layers = self.pending.pop(key)
+            if error is not None:
+                self.image_failed.emit(key, layers, error)
+                continue
+            asset_store.commit(temp_path, asset, extension)
+            image_cache.store_pyramid(asset_store.path(asset), image, levels)
+            self.image_loaded.emit(asset, layers)
+
+    def wait(self):
+        """Ожидание всех загрузок с обработкой результатов"""
+        self.pool.waitForDone()
+        self.drain()
+
+    def cancel(self):
+        """Отмена загрузок (уже начатые задачи доработают, их результаты отбрасываются)"""
+        self.cancelled = True
+        self.pool.clear()
+        self.pool.waitForDone()
+        self.drain()
+        self.pending.clear()
+
+
+class _SaveTask(QRunnable):
+    """Запись снимка проекта в потоке пула"""
+
+    def __init__(self, saver, file_path, canvas_size, layers, tag, journal):
+        super().__init__()
+        self.saver = saver
+        self.file_path = file_path
+        self.canvas_size = canvas_size
+        self.layers = layers
+        self.tag = tag
+        self.journal = journal
+
+    def run(self):
+        def progress(done, total):
+            self.saver.progress.emit(self.file_path, done, total)
+
+        try:
+            write_project(self.file_path, self.canvas_size, self.layers, progress, self.journal)
+            error = None
+        except Exception as e:
+            error = e
+        self.saver.results.put((self.file_path, error, self.layers, self.tag))
+        self.saver.ready.emit()
+
+
+class ProjectSaver(QObject):
+    """Фоновое сохранение проектов.
+
+    save() делает снимок слоев (копии объектов слоев, без копирования
+    изображений) и удерживает их ресурсы в хранилище, чтобы правки и
+    очистка истории во время записи не удалили нужные файлы. Запись идет в
+    единственном потоке пула, поэтому сохранения выполняются по очереди.
+    Ресурсы снимка освобождаются в основном потоке (drain), после чего
+    сигнал saved сообщает путь, исключение (None при успехе) и метку
+    вызывающего.
+    """
+
+    ready = pyqtSignal()
+    progress = pyqtSignal(str, int, int)  # путь, готово слоев, всего слоев
+    saved = pyqtSignal(str, object, object)  # путь, исключение, метка
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.results = queue.Queue()
+        self.running = 0
+        self.ready.connect(self.drain)
+
+    def save(self, file_path, canvas_size, layers, tag=None, journal=None):
+        snapshot = [layer.copy() for layer in layers]
+        for layer in snapshot:
+            asset_store.retain(layer.asset)
+        self.running += 1
+        self.pool.start(_SaveTask(self, file_path, QSize(canvas_size), snapshot, tag, journal))
+
+    def drain(self):
+        """Обработка завершенных сохранений в основном потоке"""
+        while True:
+            try:
+                file_path, error, snapshot, tag = self.results.get_nowait()
+            except queue.Empty:
+                return
+            for layer in snapshot:
+                asset_store.release(layer.asset)
+            self.running -= 1
+            self.saved.emit(file_path, error, tag)
+
+    def is_busy(self):
+        return self.running > 0
+
+    def wait(self):
+        """Ожидание всех сохранений с обработкой их завершения"""
+        self.pool.waitForDone()
+        self.drain()
+
+
+class ExportCancelled(Exception):
+    """Экспорт прерван пользователем"""
+
+
+class _ExportTask(QRunnable):
+    """Отрисовка и запись изображения в потоке пула"""
+
+    def __init__(self, exporter, file_path, render, encode, layers):
+        super().__init__()
+        self.exporter = exporter
+        self.file_path = file_path
+        self.render = render
+        self.encode = encode
+        self.layers = layers
+
+    def run(self):
+        def progress(done, total):
+            if self.exporter.cancelled:
+                raise ExportCancelled()
+            self.exporter.progress.emit(done, total)
+
+        temp_path = None
+        try:
+            image = self.render(progress)
+            if self.exporter.cancelled:
+                raise ExportCancelled()
+            # Запись во временный файл: отмена или сбой не оставляют недописанного изображения
+            directory = os.path.dirname(os.path.abspath(self.file_path))
+            handle, temp_path = tempfile.mkstemp(suffix=os.path.splitext(self.file_path)[1], dir=directory)
+            os.close(handle)
+            result = self.encode(image, temp_path, progress)
+            if self.exporter.cancelled:
+                raise ExportCancelled()
+            if os.path.exists(self.file_path):
+                shutil.copymode(self.file_path, temp_path)
+            else:
+                os.chmod(temp_path, 0o644)
+            os.replace(temp_path, self.file_path)
+            temp_path = None
+            error = None
+        except Exception as e:
+            result, error = None, e
+        finally:
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+        self.exporter.results.put((self.file_path, result, error, self.layers))
+        self.exporter.ready.emit()
+
+
+class ImageExporter(QObject):
+    """Экспорт изображения в фоновом потоке.
+
+    export() получает функции render(progress) -> изображение и
+    encode(изображение, путь, progress) -> результат, которые выполняются
+    в потоке пула и не должны обращаться к данным редактора (слои
+    передаются копиями, изображения - через export_sources). Ресурсы
+    копий слоев удерживаются до конца экспорта: поток отрисовки может
+    декодировать их файлы позже, чем очистка истории удалила бы их. Сигнал
+    progress сообщает ход отрисовки и кодирования, exported - путь,
+    результат encode и исключение (ExportCancelled при отмене, None при
+    успехе).
+    """
+
+    ready = pyqtSignal()
+    progress = pyqtSignal(int, int)  # готово, всего
+    exported = pyqtSignal(str, object, object)  # путь, результат, исключение
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.results = queue.Queue()
+        self.running = 0
+        self.cancelled = False
+        self.ready.connect(self.drain)
+
+    def export(self, file_path, render, encode, layers=()):
+        for layer in layers:
+            asset_store.retain(layer.asset)
+        self.cancelled = False
+        self.running += 1
+        self.pool.start(_ExportTask(self, file_path, render, encode, layers))
+
+    def drain(self):
+        """Обработка завершенных экспортов в основном потоке"""
+        while True:
+            try:
+                file_path, result, error, layers = self.results.get_nowait()
+            except queue.Empty:
+                return
+            for layer in layers:
+                asset_store.release(layer.asset)
+            self.running -= 1
+            self.exported.emit(file_path, result, error)
+
+    def is_busy(self):
+        return self.running > 0
+
+    def cancel(self):
+        """Отмена экспорта (проверяется между слоями и перед записью файла)"""
+        self.cancelled = True
+
+    def wait(self):
+        self.pool.waitForDone()
+        self.drain()
+
+
+class LayerGeometry:
+    """Экранная геометрия слоя при заданном масштабе.
+
+    Хранит масштабированную рамку, преобразование из локальных координат слоя
+    в экранные, обратное к нему и прямоугольники маркеров. Маркеры заданы в
+    локальных координатах, поэтому для повернутых слоев попадание в них
+    проверяется так же точно, как и для обычных.
+    """
+
+    HANDLE_SIZE = 8
+    HANDLE_MARGIN = 6  # Запас на маркеры и толщину пера выделения
+    ROTATION_HANDLE_OFFSET = 30  # Расстояние от рамки до маркера вращения
+
+    # Курсоры для маркера вращения и маркеров изменения размера
+    HANDLE_CURSORS = {
+        'rotation': Qt.PointingHandCursor,
+        'top-left': Qt.SizeFDiagCursor,
+        'bottom-right': Qt.SizeFDiagCursor,
+        'top-right': Qt.SizeBDiagCursor,
+        'bottom-left': Qt.SizeBDiagCursor,
+        'top-center': Qt.SizeVerCursor,
+        'bottom-center': Qt.SizeVerCursor,
+        'left-center': Qt.SizeHorCursor,
+        'right-center': Qt.SizeHorCursor
+    }
+
+    @staticmethod
+    def make_key(layer, scale_factor):
+        """Ключ актуальности геометрии: версия слоя и масштаб"""
+        return layer.version, scale_factor
+
+    def __init__(self, layer, scale_factor, key=None):
+        self.key = key if key is not None else self.make_key(layer, scale_factor)
+
+        rect = layer.rect
+        self.screen_rect = QRect(
+            int(rect.x() * scale_factor),
+            int(rect.y() * scale_factor),
+            int(rect.width() * scale_factor),
+            int(rect.height() * scale_factor)
+        )
+        width, height = self.screen_rect.width(), self.screen_rect.height()
+        self.local_rect = QRect(0, 0, width, height)
+
+        self.transform = QTransform()
+        if layer.rotation != 0:
+            center = self.screen_rect.center()
+            self.transform.translate(center.x(), center.y())
+            self.transform.rotate(layer.rotation)
+            self.transform.translate(-width / 2, -height / 2)
+        else:
+            self.transform.translate(self.screen_rect.x(), self.screen_rect.y())
+        self.inverse = self.transform.inverted()[0]
+
+        size = self.HANDLE_SIZE
+        half = size // 2
+        self.handles = {
+            'top-left': QRect(-half, -half, size, size),
+            'top-right': QRect(width - half, -half, size, size),
+            'bottom-left': QRect(-half, height - half, size, size),
+            'bottom-right': QRect(width - half, height - half, size, size),
+            'top-center': QRect(width // 2 - half, -half, size, size),
+            'bottom-center': QRect(width // 2 - half, height - half, size, size),
+            'left-center': QRect(-half, height // 2 - half, size, size),
+            'right-center': QRect(width - half, height // 2 - half, size, size)
+        }
+        self.rotation_handle = QRect(width // 2 - half, -self.ROTATION_HANDLE_OFFSET, size, size)
+
+        self._bounds = {}
+
+    def bounds(self, with_handles=True):
+        """Экранные границы слоя с учетом поворота и маркеров"""
+        bounds = self._bounds.get(with_handles)
+        if bounds is None:
+            margin = self.HANDLE_MARGIN
+            top_margin = margin + self.ROTATION_HANDLE_OFFSET if with_handles else margin
+            local = QRectF(self.local_rect).adjusted(-margin, -top_margin, margin, margin)
+            bounds = self.transform.mapRect(local).toAlignedRect().adjusted(-1, -1, 1, 1)
+            self._bounds[with_handles] = bounds
+        return bounds
+
+    def contains(self, pos):
+        """Попадание экранной точки внутрь рамки слоя"""
+        return self.local_rect.contains(self.inverse.map(pos))
+
+    def handle_at(self, pos):
+        """Маркер под экранной точкой: 'rotation', имя маркера размера или None"""
+        local_pos = self.inverse.map(pos)
+        if self.rotation_handle.contains(local_pos):
+            return 'rotation'
+        for name, handle in self.handles.items():
+            if handle.contains(local_pos):
+                return name
+        return None
+
+
+class LayerGeometryStore:
+    """Колоночная копия геометрии слоев в массивах NumPy.
+
+    Строка i соответствует слою editor.layers[i]. Хранятся рамка (x, y, w, h),
+    угол, видимость, порядок отрисовки z (0 - нижний слой) и производные
+    столбцы: синус/косинус угла и ограничивающий прямоугольник повернутой
+    рамки. Запросы по всем слоям сразу выполняются векторно, без цикла по
+    слоям. Синхронизация идет через rebuild (изменение состава или порядка
+    слоев) и update (изменение одного слоя).
+    """
+
+    def __init__(self):
+        self.rebuild([])
+
+    def __len__(self):
+        return len(self.x)
+
+    def rebuild(self, layers):
+        """Полное заполнение столбцов по списку слоев"""
+        count = len(layers)
+        rects = np.array([(layer.rect.x(), layer.rect.y(), layer.rect.width(), layer.rect.height())
+                          for layer in layers], dtype=np.float64).reshape(count, 4)
+        self.x, self.y, self.w, self.h = (rects[:, k].copy() for k in range(4))
+        self.rotation = np.fromiter((layer.rotation for layer in layers), np.float64, count)
+        self.visible = np.fromiter((layer.visible for layer in layers), np.bool_, count)
+        self.z = np.arange(count - 1, -1, -1, dtype=np.int32)
+        self._update_derived(slice(None))
+
+    def update(self, index, layer):
+        """Обновление строки одного слоя после перемещения, поворота или скрытия"""
+        rect = layer.rect
+        self.x[index], self.y[index] = rect.x(), rect.y()
+        self.w[index], self.h[index] = rect.width(), rect.height()
+        self.rotation[index] = layer.rotation
+        self.visible[index] = layer.visible
+        self._update_derived(slice(index, index + 1))
+
+    def _update_derived(self, rows):
+        radians = np.radians(self.rotation[rows])
+        cos, sin = np.cos(radians), np.sin(radians)
+        w, h = self.w[rows], self.h[rows]
+        half_w = (w * np.abs(cos) + h * np.abs(sin)) / 2
+        half_h = (w * np.abs(sin) + h * np.abs(cos)) / 2
+        center_x, center_y = self.x[rows] + w / 2, self.y[rows] + h / 2
+        if isinstance(rows, slice) and rows == slice(None):
+            self.cos, self.sin = cos, sin
+            self.left, self.right = center_x - half_w, center_x + half_w
+            self.top, self.bottom = center_y - half_h, center_y + half_h
+        else:
+            self.cos[rows], self.sin[rows] = cos, sin
+            self.left[rows], self.right[rows] = center_x - half_w, center_x + half_w
+            self.top[rows], self.bottom[rows] = center_y - half_h, center_y + half_h
+
+    def _top_first(self, mask):
+        """Индексы отмеченных слоев от верхнего к нижнему"""
+        rows = np.flatnonzero(mask)
+        return rows[np.argsort(-self.z[rows], kind='stable')]
+
+    def rows_in_rect(self, rect, include_hidden=False):
+        """Слои, повернутые рамки которых пересекают прямоугольник холста, сверху вниз"""
+        left, top, right, bottom = rect.left(), rect.top(), rect.right(), rect.bottom()
+        mask = (self.left <= right) & (self.right >= left) & (self.top <= bottom) & (self.bottom >= top)
+        if not include_hidden:
+            mask &= self.visible
+        return self._top_first(mask)
+
+    def rows_at_point(self, x, y, tolerance=0.0):
+        """Видимые слои, повернутая рамка которых содержит точку холста, сверху вниз"""
+        dx = x - (self.x + self.w / 2)
+        dy = y - (self.y + self.h / 2)
+        local_x = dx * self.cos + dy * self.sin
+        local_y = dy * self.cos - dx * self.sin
+        mask = ((np.abs(local_x) <= self.w / 2 + tolerance) & (np.abs(local_y) <= self.h / 2 + tolerance)
+                & self.visible)
+        return self._top_first(mask)
+
+    def scaled_rects(self, scale_x, scale_y):
+        """Рамки всех слоев в целевом масштабе (с отбрасыванием дробной части, как int())"""
+        rects = np.stack((self.x * scale_x, self.y * scale_y, self.w * scale_x, self.h * scale_y), axis=1)
+        return np.trunc(rects).astype(np.int64)
+
+
+class HistoryCommand:
+    """Обратимое действие в истории изменений.
+
+    Команда хранит только изменившиеся данные. В историю она попадает уже
+    выполненной, поэтому redo вызывается лишь при повторе действия. Команды
+    применяются строго в порядке стека, так что индексы слоев, запомненные
+    при записи, остаются верными при отмене и повторе.
+    """
+
+    def __init__(self, label, merge_key=None):
+        self.label = label
+        self.index = None  # Индекс слоя, который стоит выделить после отмены/повтора
+        self.merge_key = merge_key  # Однотипные правки с одинаковым ключом сливаются
+        self.timestamp = time.monotonic()
+        self.nbytes = 0  # Оценка занимаемой памяти (заполняется при записи в историю)
+
+    def merge(self, other):
+        """Поглощение следующей однотипной команды (False - слияние невозможно)"""
+        return False
+
+    def undo(self, editor):
+        pass
+
+    def redo(self, editor):
+        pass
+
+
+class ChangeLayerCommand(HistoryCommand):
+    """Изменение свойств слоя: перемещение, размер, поворот, текст, шрифт, цвет..."""
+
+    def __init__(self, label, index, before, after, merge_kind=None):
+        super().__init__(label, (merge_kind, index) if merge_kind else None)
+        self.index = index
+        self.before = before
+        self.after = after
+
+    def merge(self, other):
+        if not isinstance(other, ChangeLayerCommand) or other.merge_key != self.merge_key:
+            return False
+        for key, value in other.before.items():
+            self.before.setdefault(key, value)
+        self.after.update(other.after)
+        self.timestamp = other.timestamp
+        return True
+
+    @staticmethod
+    def _apply(editor, index, values):
+        layer = editor.layers[index]
+        for key, value in values.items():
+            setattr(layer, key, QRect(value) if isinstance(value, QRect) else value)
+        editor.layer_changed(index)
+
+    def undo(self, editor):
+        self._apply(editor, self.index, self.before)
+
+    def redo(self, editor):
+        self._apply(editor, self.index, self.after)
+
+
+class InsertLayerCommand(HistoryCommand):
+    """Добавление слоя (при первом изображении заодно меняется размер холста)"""
+
+    def __init__(self, label, index, layer, canvas_size=None):
+        super().__init__(label)
+        self.index = index
+        self.layer = layer
+        self.canvas_size = canvas_size  # (размер до, размер после) или None
+
+    def undo(self, editor):
+        # Запоминаем сам удаляемый объект: команда могла быть восстановлена с диска в виде копии
+        self.layer = editor.remove_layer(self.index)
+        if self.canvas_size is not None:
+            editor.canvas.set_canvas_size(self.canvas_size[0])
+
+    def redo(self, editor):
+        editor.insert_layer(self.index, self.layer)
+        if self.canvas_size is not None:
+            editor.canvas.set_canvas_size(self.canvas_size[1])
+
+
+class DeleteLayerCommand(HistoryCommand):
+    """Удаление слоя"""
+
+    def __init__(self, index, layer):
+        super().__init__("Удаление слоя")
+        self.index = index
+        self.layer = layer
+
+    def undo(self, editor):
+        editor.insert_layer(self.index, self.layer)
+
+    def redo(self, editor):
+        self.layer = editor.remove_layer(self.index)
+
+
+class ReorderLayerCommand(HistoryCommand):
+    """Перемещение слоя вверх или вниз по списку"""
+
+    def __init__(self, old_index, new_index):
+        super().__init__("Порядок слоев")
+        self.old_index = old_index
+        self.new_index = new_index
+        self.index = new_index
+
+    def undo(self, editor):
+        editor.move_layer(self.new_index, self.old_index)
+        self.index = self.old_index
+
+    def redo(self, editor):
+        editor.move_layer(self.old_index, self.new_index)
+        self.index = self.new_index
+
+
+class SpilledCommand(HistoryCommand):
+    """Заглушка записи истории, выгруженной на диск"""
+
+    def __init__(self, command, offset, length):
+        super().__init__(command.label)
+        self.index = command.index
+        self.offset = offset
+        self.length = length
+
+
+class HistorySpillStore:
+    """Временное хранилище на диске для старых записей истории.
+
+    Записи сжимаются и дописываются в конец временного файла, а в памяти
+    остается только SpilledCommand со смещением. Загруженная обратно или
+    удаленная запись становится мусором; когда мусора в файле больше, чем
+    живых записей, файл переписывается без него (со сдвигом смещений).
+    Файл удаляется при сбросе истории или закрытии редактора.
+    """
+
+    COMPACT_MIN_BYTES = 64 * 1024  # Меньший объем мусора не стоит переписывания файла
+
+    def __init__(self):
+        self._file = None
+        self._live = set()  # SpilledCommand, на которые еще ссылается история
+        self.disk_bytes = 0  # Объем записей, на которые еще ссылается история
+        self.file_bytes = 0  # Размер временного файла вместе с мусором
+
+    def spill(self, command):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix="postcard_history_")
+        data = zlib.compress(pickle.dumps(command, pickle.HIGHEST_PROTOCOL))
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        self._file.write(data)
+        self.disk_bytes += len(data)
+        self.file_bytes = offset + len(data)
+        spilled = SpilledCommand(command, offset, len(data))
+        self._live.add(spilled)
+        return spilled
+
+    def load(self, spilled):
+        self._file.seek(spilled.offset)
+        command = pickle.loads(zlib.decompress(self._file.read(spilled.length)))
+        self.forget(spilled)
+        return command
+
+    def forget(self, spilled):
+        """Учет записи, удаленной из истории без загрузки"""
+        self._live.discard(spilled)
+        self.disk_bytes -= spilled.length
+        garbage = self.file_bytes - self.disk_bytes
+        if garbage > self.disk_bytes and garbage >= self.COMPACT_MIN_BYTES:
+            self.compact()
+
+    def compact(self):
+        """Перезапись файла только с живыми записями"""
+        compacted = tempfile.TemporaryFile(prefix="postcard_history_")
+        for spilled in sorted(self._live, key=lambda spilled: spilled.offset):
+            self._file.seek(spilled.offset)
+            data = self._file.read(spilled.length)
+            spilled.offset = compacted.tell()
+            compacted.write(data)
+        self._file.close()
+        self._file = compacted
+        self.file_bytes = compacted.tell()
+
+    def clear(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._live.clear()
+        self.disk_bytes = 0
+        self.file_bytes = 0
+
+
+class UndoneCommand(HistoryCommand):
+    """Отмена действия, восстановленная из журнала правок как самостоятельная запись"""
+
+    def __init__(self, command):
+        super().__init__("Отмена: " + command.label)
+        self.command = command
+        self.index = command.index
+
+    def undo(self, editor):
+        self.command.redo(editor)
+        self.index = self.command.index
+
+    def redo(self, editor):
+        self.command.undo(editor)
+        self.index = self.command.index
+
+
+JOURNAL_COMMANDS = {cls.__name__: cls for cls in (
+    ChangeLayerCommand, InsertLayerCommand, DeleteLayerCommand, ReorderLayerCommand, UndoneCommand)}
+
+
+class ProjectJournal:
+    """Журнал правок, дописываемый рядом с файлом проекта (<проект>.journal).
+
+    Каждое выполненное, отмененное или повторенное действие дописывается в
+    конец журнала небольшой записью, поэтому сохранение не переписывает
+    проект целиком, а при сбое теряется не больше одной записи. Записи
+    описывают последовательность действий над снимком проекта: 'do' -
+    действие выполнено (или повторено), 'undo' - отменено, 'merge' - последнее
+    выполненное действие продолжено (быстрые правки, слитые в одну запись
+    истории) и заменяется командой записи целиком. Изображения, которых
+    нет в снимке, дописываются один раз записью 'asset' с содержимым файла.
+    Сохранение проекта дописывает отметку 'save': содержимое документа - это
+    снимок и действия до последней отметки, а действия после нее - не
+    сохраненные пользователем правки, которые можно лишь восстановить после сбоя.
+
+    Формат: строка JSON на запись, за записью 'asset' сразу следуют size
+    байт файла. Первая запись - заголовок с меткой снимка; журнал с чужой
+    меткой (от другого снимка) не применяется. Оборванный хвост после
+    сбоя отбрасывается при чтении.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, token, assets, file):
+        self.path = path
+        self.token = token
+        self.assets = set(assets)  # Ресурсы, доступные при воспроизведении: из снимка и журнала
+        self._file = file
+        self.failed = False  # Запись не удалась: журнал закрыт и больше не дописывается
+        self._last_action = None  # (начало, операция) последней записи, если это 'do' или 'merge'
+
+    @classmethod
+    def create(cls, path, token, assets):
+        """Новый журнал к снимку с меткой token (прежний файл заменяется)"""
+        journal = cls(path, token, assets, open(path, 'wb'))
+        journal._write({'journal': cls.VERSION, 'token': token})
+        return journal
+
+    @classmethod
+    def resume(cls, path, token, assets, end):
+        """Продолжение прочитанного журнала с отбрасыванием оборванного хвоста"""
+        file = open(path, 'r+b')
+        file.truncate(end)
+        file.seek(end)
+        return cls(path, token, assets, file)
+
+    @staticmethod
+    def read(path, token):
+        """Записи журнала к снимку token: (список (запись, смещение содержимого, конец записи), конец заголовка).
+
+        Содержимое файлов ресурсов не читается, запоминается только его
+        смещение в журнале. Возвращает None, если журнала нет или он
+        относится к другому снимку.
+        """
+        try:
+            file = open(path, 'rb')
+        except OSError:
+            return None
+        records = []
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            try:
+                header = json.loads(file.readline())
+            except ValueError:
+                return None
+            if not isinstance(header, dict) or header.get('token') != token:
+                return None
+            start = file.tell()
+            while True:
+                line = file.readline()
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                offset = None
+                if 'size' in record:
+                    offset = file.tell()
+                    if offset + record['size'] > size:
+                        break
+                    file.seek(record['size'], os.SEEK_CUR)
+                records.append((record, offset, file.tell()))
+        return records, start
+
+    @staticmethod
+    def split_saved(records):
+        """Разделение записей на сохраненные (до последней отметки 'save' включительно) и несохраненные"""
+        last = max((i for i, (record, _, _) in enumerate(records) if record['op'] == 'save'), default=-1)
+        return records[:last + 1], records[last + 1:]
+
+    @staticmethod
+    def count_actions(records):
+        """Число действий ('do' и 'undo') среди записей"""
+        return sum(1 for record, _, _ in records if record['op'] in ('do', 'undo'))
+
+    @classmethod
+    def actions(cls, path, records, assets, images):
+        """Действия журнала path по порядку: (операция, команда, конец записи).
+
+        Ресурсы из журнала не извлекаются: их хэши добавляются в assets, а
+        (хэш, расширение, источник) - в images, для таких записей вместо
+        команды возвращается None. Команда 'undo' возвращается обернутой в
+        UndoneCommand, так что для воспроизведения любого действия
+        достаточно вызвать redo. Команда 'merge' заменяет последнее действие
+        в истории, а ее redo приводит документ к состоянию после продолжения.
+        """
+        for record, offset, end in records:
+            op = record['op']
+            if op == 'asset':
+                if record['asset'] not in assets:
+                    assets.add(record['asset'])
+                    images.append((record['asset'], record['extension'],
+                                   _JournalImageSource(path, offset, record['size'])))
+                yield op, None, end
+                continue
+            if op == 'save':
+                yield op, None, end
+                continue
+            command = cls.decode(record['command'])
+            if op == 'undo':
+                command = UndoneCommand(command)
+            yield op, command, end
+
+    def _write(self, record, blob=None):
+        start = self._file.tell()
+        self._last_action = None
+        try:
+            self._file.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+            if blob is not None:
+                self._file.write(blob)
+            # Запись сразу уходит в ОС: при аварийном завершении программы она сохранится
+            self._file.flush()
+        except OSError:
+            self.failed = True
+            self._truncate(start)
+            raise
+
+    def _truncate(self, end):
+        """Закрытие журнала с отрезанием недописанной записи: все записи до нее остаются читаемыми"""
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        try:
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        except OSError:
+            pass
+
+    def record(self, op, command):
+        """Дописывание выполненного ('do'), отмененного ('undo') или продолженного ('merge') действия.
+
+        Продолжение, записываемое сразу за самим действием, переписывает его
+        запись на месте: набор текста занимает в журнале одну запись, а не
+        запись с полным текстом на каждое нажатие.
+        """
+        data = self.encode(command)
+        rewrite = op == 'merge' and self._last_action is not None
+        if rewrite:
+            start, op = self._last_action
+            self._file.seek(start)
+        else:
+            start = self._file.tell()
+        self._write({'op': op, 'command': data})
+        if rewrite:
+            try:
+                # Прежняя запись могла быть длиннее новой
+                self._file.truncate()
+            except OSError:
+                self.failed = True
+                self._truncate(start)
+                raise
+        if op in ('do', 'merge'):
+            self._last_action = (start, op)
+
+    def encode(self, value):
+        """Значение простыми типами JSON (изображения новых слоев дописываются в журнал)"""
+        if isinstance(value, HistoryCommand):
+            data = {key: self.encode(item) for key, item in vars(value).items()
+                    if key not in ('timestamp', 'nbytes')}
+            data['$command'] = type(value).__name__
+            return data
+        if isinstance(value, Layer):
+            if value.type == 'image':
+                self.add_asset(value.asset)
+            return {'$layer': value.to_dict()}
+        if isinstance(value, QRect):
+            return {'$rect': [value.x(), value.y(), value.width(), value.height()]}
+        if isinstance(value, QSize):
+            return {'$size': [value.width(), value.height()]}
+        if isinstance(value, dict):
+            return {key: self.encode(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.encode(item) for item in value]
+        return value
+
+    @classmethod
+    def decode(cls, value):
+        if isinstance(value, list):
+            return [cls.decode(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        if '$command' in value:
+            command_class = JOURNAL_COMMANDS[value['$command']]
+            command = command_class.__new__(command_class)
+            HistoryCommand.__init__(command, value['label'])
+            for key, item in value.items():
+                if key != '$command':
+                    setattr(command, key, cls.decode(item))
+            if command.merge_key is not None:
+                command.merge_key = tuple(command.merge_key)
+            return command
+        if '$layer' in value:
+            return Layer.from_dict(value['$layer'])
+        if '$rect' in value:
+            return QRect(*value['$rect'])
+        if '$size' in value:
+            return QSize(*value['$size'])
+        return {key: cls.decode(item) for key, item in value.items()}
+
+    def add_asset(self, asset):
+        """Дописывание файла ресурса, которого нет ни в снимке, ни в журнале"""
+        path = asset_store.path(asset)
+        if asset in self.assets or path is None:
+            return
+        with open(path, 'rb') as f:
+            blob = f.read()
+        self._write({'op': 'asset', 'asset': asset, 'extension': os.path.splitext(path)[1], 'size': len(blob)},
+                    blob)
+        self.assets.add(asset)
+
+    def save_point(self):
+        """Отметка сохранения проекта, сброшенная на диск"""
+        start = self._file.tell()
+        self._write({'op': 'save'})
+        try:
+            self.sync()
+        except OSError:
+            # Отметка, не дошедшая до диска, не считается сохранением
+            self.failed = True
+            self._truncate(start)
+            raise
+
+    def sync(self):
+        """Сброс журнала на диск"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def move(self, path):
+        """Переименование файла журнала (после замены снимка, к которому он относится)"""
+        self._file.close()
+        os.replace(self.path, path)
+        self.path = path
+        # Не 'ab': последняя запись может переписываться на месте (см. record)
+        self._file = open(path, 'r+b')
+        self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def discard(self):
+        """Закрытие и удаление журнала, снимок к которому так и не был записан"""
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class ProjectDocument:
+    """Документ проекта без окна редактора (пакетный экспорт).
+
+    Предоставляет команды истории тот же интерфейс, что и редактор, поэтому
+    журнал правок применяется к нему теми же командами.
+    """
+
+    def __init__(self, canvas_size, layers):
+        self.canvas_size = QSize(canvas_size)
+        self.layers = layers
+        self.canvas = self  # Команды меняют размер холста через editor.canvas
+
+    def set_canvas_size(self, size):
+        self.canvas_size = QSize(size)
+
+    def insert_layer(self, index, layer):
+        self.layers.insert(index, layer)
+
+    def remove_layer(self, index):
+        return self.layers.pop(index)
+
+    def move_layer(self, old_index, new_index):
+        self.layers.insert(new_index, self.layers.pop(old_index))
+
+    def layer_changed(self, index):
+        self.layers[index].touch()
+
+
+def load_project(file_path):
+    """Чтение проекта целиком: изображения извлекаются сразу, журнал правок применяется
+    до последнего сохранения.
+
+    Ресурсы добавляются в asset_store без удержания, их можно удалить
+    вызовом asset_store.purge() после работы с документом.
+    """
+    with ProjectReader(file_path) as reader:
+        document = ProjectDocument(reader.canvas_size, [])
+        for layer_data in reader.layers:
+            layer = Layer.from_dict(layer_data)
+            # Ресурс, уже извлеченный для другого слоя, не извлекается повторно
+            if layer.type == 'image' and layer.asset not in asset_store:
+                write = reader.image_source(layer_data)
+                if write is not None:
+                    layer.asset = asset_store.add_stream(write, f".{layer_data['image_format']}")
+            document.layers.append(layer)
+        token = reader.journal
+
+    if token is not None:
+        for path in (file_path + '.journal', file_path + '.journal.new'):
+            result = ProjectJournal.read(path, token)
+            if result is not None:
+                break
+        if result is not None:
+            assets = {layer.asset for layer in document.layers}
+            images = []
+            saved, _ = ProjectJournal.split_saved(result[0])
+            for _, command, _ in ProjectJournal.actions(path, saved, assets, images):
+                if command is not None:
+                    command.redo(document)
+            for asset, extension, source in images:
+                if asset not in asset_store:
+                    asset_store.add_stream(source, extension)
+    return document
+
+
+class LayerListModel(QAbstractListModel):
+    """Модель панели слоев поверх списка PostcardEditor.layers.
+
+    Подписи слоев вычисляются по запросу представления, поэтому строятся
+    только для видимых строк. Изменения списка сообщаются построчными
+    сигналами из методов редактора insert_layer, remove_layer и т.д.
+    """
+
+    def __init__(self, editor):
+        super().__init__(editor)
+        self.editor = editor
+
+    @staticmethod
+    def label(layer):
+        """Подпись слоя в панели"""
+        if layer.type == 'image':
+            return f"Изображение: {layer.name or os.path.basename(layer.path or '')}"
+        text = layer.text
+        return f"Текст: {text[:15] + '...' if len(text) > 15 else text}"
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.editor.layers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid() and index.row() < len(self.editor.layers):
+            return self.label(self.editor.layers[index.row()])
+        return None
+
+
+class HistoryListModel(QAbstractListModel):
+    """Модель панели истории поверх списка PostcardEditor.history"""
+
+    def __init__(self, editor):
+        super().__init__(editor)
+        self.editor = editor
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.editor.history)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid() and index.row() < len(self.editor.history):
+            return f"{index.row() + 1}. {self.editor.history[index.row()].label}"
+        return None
+
+    def rows_renumbered(self):
+        """Номера всех строк сдвинулись после удаления начала истории"""
+        if self.editor.history:
+            self.dataChanged.emit(self.index(0), self.index(len(self.editor.history) - 1), [Qt.DisplayRole])
+
+
+class RowListView(QListView):
+    """QListView с построчным выбором в стиле QListWidget"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setUniformItemSizes(True)
+
+    def currentRow(self):
+        index = self.currentIndex()
+        return index.row() if index.isValid() else -1
+
+    def setCurrentRow(self, row):
+        self.setCurrentIndex(self.model().index(row, 0))
+
 
 class Canvas(QWidget):
     """Класс холста для отображения и редактирования открытки"""
@@ -34,9 +1744,29 @@ class Canvas(QWidget):
         self.editing_text = None  # Индекс редактируемого текста
         self.text_edit_widget = None  # Виджет для редактирования текста
         self.setFocusPolicy(Qt.StrongFocus)
-        self.center_canvas()
         self.last_scale_factor = 1.0
         self.hovered_item = None  # Индекс подсвечиваемого элемента
+        self.transform_cache = None  # (область, слои ниже, слои выше) на время трансформации
+        self.geometry_cache = {}  # id слоя -> LayerGeometry
+        self.transform_start = None  # Рамка и угол слоя в начале перемещения/вращения
+        self.text_edit_start = None  # Текст и рамка слоя в начале редактирования
+
+        # Таймер перерисовки с частотой кадров экрана
+        self.pending_update_rect = QRect()
+        self.pending_full_update = False
+        self.frame_timer = QTimer()
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.timeout.connect(self.flush_scheduled_update)
+
+        # Виджет холста не зависит от масштаба: документ выводится со смещением
+        # view_offset (экранные координаты документа левого верхнего угла виджета)
+        self.canvas_size = QSize(0, 0)  # Размер открытки в пикселях
+        self.view_offset = QPoint()
+        self.h_scrollbar = QScrollBar(Qt.Horizontal)
+        self.v_scrollbar = QScrollBar(Qt.Vertical)
+        for scrollbar in (self.h_scrollbar, self.v_scrollbar):
+            scrollbar.setSingleStep(20)
+            scrollbar.valueChanged.connect(self.scroll_view)
 
         # Таймер для центрирования холста
         self.center_canvas_timer = QTimer()
@@ -53,51 +1783,9 @@ class Canvas(QWidget):
         self.text_edit.installEventFilter(self)
 
         # Загрузка пользовательских шрифтов
-        self.load_custom_fonts()
+        load_custom_fonts()
         self.resize_timer = QTimer()
 
-    def load_custom_fonts(self):
-        font_db = QFontDatabase()
-        font_files = [
-            "Monotype-Corsiva-Bold.ttf",
-            "Monotype-Corsiva-Bold-Italic.ttf",
-            "Monotype-Corsiva-Regular.ttf",
-            "Monotype-Corsiva-Regular-Italic.ttf"
-        ]
-
-        # Проверяем несколько возможных путей
-        search_paths = []
-
-        # 1. Путь в собранном приложении (onefile)
-        if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
-            search_paths.append(os.path.join(sys._MEIPASS, 'fonts/Monotype-Corsiva'))
-
-        # 2. Путь в собранном приложении (onedir)
-        search_paths.append(os.path.join(os.path.dirname(sys.executable), 'fonts/Monotype-Corsiva'))
-
-        # 3. Путь в режиме разработки
-        search_paths.append(os.path.join(os.path.dirname(__file__), 'fonts/Monotype-Corsiva'))
-
-        # 4. Системные пути
-        search_paths.extend([
-            '/usr/share/fonts/truetype/postcard-editor',
-            '/usr/local/share/fonts',
-            os.path.expanduser('~/.local/share/fonts')
-        ])
-
-        for font_file in font_files:
-            loaded = False
-            for path in search_paths:
-                font_path = os.path.join(path, font_file)
-                if os.path.exists(font_path):
-                    font_id = font_db.addApplicationFont(font_path)
-                    if font_id != -1:
-                        print(f"Successfully loaded font: {font_path}")
-                        loaded = True
-                        break
-            if not loaded:
-                print(f"Warning: Font not found: {font_file}")
-
     def eventFilter(self, obj, event):
         """Обработка событий для текстового редактора"""
         if obj == self.text_edit and event.type() == event.FocusOut:
@@ -119,314 +1807,388 @@ class Canvas(QWidget):
         text_height = doc.size().height()
 
         # Установка новых размеров
-        new_width = max(int(layer['rect'].width() * self.scale_factor), int(text_width) + 10)
-        new_height = max(int(layer['rect'].height() * self.scale_factor), int(text_height) + 10)
+        new_width = max(int(layer.rect.width() * self.scale_factor), int(text_width) + 10)
+        new_height = max(int(layer.rect.height() * self.scale_factor), int(text_height) + 10)
 
         # Обновление размеров редактора
         rect = QRect(
-            int(layer['rect'].x() * self.scale_factor),
-            int(layer['rect'].y() * self.scale_factor),
+            int(layer.rect.x() * self.scale_factor),
+            int(layer.rect.y() * self.scale_factor),
             new_width,
             new_height
         )
-        self.text_edit.setGeometry(rect)
+        self.text_edit.setGeometry(rect.translated(-self.view_offset))
 
         # Обновление размеров слоя
-        layer['rect'].setWidth(new_width / self.scale_factor)
-        layer['rect'].setHeight(new_height / self.scale_factor)
+        layer.rect.setWidth(int(new_width / self.scale_factor))
+        layer.rect.setHeight(int(new_height / self.scale_factor))
+        self.parent_editor.layer_changed(self.editing_text)
 
         self.update()
 
-    def fit_to_view(self):
-        """Подгонка холста под размер окна"""
-        if not hasattr(self, 'minimumWidth') or not hasattr(self, 'minimumHeight'):
-            return
+    def set_canvas_size(self, size):
+        """Изменение размера открытки (размер виджета не меняется)"""
+        self.canvas_size = QSize(size)
+        self.update_scrollbars()
+        self.update()
 
-        scroll_area = self.parent().findChild(QScrollArea)
-        if not scroll_area:
+    def scaled_canvas_size(self):
+        """Размер открытки на экране при текущем масштабе"""
+        return QSize(int(self.canvas_size.width() * self.scale_factor),
+                     int(self.canvas_size.height() * self.scale_factor))
+
+    def update_scrollbars(self):
+        """Пересчет диапазонов полос прокрутки под масштаб и размер окна"""
+        scaled = self.scaled_canvas_size()
+        for scrollbar, content, page in ((self.h_scrollbar, scaled.width(), self.width()),
+                                         (self.v_scrollbar, scaled.height(), self.height())):
+            scrollbar.blockSignals(True)
+            scrollbar.setRange(0, max(0, content - page))
+            scrollbar.setPageStep(page)
+            scrollbar.blockSignals(False)
+        self.scroll_view()
+
+    def scroll_view(self):
+        """Смещение вида по полосам прокрутки (открытка меньше окна выводится по центру)"""
+        scaled = self.scaled_canvas_size()
+        x = self.h_scrollbar.value() if scaled.width() > self.width() else -((self.width() - scaled.width()) // 2)
+        y = self.v_scrollbar.value() if scaled.height() > self.height() else -((self.height() - scaled.height()) // 2)
+        offset = QPoint(x, y)
+        if offset == self.view_offset:
             return
 
-        viewport_size = scroll_area.viewport().size()
-        if viewport_size.width() == 0 or viewport_size.height() == 0:
+        # Редактор текста - дочерний виджет и сдвигается вместе с документом
+        if self.editing_text is not None:
+            self.text_edit.move(self.text_edit.pos() + self.view_offset - offset)
+        self.view_offset = offset
+        self.update()
+
+    def scroll_to(self, x, y):
+        """Прокрутка так, чтобы точка документа (x, y) на экране оказалась в левом верхнем углу"""
+        self.h_scrollbar.setValue(int(x))
+        self.v_scrollbar.setValue(int(y))
+        self.scroll_view()
+
+    def document_pos(self, pos):
+        """Перевод точки виджета в экранные координаты документа"""
+        return pos + self.view_offset
+
+    def viewport_rect(self):
+        """Видимая в окне часть документа (в экранных координатах документа)"""
+        return QRect(self.view_offset, self.size())
+
+    def zoom_to(self, scale_factor, anchor=None):
+        """Изменение масштаба с сохранением точки документа под anchor (точка виджета)
+
+        Стоимость не зависит от масштаба: меняются только коэффициент и
+        смещение вида, геометрия слоев пересчитывается лениво при отрисовке.
+        """
+        if anchor is None:
+            anchor = QPoint(self.width() // 2, self.height() // 2)
+        scale_change = scale_factor / self.scale_factor
+        point = self.document_pos(anchor)
+
+        self.scale_factor = scale_factor
+        self.last_scale_factor = scale_factor
+        self.update_scrollbars()
+        self.scroll_to(point.x() * scale_change - anchor.x(), point.y() * scale_change - anchor.y())
+        if self.editing_text is not None:
+            self.text_edit.setGeometry(
+                self.layer_geometry(self.editing_text).screen_rect.translated(-self.view_offset))
+        self.update()
+
+    def fit_to_view(self):
+        """Подгонка холста под размер окна"""
+        if self.canvas_size.isEmpty() or self.width() == 0 or self.height() == 0:
             return
 
         # Расчет масштаба для полного отображения
-        width_scale = viewport_size.width() / self.minimumWidth()
-        height_scale = viewport_size.height() / self.minimumHeight()
-        self.scale_factor = min(width_scale, height_scale) * 0.9
-        self.scale_factor = max(0.1, min(5.0, self.scale_factor))
-
-        # Обновление размеров холста
-        self.resize(
-            int(self.minimumWidth() * self.scale_factor),
-            int(self.minimumHeight() * self.scale_factor)
-        )
+        width_scale = self.width() / self.canvas_size.width()
+        height_scale = self.height() / self.canvas_size.height()
+        self.zoom_to(max(0.1, min(5.0, min(width_scale, height_scale) * 0.9)))
 
         # Центрирование холста
         self.center_canvas()
-        self.update()
 
     def center_canvas(self):
         """Центрирование холста в области просмотра"""
-        scroll_area = self.parent().findChild(QScrollArea)
-        if not scroll_area:
-            return
+        scaled = self.scaled_canvas_size()
+        self.update_scrollbars()
+        self.scroll_to((scaled.width() - self.width()) / 2, (scaled.height() - self.height()) / 2)
 
-        QApplication.processEvents()
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.update_scrollbars()
+
+    def sync_layers(self):
+        """Реакция на изменение состава или порядка слоев"""
+        self.geometry_cache.clear()
+
+    def layer_geometry(self, i):
+        """Экранная геометрия слоя (пересчитывается только при изменении слоя или масштаба)"""
+        layer = self.parent_editor.layers[i]
+        key = LayerGeometry.make_key(layer, self.scale_factor)
+        geometry = self.geometry_cache.get(id(layer))
+        if geometry is None or geometry.key != key:
+            geometry = LayerGeometry(layer, self.scale_factor, key)
+            self.geometry_cache[id(layer)] = geometry
+        return geometry
+
+    def layer_screen_bounds(self, index, with_handles=True):
+        """Экранные границы слоя с учетом поворота, маркеров и выхода текста за рамку"""
+        return self.layer_geometry(index).bounds(with_handles)
+
+    def update_region(self, *rects):
+        """Перерисовка только объединения переданных прямоугольников"""
+        region = QRect()
+        for rect in rects:
+            if rect is not None:
+                region = region.united(rect)
+        if not region.isEmpty():
+            self.schedule_update(region)
+
+    def schedule_update(self, rect=None):
+        """Отложенная перерисовка, объединяющая все запросы до следующего кадра экрана"""
+        if rect is None:
+            self.pending_full_update = True
+        else:
+            self.pending_update_rect = self.pending_update_rect.united(rect)
 
-        viewport = scroll_area.viewport()
-        if viewport.width() == 0 or viewport.height() == 0:
-            return
+        if not self.frame_timer.isActive():
+            screen = self.screen()
+            refresh_rate = screen.refreshRate() if screen is not None else 0
+            self.frame_timer.start(int(1000 / refresh_rate) if refresh_rate > 0 else 16)
 
-        if not hasattr(self, 'minimumWidth') or not hasattr(self, 'minimumHeight'):
-            return
+    def flush_scheduled_update(self):
+        """Выполнение накопленной перерисовки"""
+        if self.pending_full_update:
+            self.update()
+        elif not self.pending_update_rect.isEmpty():
+            self.update(self.pending_update_rect.translated(-self.view_offset))
+        self.pending_full_update = False
+        self.pending_update_rect = QRect()
+
+    def paint_background(self, painter):
+        """Отрисовка фона и белого листа открытки"""
+        painter.fillRect(self.viewport_rect(), QColor("#808080"))
+        painter.fillRect(QRect(QPoint(0, 0), self.scaled_canvas_size()), Qt.white)
+
+    def draw_layers(self, painter, indices, clip_rect=None):
+        """Отрисовка слоев с указанными индексами (от нижнего к верхнему)"""
+        for i in indices:
+            layer = self.parent_editor.layers[i]
+            if not layer.visible or (self.editing_text is not None and
+                                        self.editing_text == i):
+                continue
 
-        # Расчет размеров с учетом масштаба
-        canvas_width = self.minimumWidth() * self.scale_factor
-        canvas_height = self.minimumHeight() * self.scale_factor
+            if clip_rect is not None and not self.layer_screen_bounds(i, with_handles=False).intersects(clip_rect):
+                continue
 
-        # Расчет центра viewport
-        viewport_center_x = viewport.width() / 2
-        viewport_center_y = viewport.height() / 2
+            self.draw_layer(painter, i, layer)
 
-        # Расчет центра холста
-        canvas_center_x = canvas_width / 2
-        canvas_center_y = canvas_height / 2
+    def draw_layer(self, painter, i, layer):
+        """Отрисовка одного слоя с учетом масштаба"""
+        geometry = self.layer_geometry(i)
+        local_rect = geometry.local_rect
 
-        # Установка новых размеров
-        self.resize(int(canvas_width), int(canvas_height))
+        painter.save()
+        painter.setTransform(geometry.transform, True)
+
+        # Подсветка при наведении (кроме текущего выделенного элемента)
+        if i == self.hovered_item and i != self.current_item:
+            painter.setPen(QPen(QColor(100, 150, 255, 150), 3, Qt.SolidLine))
+            painter.setBrush(Qt.NoBrush)
+            painter.drawRect(local_rect)
+
+        if layer.type == 'image':
+            # Декодированное и отмасштабированное изображение берется из кэша
+            if layer.path is None:
+                self.draw_placeholder(painter, QRectF(local_rect))
+            else:
+                pixmap = image_cache.get_pixmap(layer.path, local_rect.size())
+                if not pixmap.isNull():
+                    painter.drawPixmap(local_rect, pixmap)
+
+        elif layer.type == 'text':
+            # Масштабируем размер шрифта
+            scaled_font_size = max(4, int(layer.font_size * self.scale_factor))
+            font = QFont(layer.font, scaled_font_size)
+            painter.setFont(font)
+            painter.setPen(QColor(layer.color))
+            painter.drawText(local_rect, layer.alignment, layer.text)
+
+        painter.restore()
+
+    @staticmethod
+    def draw_placeholder(painter, rect):
+        """Заглушка изображения, которое еще загружается"""
+        painter.fillRect(rect, QColor(225, 225, 225))
+        painter.setPen(QPen(QColor(150, 150, 150), 1, Qt.DashLine))
+        painter.setBrush(Qt.NoBrush)
+        painter.drawRect(rect)
+
+    def begin_transform_cache(self):
+        """Слияние неподвижных слоев в два растра на время перетаскивания/вращения
+
+        Слои под текущим элементом (вместе с фоном) и над ним не меняются во
+        время жеста, поэтому каждый кадр рисуются только эти растры и сам
+        изменяемый слой. Кэшируется только видимая часть холста.
+        """
+        self.transform_cache = None
+        if self.current_item is None:
+            return
+
+        rect = self.viewport_rect()
+        if rect.isEmpty():
+            return
 
-        # Прокрутка к центру
-        h_scroll = int(canvas_center_x - viewport_center_x)
-        v_scroll = int(canvas_center_y - viewport_center_y)
+        count = len(self.parent_editor.layers)
+        below = self._render_cache_pixmap(rect, reversed(range(self.current_item + 1, count)), True)
+        above = self._render_cache_pixmap(rect, reversed(range(self.current_item)), False)
+        self.transform_cache = (rect, below, above)
 
-        scroll_area.horizontalScrollBar().setValue(h_scroll)
-        scroll_area.verticalScrollBar().setValue(v_scroll)
+    def _render_cache_pixmap(self, rect, indices, with_background):
+        ratio = self.devicePixelRatioF()
+        pixmap = QPixmap(rect.size() * ratio)
+        pixmap.setDevicePixelRatio(ratio)
+        pixmap.fill(Qt.transparent)
+
+        painter = QPainter(pixmap)
+        painter.translate(-rect.topLeft())
+        if with_background:
+            self.paint_background(painter)
+        self.draw_layers(painter, indices, rect)
+        painter.end()
+        return pixmap
+
+    def end_transform_cache(self):
+        self.transform_cache = None
 
     def paintEvent(self, event):
         painter = QPainter(self)
-        painter.fillRect(self.rect(), QColor("#808080"))
 
-        if hasattr(self, 'minimumWidth') and hasattr(self, 'minimumHeight'):
-            canvas_rect = QRect(0, 0, self.minimumWidth(), self.minimumHeight())
-            scaled_rect = QRect(0, 0, int(self.minimumWidth() * self.scale_factor),
-                                int(self.minimumHeight() * self.scale_factor))
-            painter.fillRect(scaled_rect, Qt.white)
+        # Дальше все рисуется в экранных координатах документа
+        painter.translate(-self.view_offset)
+        dirty_rect = event.rect().translated(self.view_offset)
+
+        # Во время трансформации неподвижные слои берутся из кэша
+        if (self.transform_cache is not None and self.current_item is not None
+                and self.transform_cache[0].contains(dirty_rect)):
+            cache_rect, below, above = self.transform_cache
+            painter.drawPixmap(cache_rect.topLeft(), below)
+            self.draw_layers(painter, [self.current_item])
+            painter.drawPixmap(cache_rect.topLeft(), above)
+            self.draw_selection(painter)
+            return
+
+        # Рисуется только видимая в окне часть измененной области
+        visible_rect = dirty_rect.intersected(self.viewport_rect())
+        if visible_rect.isEmpty():
+            return
+        painter.setClipRect(visible_rect)
+
+        self.paint_background(painter)
 
         if not self.parent_editor.layers:
             return
 
-        # Отрисовка слоев с учетом масштаба
-        for i in reversed(range(len(self.parent_editor.layers))):
-            layer = self.parent_editor.layers[i]
-            if not layer['visible'] or (self.editing_text is not None and
-                                        self.editing_text == i):
-                continue
+        # Слои вне видимой области пропускаются до загрузки и масштабирования изображений
+        self.draw_layers(painter, self.layers_in_screen_rect(visible_rect), visible_rect)
 
-            scaled_rect = QRect(
-                int(layer['rect'].x() * self.scale_factor),
-                int(layer['rect'].y() * self.scale_factor),
-                int(layer['rect'].width() * self.scale_factor),
-                int(layer['rect'].height() * self.scale_factor)
-            )
-
-            # Подсветка при наведении (кроме текущего выделенного элемента)
-            if i == self.hovered_item and i != self.current_item:
-                painter.setPen(QPen(QColor(100, 150, 255, 150), 3, Qt.SolidLine))
-                painter.setBrush(Qt.NoBrush)
-                painter.drawRect(scaled_rect)
-
-            if layer['type'] == 'image':
-                pixmap = QPixmap(layer['path'])
-                if layer['rotation'] != 0:
-                    transform = QTransform()
-                    transform.translate(scaled_rect.center().x(), scaled_rect.center().y())
-                    transform.rotate(layer['rotation'])
-                    transform.translate(-scaled_rect.width() / 2, -scaled_rect.height() / 2)
-                    painter.setTransform(transform)
-                    painter.drawPixmap(QRect(0, 0, scaled_rect.width(), scaled_rect.height()),
-                                       pixmap.scaled(scaled_rect.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
-                    painter.resetTransform()
-                else:
-                    painter.drawPixmap(scaled_rect,
-                                       pixmap.scaled(scaled_rect.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
-
-            elif layer['type'] == 'text':
-                # Масштабируем размер шрифта
-                scaled_font_size = max(4, int(layer['font_size'] * self.scale_factor))
-                font = QFont(layer['font'], scaled_font_size)
-                painter.setFont(font)
-                painter.setPen(QColor(layer['color']))
-
-                if layer['rotation'] != 0:
-                    painter.save()
-                    painter.translate(scaled_rect.center())
-                    painter.rotate(layer['rotation'])
-                    painter.translate(-scaled_rect.width() / 2, -scaled_rect.height() / 2)
-                    painter.drawText(QRect(0, 0, scaled_rect.width(), scaled_rect.height()),
-                                     layer['alignment'], layer['text'])
-                    painter.restore()
-                else:
-                    painter.drawText(scaled_rect, layer['alignment'], layer['text'])
+        self.draw_selection(painter)
 
-        # Отрисовка выделения (без изменений)
-        if self.current_item is not None and self.editing_text is None:
-            layer = self.parent_editor.layers[self.current_item]
-            scaled_rect = QRect(
-                int(layer['rect'].x() * self.scale_factor),
-                int(layer['rect'].y() * self.scale_factor),
-                int(layer['rect'].width() * self.scale_factor),
-                int(layer['rect'].height() * self.scale_factor)
-            )
-
-            if layer['rotation'] != 0:
-                painter.save()
-                painter.translate(scaled_rect.center())
-                painter.rotate(layer['rotation'])
-                painter.translate(-scaled_rect.width() / 2, -scaled_rect.height() / 2)
-
-                painter.setPen(QPen(Qt.blue, 2, Qt.DashLine))
-                painter.drawRect(QRect(0, 0, scaled_rect.width(), scaled_rect.height()))
-
-                painter.setPen(QPen(Qt.black, 2))
-                painter.setBrush(Qt.white)
-                size = 8
-                handles = [
-                    QRect(0 - size // 2, 0 - size // 2, size, size),
-                    QRect(scaled_rect.width() - size // 2, 0 - size // 2, size, size),
-                    QRect(0 - size // 2, scaled_rect.height() - size // 2, size, size),
-                    QRect(scaled_rect.width() - size // 2, scaled_rect.height() - size // 2, size, size),
-                    QRect(scaled_rect.width() // 2 - size // 2, 0 - size // 2, size, size),
-                    QRect(scaled_rect.width() // 2 - size // 2, scaled_rect.height() - size // 2, size, size),
-                    QRect(0 - size // 2, scaled_rect.height() // 2 - size // 2, size, size),
-                    QRect(scaled_rect.width() - size // 2, scaled_rect.height() // 2 - size // 2, size, size)
-                ]
-                for handle in handles:
-                    painter.drawRect(handle)
-
-                rotation_handle = QRect(scaled_rect.width() // 2 - size // 2, -30, size, size)
-                painter.drawRect(rotation_handle)
-                painter.drawLine(scaled_rect.width() // 2, 0, scaled_rect.width() // 2, -25)
-
-                painter.restore()
-            else:
-                painter.setPen(QPen(Qt.blue, 2, Qt.DashLine))
-                painter.drawRect(scaled_rect)
-
-                painter.setPen(QPen(Qt.black, 2))
-                painter.setBrush(Qt.white)
-                size = 8
-                handles = [
-                    QRect(scaled_rect.left() - size // 2, scaled_rect.top() - size // 2, size, size),
-                    QRect(scaled_rect.right() - size // 2, scaled_rect.top() - size // 2, size, size),
-                    QRect(scaled_rect.left() - size // 2, scaled_rect.bottom() - size // 2, size, size),
-                    QRect(scaled_rect.right() - size // 2, scaled_rect.bottom() - size // 2, size, size),
-                    QRect(scaled_rect.center().x() - size // 2, scaled_rect.top() - size // 2, size, size),
-                    QRect(scaled_rect.center().x() - size // 2, scaled_rect.bottom() - size // 2, size, size),
-                    QRect(scaled_rect.left() - size // 2, scaled_rect.center().y() - size // 2, size, size),
-                    QRect(scaled_rect.right() - size // 2, scaled_rect.center().y() - size // 2, size, size)
-                ]
-                for handle in handles:
-                    painter.drawRect(handle)
-
-                rotation_handle = QRect(scaled_rect.center().x() - size // 2, scaled_rect.top() - 30, size, size)
-                painter.drawRect(rotation_handle)
-                painter.drawLine(scaled_rect.center().x(), scaled_rect.top(),
-                                 scaled_rect.center().x(), scaled_rect.top() - 25)
+    def draw_selection(self, painter):
+        """Отрисовка рамки выделения и маркеров текущего элемента"""
+        if self.current_item is None or self.editing_text is not None:
+            return
+
+        geometry = self.layer_geometry(self.current_item)
+        width = geometry.local_rect.width()
+
+        painter.save()
+        painter.setTransform(geometry.transform, True)
+
+        painter.setPen(QPen(Qt.blue, 2, Qt.DashLine))
+        painter.setBrush(Qt.NoBrush)
+        painter.drawRect(geometry.local_rect)
+
+        painter.setPen(QPen(Qt.black, 2))
+        painter.setBrush(Qt.white)
+        for handle in geometry.handles.values():
+            painter.drawRect(handle)
+
+        painter.drawRect(geometry.rotation_handle)
+        painter.drawLine(width // 2, 0, width // 2, -25)
+
+        painter.restore()
+
+    def layer_contains(self, i, pos):
+        """Проверка попадания экранной точки в слой с учетом поворота"""
+        return self.layer_geometry(i).contains(pos)
+
+    def layer_at(self, pos):
+        """Индекс верхнего видимого слоя под экранной точкой или None"""
+        # Запас в несколько экранных пикселей покрывает округление масштабированных рамок,
+        # центра поворота и целочисленных координат курсора; точная проверка - ниже
+        tolerance = 4 / self.scale_factor + 1
+        candidates = self.parent_editor.layer_store.rows_at_point(
+            pos.x() / self.scale_factor, pos.y() / self.scale_factor, tolerance)
+        for i in candidates:
+            if self.layer_contains(int(i), pos):
+                return int(i)
+        return None
+
+    def layers_in_screen_rect(self, rect):
+        """Индексы слоев, которые могут попасть в экранный прямоугольник, снизу вверх"""
+        scale = self.scale_factor
+        margin = (LayerGeometry.HANDLE_MARGIN + 2) / scale
+        scene_rect = QRectF(rect.x() / scale, rect.y() / scale,
+                            rect.width() / scale, rect.height() / scale).adjusted(-margin, -margin, margin, margin)
+        # Текст обрезается по рамке слоя, поэтому для всех слоев достаточно границ рамок
+        rows = self.parent_editor.layer_store.rows_in_rect(scene_rect)
+        return [int(i) for i in rows[::-1]]
 
     def mousePressEvent(self, event):
         """Обработка нажатия кнопки мыши"""
+        pos = self.document_pos(event.pos())
         if event.button() == Qt.LeftButton:
             self.hovered_item = None
-            self.start_pos = event.pos()
+            self.start_pos = pos
 
             if self.current_item is not None and self.editing_text is None:
+                geometry = self.layer_geometry(self.current_item)
+                handle = geometry.handle_at(pos)
+
+                # Состояние слоя до начала трансформации (для истории)
                 layer = self.parent_editor.layers[self.current_item]
-                scaled_rect = QRect(
-                    int(layer['rect'].x() * self.scale_factor),
-                    int(layer['rect'].y() * self.scale_factor),
-                    int(layer['rect'].width() * self.scale_factor),
-                    int(layer['rect'].height() * self.scale_factor)
-                )
+                self.transform_start = {'rect': QRect(layer.rect), 'rotation': layer.rotation}
 
                 # Проверка нажатия на маркер вращения
-                if layer['rotation'] != 0:
-                    transform = QTransform()
-                    transform.translate(scaled_rect.center().x(), scaled_rect.center().y())
-                    transform.rotate(layer['rotation'])
-                    transform.translate(-scaled_rect.width() / 2, -scaled_rect.height() / 2)
-                    rotation_handle = QRect(scaled_rect.width() // 2 - 4, -30, 8, 8)
-                    global_handle = transform.mapRect(rotation_handle)
-
-                    if global_handle.contains(event.pos()):
-                        self.rotating = True
-                        self.transform_origin = scaled_rect.center()
-                        return
-                else:
-                    rotation_handle = QRect(scaled_rect.center().x() - 4, scaled_rect.top() - 30, 8, 8)
-                    if rotation_handle.contains(event.pos()):
-                        self.rotating = True
-                        self.transform_origin = scaled_rect.center()
-                        return
+                if handle == 'rotation':
+                    self.rotating = True
+                    self.transform_origin = geometry.screen_rect.center()
+                    self.begin_transform_cache()
+                    return
 
                 # Проверка нажатия на маркеры изменения размера
-                size = 8
-                handles = {
-                    'top-left': QRect(scaled_rect.left() - size // 2, scaled_rect.top() - size // 2, size, size),
-                    'top-right': QRect(scaled_rect.right() - size // 2, scaled_rect.top() - size // 2, size, size),
-                    'bottom-left': QRect(scaled_rect.left() - size // 2, scaled_rect.bottom() - size // 2, size, size),
-                    'bottom-right': QRect(scaled_rect.right() - size // 2, scaled_rect.bottom() - size // 2, size,
-                                          size),
-                    'top-center': QRect(scaled_rect.center().x() - size // 2, scaled_rect.top() - size // 2, size,
-                                        size),
-                    'bottom-center': QRect(scaled_rect.center().x() - size // 2, scaled_rect.bottom() - size // 2, size,
-                                           size),
-                    'left-center': QRect(scaled_rect.left() - size // 2, scaled_rect.center().y() - size // 2, size,
-                                         size),
-                    'right-center': QRect(scaled_rect.right() - size // 2, scaled_rect.center().y() - size // 2, size,
-                                          size)
-                }
-
-                for handle_name, handle_rect in handles.items():
-                    if handle_rect.contains(event.pos()):
-                        self.resizing = handle_name
-                        return
+                if handle is not None:
+                    self.resizing = handle
+                    self.begin_transform_cache()
+                    return
 
                 # Проверка нажатия внутри объекта (начало перемещения)
-                if scaled_rect.contains(event.pos()):
+                if geometry.contains(pos):
                     self.dragging = True
+                    self.begin_transform_cache()
                     return
 
-            # Проверка нажатия на любой слой (выбор) - теперь проверяем от верхнего к нижнему
-            for i in range(len(self.parent_editor.layers)):
-                layer = self.parent_editor.layers[i]
-                if not layer['visible']:
-                    continue
-
-                scaled_rect = QRect(
-                    int(layer['rect'].x() * self.scale_factor),
-                    int(layer['rect'].y() * self.scale_factor),
-                    int(layer['rect'].width() * self.scale_factor),
-                    int(layer['rect'].height() * self.scale_factor)
-                )
-
-                if layer['rotation'] != 0:
-                    transform = QTransform()
-                    transform.translate(scaled_rect.center().x(), scaled_rect.center().y())
-                    transform.rotate(layer['rotation'])
-                    transform.translate(-scaled_rect.width() / 2, -scaled_rect.height() / 2)
-                    inverted_transform = transform.inverted()[0]
-                    local_pos = inverted_transform.map(event.pos())
-                    if QRect(0, 0, scaled_rect.width(), scaled_rect.height()).contains(local_pos):
-                        self.current_item = i
-                        self.parent_editor.layer_list.setCurrentRow(i)
-                        self.update()
-                        return
-                elif scaled_rect.contains(event.pos()):
-                    self.current_item = i
-                    self.parent_editor.layer_list.setCurrentRow(i)
-                    self.update()
-                    return
+            # Проверка нажатия на любой слой (выбор) - от верхнего к нижнему по пространственному индексу
+            i = self.layer_at(pos)
+            if i is not None:
+                self.current_item = i
+                self.parent_editor.layer_list.setCurrentRow(i)
+                self.update()
+                return
 
             # Снятие выделения при нажатии на пустую область
             self.current_item = None
@@ -439,11 +2201,12 @@ class Canvas(QWidget):
     def start_text_edit(self, layer):
         """Начало редактирования текста"""
         self.editing_text = self.parent_editor.layers.index(layer)
+        self.text_edit_start = {'text': layer.text, 'rect': QRect(layer.rect)}
 
         # Установка текста и шрифта
-        self.text_edit.setPlainText(layer['text'])
-        self.text_edit.setFont(QFont(layer['font'], layer['font_size']))
-        self.text_edit.setAlignment(layer['alignment'])
+        self.text_edit.setPlainText(layer.text)
+        self.text_edit.setFont(QFont(layer.font, layer.font_size))
+        self.text_edit.setAlignment(layer.alignment)
 
         # Отключение автоматического переноса строк
         self.text_edit.setLineWrapMode(QTextEdit.NoWrap)
@@ -457,18 +2220,12 @@ class Canvas(QWidget):
         self.text_edit.setStyleSheet(f"""
             background-color: white; 
             border: 2px solid blue;
-            color: {layer['color']};
+            color: {layer.color};
             padding: 2px;
         """)
 
         # Позиционирование редактора
-        rect = QRect(
-            int(layer['rect'].x() * self.scale_factor),
-            int(layer['rect'].y() * self.scale_factor),
-            int(layer['rect'].width() * self.scale_factor),
-            int(layer['rect'].height() * self.scale_factor)
-        )
-        self.text_edit.setGeometry(rect)
+        self.text_edit.setGeometry(self.layer_geometry(self.editing_text).screen_rect.translated(-self.view_offset))
         self.text_edit.setVisible(True)
         self.text_edit.setFocus()
 
@@ -482,40 +2239,35 @@ class Canvas(QWidget):
         """Завершение редактирования текста"""
         if self.editing_text is not None:
             layer = self.parent_editor.layers[self.editing_text]
-            layer['text'] = self.text_edit.toPlainText()
+            layer.text = self.text_edit.toPlainText()
 
             # Фиксация окончательных размеров
             doc = self.text_edit.document()
             doc.adjustSize()
-            layer['rect'].setWidth(doc.idealWidth() / self.scale_factor + 10 / self.scale_factor)
-            layer['rect'].setHeight(doc.size().height() / self.scale_factor + 10 / self.scale_factor)
-
-            # Обновление списка слоев
-            text = layer['text']
-            self.parent_editor.layer_list.item(self.editing_text).setText(
-                f"Текст: {text[:15] + '...' if len(text) > 15 else text}")
+            layer.rect.setWidth(int(doc.idealWidth() / self.scale_factor + 10 / self.scale_factor))
+            layer.rect.setHeight(int(doc.size().height() / self.scale_factor + 10 / self.scale_factor))
+            self.parent_editor.layer_changed(self.editing_text)
 
             # Скрытие редактора
             self.text_edit.setVisible(False)
+            index = self.editing_text
             self.editing_text = None
 
             # Добавление в историю
-            self.parent_editor.add_to_history()
+            after = {'text': layer.text, 'rect': QRect(layer.rect)}
+            if self.text_edit_start is not None and after != self.text_edit_start:
+                self.parent_editor.add_to_history(
+                    ChangeLayerCommand("Редактирование текста", index, self.text_edit_start, after))
+            self.text_edit_start = None
             self.update()
 
     def mouseDoubleClickEvent(self, event):
         """Обработка двойного клика мыши"""
+        pos = self.document_pos(event.pos())
         if event.button() == Qt.LeftButton and self.current_item is not None:
             layer = self.parent_editor.layers[self.current_item]
-            if layer['type'] == 'text':
-                rect = QRect(
-                    int(layer['rect'].x() * self.scale_factor),
-                    int(layer['rect'].y() * self.scale_factor),
-                    int(layer['rect'].width() * self.scale_factor),
-                    int(layer['rect'].height() * self.scale_factor)
-                )
-                if rect.contains(event.pos()):
-                    self.start_text_edit(layer)
+            if layer.type == 'text' and self.layer_geometry(self.current_item).contains(pos):
+                self.start_text_edit(layer)
 
     def keyPressEvent(self, event):
         """Обработка нажатия клавиш"""
@@ -523,28 +2275,29 @@ class Canvas(QWidget):
             layer = self.parent_editor.layers[self.current_item]
             step = 5 / self.scale_factor
 
-            if event.key() == Qt.Key_Left:
-                layer['rect'].moveLeft(layer['rect'].left() - step)
-                self.parent_editor.add_to_history()
-                self.update()
-            elif event.key() == Qt.Key_Right:
-                layer['rect'].moveLeft(layer['rect'].left() + step)
-                self.parent_editor.add_to_history()
-                self.update()
-            elif event.key() == Qt.Key_Up:
-                layer['rect'].moveTop(layer['rect'].top() - step)
-                self.parent_editor.add_to_history()
-                self.update()
-            elif event.key() == Qt.Key_Down:
-                layer['rect'].moveTop(layer['rect'].top() + step)
-                self.parent_editor.add_to_history()
-                self.update()
+            if event.key() in (Qt.Key_Left, Qt.Key_Right, Qt.Key_Up, Qt.Key_Down):
+                # Автоповтор стрелок сливается в одну запись истории
+                old_bounds = self.layer_screen_bounds(self.current_item)
+                before = QRect(layer.rect)
+                if event.key() == Qt.Key_Left:
+                    layer.rect.moveLeft(int(layer.rect.left() - step))
+                elif event.key() == Qt.Key_Right:
+                    layer.rect.moveLeft(int(layer.rect.left() + step))
+                elif event.key() == Qt.Key_Up:
+                    layer.rect.moveTop(int(layer.rect.top() - step))
+                else:
+                    layer.rect.moveTop(int(layer.rect.top() + step))
+                self.parent_editor.layer_changed(self.current_item)
+                self.parent_editor.add_to_history(ChangeLayerCommand(
+                    "Перемещение", self.current_item, {'rect': before}, {'rect': QRect(layer.rect)},
+                    merge_kind='nudge'))
+                self.update_region(old_bounds, self.layer_screen_bounds(self.current_item))
             elif event.key() == Qt.Key_Delete:
                 # Проверяем, что слой существует
                 if 0 <= self.current_item < len(self.parent_editor.layers):
                     self.parent_editor.delete_layer()
             elif event.key() == Qt.Key_F:
-                if layer['type'] == 'text':
+                if layer.type == 'text':
                     self.start_text_edit(layer)
         elif event.key() == Qt.Key_Escape:
             if self.editing_text is not None:
@@ -554,7 +2307,8 @@ class Canvas(QWidget):
 
     def mouseMoveEvent(self, event):
         """Обработка перемещения мыши"""
-        self.cursor_pos = event.pos()
+        pos = self.document_pos(event.pos())
+        self.cursor_pos = pos
 
         # Сброс подсвечивания перед проверкой
         old_hovered = self.hovered_item
@@ -562,61 +2316,36 @@ class Canvas(QWidget):
 
         # Проверка наведения на объекты (только если не выполняются другие операции)
         if not (self.dragging or self.resizing or self.rotating):
-            # Идем от верхнего слоя (первого в списке) к нижнему (последнему)
-            for i in range(len(self.parent_editor.layers)):
-                layer = self.parent_editor.layers[i]
-                if not layer['visible']:
-                    continue
-
-                scaled_rect = QRect(
-                    int(layer['rect'].x() * self.scale_factor),
-                    int(layer['rect'].y() * self.scale_factor),
-                    int(layer['rect'].width() * self.scale_factor),
-                    int(layer['rect'].height() * self.scale_factor)
-                )
-
-                if layer['rotation'] != 0:
-                    # Для повернутых объектов используем более точную проверку
-                    transform = QTransform()
-                    transform.translate(scaled_rect.center().x(), scaled_rect.center().y())
-                    transform.rotate(layer['rotation'])
-                    transform.translate(-scaled_rect.width() / 2, -scaled_rect.height() / 2)
-                    inverted_transform = transform.inverted()[0]
-                    local_pos = inverted_transform.map(event.pos())
-                    if QRect(0, 0, scaled_rect.width(), scaled_rect.height()).contains(local_pos):
-                        self.hovered_item = i
-                        break
-                elif scaled_rect.contains(event.pos()):
-                    self.hovered_item = i
-                    break  # Прерываем цикл после нахождения первого подходящего слоя
+            # Кандидаты под курсором отбираются по столбцам геометрии слоев, от верхнего к нижнему
+            self.hovered_item = self.layer_at(pos)
 
         # Обновление только если состояние подсветки изменилось
         if old_hovered != self.hovered_item:
-            self.update()
+            self.update_region(*(self.layer_screen_bounds(i, with_handles=False)
+                                 for i in (old_hovered, self.hovered_item)
+                                 if i is not None and i < len(self.parent_editor.layers)))
+
+        # Границы изменяемого слоя до трансформации
+        if (self.rotating or self.resizing or self.dragging) and self.current_item is not None:
+            old_bounds = self.layer_screen_bounds(self.current_item)
 
         # Вращение объекта
         if self.rotating and self.current_item is not None:
             layer = self.parent_editor.layers[self.current_item]
-            scaled_rect = QRect(
-                int(layer['rect'].x() * self.scale_factor),
-                int(layer['rect'].y() * self.scale_factor),
-                int(layer['rect'].width() * self.scale_factor),
-                int(layer['rect'].height() * self.scale_factor)
-            )
-            center = scaled_rect.center()
+            center = self.layer_geometry(self.current_item).screen_rect.center()
 
             # Расчет угла между центром и позицией мыши
-            angle = np.arctan2(event.pos().y() - center.y(), event.pos().x() - center.x()) * 180 / np.pi
-            layer['rotation'] = (angle + 90) % 360  # +90 для начала сверху
+            angle = np.arctan2(pos.y() - center.y(), pos.x() - center.x()) * 180 / np.pi
+            layer.rotation = (angle + 90) % 360  # +90 для начала сверху
+            self.parent_editor.layer_changed(self.current_item)
 
-            self.update()
+            self.update_region(old_bounds, self.layer_screen_bounds(self.current_item))
             return
 
         # Изменение размера объекта
         if self.resizing and self.current_item is not None:
             layer = self.parent_editor.layers[self.current_item]
-            rect = layer['rect']
-            pos = event.pos()
+            rect = layer.rect
             delta = (pos - self.start_pos) / self.scale_factor
 
             new_rect = QRect(rect)
@@ -669,66 +2398,36 @@ class Canvas(QWidget):
                 else:
                     new_rect.setBottom(new_rect.top() + 20)
 
-            layer['rect'] = new_rect
-            self.start_pos = event.pos()
-            self.update()
+            layer.rect = new_rect
+            self.parent_editor.layer_changed(self.current_item)
+            self.start_pos = pos
+            self.update_region(old_bounds, self.layer_screen_bounds(self.current_item))
             return
 
         # Перемещение объекта
         if self.dragging and self.current_item is not None:
             layer = self.parent_editor.layers[self.current_item]
-            rect = layer['rect']
-            delta = (event.pos() - self.start_pos) / self.scale_factor
+            rect = layer.rect
+            delta = (pos - self.start_pos) / self.scale_factor
             new_rect = rect.translated(int(delta.x()), int(delta.y()))
-            layer['rect'] = new_rect
-            self.start_pos = event.pos()
-            self.update()
+            layer.rect = new_rect
+            self.parent_editor.layer_changed(self.current_item)
+            self.start_pos = pos
+            self.update_region(old_bounds, self.layer_screen_bounds(self.current_item))
             return
 
         # Изменение формы курсора
         if self.current_item is not None and self.editing_text is None:
-            layer = self.parent_editor.layers[self.current_item]
-            rect = QRect(
-                int(layer['rect'].x() * self.scale_factor),
-                int(layer['rect'].y() * self.scale_factor),
-                int(layer['rect'].width() * self.scale_factor),
-                int(layer['rect'].height() * self.scale_factor)
-            )
-
-            # Проверка на маркер вращения
-            rotation_handle = QRect(rect.center().x() - 4, rect.top() - 30, 8, 8)
-            if rotation_handle.contains(event.pos()):
-                self.setCursor(Qt.PointingHandCursor)
-                return
+            geometry = self.layer_geometry(self.current_item)
 
-            # Проверка на маркеры изменения размера
-            size = 8
-            handles = [
-                QRect(rect.left() - size // 2, rect.top() - size // 2, size, size),  # Верхний-левый
-                QRect(rect.right() - size // 2, rect.top() - size // 2, size, size),  # Верхний-правый
-                QRect(rect.left() - size // 2, rect.bottom() - size // 2, size, size),  # Нижний-левый
-                QRect(rect.right() - size // 2, rect.bottom() - size // 2, size, size),  # Нижний-правый
-                QRect(rect.center().x() - size // 2, rect.top() - size // 2, size, size),  # Верхний-центральный
-                QRect(rect.center().x() - size // 2, rect.bottom() - size // 2, size, size),  # Нижний-центральный
-                QRect(rect.left() - size // 2, rect.center().y() - size // 2, size, size),  # Левый-центральный
-                QRect(rect.right() - size // 2, rect.center().y() - size // 2, size, size)  # Правый-центральный
-            ]
-
-            for handle in handles:
-                if handle.contains(event.pos()):
-                    # Определение формы курсора
-                    if handle == handles[0] or handle == handles[3]:  # Верхний-левый или нижний-правый
-                        self.setCursor(Qt.SizeFDiagCursor)
-                    elif handle == handles[1] or handle == handles[2]:  # Верхний-правый или нижний-левый
-                        self.setCursor(Qt.SizeBDiagCursor)
-                    elif handle == handles[4] or handle == handles[5]:  # Верхний-центральный или нижний-центральный
-                        self.setCursor(Qt.SizeVerCursor)
-                    else:  # Левый-центральный или правый-центральный
-                        self.setCursor(Qt.SizeHorCursor)
-                    return
+            # Проверка на маркеры вращения и изменения размера
+            handle = geometry.handle_at(pos)
+            if handle is not None:
+                self.setCursor(LayerGeometry.HANDLE_CURSORS[handle])
+                return
 
             # Курсор перемещения внутри объекта
-            if rect.contains(event.pos()):
+            if geometry.contains(pos):
                 self.setCursor(Qt.SizeAllCursor)
                 return
 
@@ -738,24 +2437,31 @@ class Canvas(QWidget):
     def mouseReleaseEvent(self, event):
         """Обработка отпускания кнопки мыши"""
         if event.button() == Qt.LeftButton:
-            if self.dragging or self.resizing or self.rotating:
-                self.parent_editor.add_to_history()
+            if (self.dragging or self.resizing or self.rotating) and self.current_item is not None:
+                layer = self.parent_editor.layers[self.current_item]
+                after = {'rect': QRect(layer.rect), 'rotation': layer.rotation}
+                if self.transform_start is not None and after != self.transform_start:
+                    if self.rotating:
+                        label = "Поворот"
+                    elif self.resizing:
+                        label = "Изменение размера"
+                    else:
+                        label = "Перемещение"
+                    self.parent_editor.add_to_history(
+                        ChangeLayerCommand(label, self.current_item, self.transform_start, after))
+            self.transform_start = None
 
             self.dragging = None
             self.resizing = None
             self.rotating = None
 
+            self.end_transform_cache()
+
     def wheelEvent(self, event):
-        """Обработка прокрутки колеса мыши с сохранением позиции объектов"""
+        """Масштабирование колесом с Ctrl относительно курсора, без Ctrl - прокрутка"""
         if event.modifiers() & Qt.ControlModifier:
             event.accept()
 
-            # Получаем scroll area
-            scroll_area = self.parent().findChild(QScrollArea)
-
-            # Запоминаем текущую позицию курсора относительно холста
-            mouse_pos = event.pos()
-
             # Определяем направление и силу масштабирования
             zoom_direction = 1 if event.angleDelta().y() > 0 else -1
             zoom_factor = 1.1 ** zoom_direction
@@ -764,38 +2470,232 @@ class Canvas(QWidget):
             new_scale = self.scale_factor * zoom_factor
             new_scale = max(0.1, min(5.0, new_scale))
 
-            # Вычисляем коэффициент изменения масштаба
-            scale_change = new_scale / self.scale_factor
+            # Точка документа под курсором остается на месте
+            self.zoom_to(new_scale, event.pos())
+        else:
+            event.accept()
+            delta = event.angleDelta()
+            if event.modifiers() & Qt.ShiftModifier:
+                delta = QPoint(delta.y(), delta.x())
 
-            # Обновляем масштаб
-            self.scale_factor = new_scale
+            # Как в QScrollArea: три шага полосы прокрутки на щелчок колеса
+            steps = self.h_scrollbar.singleStep() * 3 / 120
+            self.scroll_to(self.h_scrollbar.value() - delta.x() * steps,
+                           self.v_scrollbar.value() - delta.y() * steps)
 
-            # Обновляем размер холста
-            new_width = int(self.minimumWidth() * self.scale_factor)
-            new_height = int(self.minimumHeight() * self.scale_factor)
-            self.resize(new_width, new_height)
 
-            # Корректируем позицию прокрутки, если scroll area найден
-            if scroll_area:
-                # Вычисляем новые позиции прокрутки
-                h_scroll = scroll_area.horizontalScrollBar().value()
-                v_scroll = scroll_area.verticalScrollBar().value()
+class LayerItem(QGraphicsItem):
+    """Элемент сцены, отображающий один слой.
 
-                # Корректируем позицию с учетом масштабирования
-                new_h_scroll = (h_scroll + mouse_pos.x()) * scale_change - mouse_pos.x()
-                new_v_scroll = (v_scroll + mouse_pos.y()) * scale_change - mouse_pos.y()
+    Координаты сцены совпадают с координатами открытки без масштаба, поворот
+    выполняется вокруг центра рамки, как и на обычном холсте.
+    """
 
-                # Устанавливаем новые значения прокрутки
-                scroll_area.horizontalScrollBar().setValue(int(new_h_scroll))
-                scroll_area.verticalScrollBar().setValue(int(new_v_scroll))
+    def __init__(self, layer):
+        super().__init__()
+        self.layer = None
+        self.version = None
+        self.index = None
+        self._bounds = QRectF()
+        self.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+        self.set_layer(layer)
+
+    def set_layer(self, layer):
+        """Обновление элемента по слою (пропускается, если версия слоя не изменилась)"""
+        if layer is self.layer and layer.version == self.version:
+            return
+        self.prepareGeometryChange()
+        self.layer = layer
+        self.version = layer.version
+
+        rect = layer.rect
+        self._bounds = QRectF(0, 0, rect.width(), rect.height())
+
+        self.setPos(rect.x(), rect.y())
+        self.setTransformOriginPoint(rect.width() / 2, rect.height() / 2)
+        self.setRotation(layer.rotation)
+        self.setVisible(layer.visible)
+        self.update()
+
+    def boundingRect(self):
+        return self._bounds
+
+    def paint(self, painter, option, widget=None):
+        layer = self.layer
+        frame = QRectF(0, 0, layer.rect.width(), layer.rect.height())
+        if layer.type == 'image' and layer.path is None:
+            Canvas.draw_placeholder(painter, frame)
+        elif layer.type == 'image':
+            # Изображение берется из кэша в размере, близком к размеру на устройстве
+            transform = painter.worldTransform()
+            scale = (transform.m11() ** 2 + transform.m12() ** 2) ** 0.5
+            size = QSize(max(1, int(frame.width() * scale)), max(1, int(frame.height() * scale)))
+            pixmap = image_cache.get_pixmap(layer.path, size)
+            if not pixmap.isNull():
+                painter.drawPixmap(frame, pixmap, QRectF(pixmap.rect()))
+        elif layer.type == 'text':
+            painter.setFont(QFont(layer.font, layer.font_size))
+            painter.setPen(QColor(layer.color))
+            painter.drawText(frame, layer.alignment, layer.text)
+
+
+class SceneView(QGraphicsView):
+    """Вид сцены внутри SceneCanvas: фон и выделение рисуются средствами холста"""
+
+    def __init__(self, scene, canvas):
+        super().__init__(scene, canvas)
+        self.canvas = canvas
+        self.setFrameShape(QGraphicsView.NoFrame)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+        self.setTransformationAnchor(QGraphicsView.NoAnchor)
+        self.setViewportUpdateMode(QGraphicsView.MinimalViewportUpdate)
+        self.setOptimizationFlag(QGraphicsView.DontSavePainterState, True)
+        self.setFocusPolicy(Qt.NoFocus)
+        # Мышь и колесо обрабатывает сам холст
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+
+    def drawBackground(self, painter, rect):
+        size = self.canvas.canvas_size
+        painter.fillRect(rect, QColor("#808080"))
+        painter.fillRect(QRectF(0, 0, size.width(), size.height()), Qt.white)
+
+    def drawForeground(self, painter, rect):
+        # Подсветка и маркеры рисуются в экранных координатах документа, как на обычном холсте
+        canvas = self.canvas
+        painter.save()
+        painter.resetTransform()
+        painter.translate(-canvas.view_offset)
+
+        hovered = canvas.hovered_item
+        if hovered is not None and hovered != canvas.current_item and hovered < len(canvas.parent_editor.layers):
+            geometry = canvas.layer_geometry(hovered)
+            painter.save()
+            painter.setTransform(geometry.transform, True)
+            painter.setPen(QPen(QColor(100, 150, 255, 150), 3, Qt.SolidLine))
+            painter.setBrush(Qt.NoBrush)
+            painter.drawRect(geometry.local_rect)
+            painter.restore()
+
+        canvas.draw_selection(painter)
+        painter.restore()
+
+
+class SceneCanvas(Canvas):
+    """Холст, отображающий слои через QGraphicsScene.
+
+    Взаимодействие (выделение, маркеры, редактирование текста, история)
+    унаследовано от Canvas, а отрисовку, порядок слоев, повороты и поиск
+    слоя под курсором выполняет сцена с BSP-индексом. Каждый слой
+    кэшируется в координатах устройства и перерисовывается только при
+    изменении самого слоя или масштаба.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.items = {}  # id слоя -> LayerItem
+        self.scene = QGraphicsScene(self)
+        self.scene.setItemIndexMethod(QGraphicsScene.BspTreeIndex)
+        self.view = SceneView(self.scene, self)
+        self.view.setGeometry(self.rect())
+        self.text_edit.raise_()
+        self.apply_view()
+
+    def apply_view(self):
+        """Перенос масштаба и смещения холста в вид сцены"""
+        scale = self.scale_factor
+        self.view.setTransform(QTransform.fromScale(scale, scale))
+        self.view.setSceneRect(QRectF(self.view_offset.x() / scale, self.view_offset.y() / scale,
+                                      self.width() / scale, self.height() / scale))
+
+    def update(self, *args):
+        """Перерисовка вида сцены (прямоугольники - в координатах виджета)"""
+        if hasattr(self, 'view'):
+            self.view.viewport().update(*args)
+
+    def paintEvent(self, event):
+        # Весь холст закрыт видом сцены
+        pass
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.view.setGeometry(self.rect())
+        self.apply_view()
+
+    def scroll_view(self):
+        super().scroll_view()
+        if hasattr(self, 'view'):
+            self.apply_view()
+
+    def zoom_to(self, scale_factor, anchor=None):
+        super().zoom_to(scale_factor, anchor)
+        self.apply_view()
+
+    def set_canvas_size(self, size):
+        super().set_canvas_size(size)
+        self.scene.setSceneRect(QRectF(0, 0, size.width(), size.height()))
+
+    def begin_transform_cache(self):
+        # Неподвижные слои уже кэшированы сценой
+        self.transform_cache = None
+
+    def sync_layers(self):
+        super().sync_layers()
+        layers = self.parent_editor.layers
+        items = {}
+        for i, layer in enumerate(layers):
+            item = self.items.pop(id(layer), None)
+            if item is None:
+                item = LayerItem(layer)
+                self.scene.addItem(item)
             else:
-                # Если scroll area не найден, просто центрируем холст
-                self.center_canvas()
+                item.set_layer(layer)
+            item.index = i
+            item.setZValue(len(layers) - i)
+            items[id(layer)] = item
+        for item in self.items.values():
+            self.scene.removeItem(item)
+        self.items = items
+        self.sync_editing()
+
+    def layers_data_changed(self, top_left, bottom_right):
+        """Обновление элементов слоев, об изменении которых сообщила модель панели слоев"""
+        layers = self.parent_editor.layers
+        for index in range(top_left.row(), min(bottom_right.row() + 1, len(layers))):
+            item = self.items.get(id(layers[index]))
+            if item is not None:
+                item.set_layer(layers[index])
+                item.setVisible(layers[index].visible and self.editing_text != index)
+
+    def sync_editing(self):
+        """Скрытие слоя, текст которого редактируется поверх холста"""
+        for i, layer in enumerate(self.parent_editor.layers):
+            item = self.items.get(id(layer))
+            if item is not None:
+                item.setVisible(layer.visible and self.editing_text != i)
 
-            self.last_scale_factor = self.scale_factor
-            self.update()
-        else:
-            super().wheelEvent(event)
+    def start_text_edit(self, layer):
+        super().start_text_edit(layer)
+        self.sync_editing()
+
+    def finish_text_edit(self):
+        super().finish_text_edit()
+        self.sync_editing()
+
+    def mousePressEvent(self, event):
+        editing = self.editing_text
+        super().mousePressEvent(event)
+        if editing != self.editing_text:
+            self.sync_editing()
+
+    def layer_at(self, pos):
+        """Индекс верхнего видимого слоя под экранной точкой (поиск по индексу сцены)"""
+        scene_pos = QPointF(pos.x() / self.scale_factor, pos.y() / self.scale_factor)
+        for item in self.scene.items(scene_pos, Qt.IntersectsItemShape, Qt.DescendingOrder):
+            if isinstance(item, LayerItem):
+                return item.index
+        return None
 
 
 class NewCanvasDialog(QDialog):
@@ -832,6 +2732,409 @@ class NewCanvasDialog(QDialog):
         self.setLayout(layout)
 
 
+# Размеры экспорта: (ключ для командной строки, подпись, доля от оригинала или (ширина, высота))
+EXPORT_SIZE_PRESETS = [
+    ('original', "Оригинальный размер", 1.0),
+    ('50%', "50% от оригинала", 0.5),
+    ('25%', "25% от оригинала", 0.25),
+    ('fullhd', "1920x1080 (Full HD)", (1920, 1080)),
+    ('hd', "1280x720 (HD)", (1280, 720)),
+    ('800x600', "800x600", (800, 600)),
+]
+
+
+def export_target_size(preset, original_size):
+    """Размер изображения для экспорта по ключу или подписи размера из EXPORT_SIZE_PRESETS"""
+    width, height = original_size
+    for key, label, size in EXPORT_SIZE_PRESETS:
+        if preset in (key, label):
+            if isinstance(size, tuple):
+                return size
+            return (int(width * size), int(height * size))
+    return (width, height)
+
+
+def export_rects(canvas_size, layers, target_size):
+    """Рамки слоев в целевом масштабе и масштаб шрифтов: (список QRect, масштаб)"""
+    scale_x = target_size[0] / canvas_size.width()
+    scale_y = target_size[1] / canvas_size.height()
+    store = LayerGeometryStore()
+    store.rebuild(layers)
+    rects = [QRect(*(int(value) for value in rect)) for rect in store.scaled_rects(scale_x, scale_y)]
+    return rects, min(scale_x, scale_y)
+
+
+def render_project(canvas_size, layers, target_size, images=None):
+    """Отрисовка видимых слоев на белом фоне в изображение целевого размера (QImage RGB32).
+
+    Все слои рисуются за один проход без отсечения. Это эталон: экспорт
+    полосами (render_strips, render_export) совпадает с ним до пикселя.
+    """
+    image = QImage(target_size[0], target_size[1], QImage.Format_RGB32)
+    image.fill(Qt.white)
+    rects, font_scale = export_rects(canvas_size, layers, target_size)
+    painter = QPainter(image)
+    try:
+        for layer, rect in zip(reversed(layers), reversed(rects)):
+            draw_export_layer(painter, layer, rect, font_scale, images)
+    finally:
+        painter.end()
+    return image
+
+
+def export_image_key(layer):
+    """Ключ исходного изображения слоя при экспорте: путь к ресурсу, а пока
+    изображение не загружено - его источник в файле проекта (None - изображения нет)"""
+    if layer.path is not None:
+        return layer.path
+    return layer.source[1] if layer.source is not None else None
+
+
+def export_sources(layers):
+    """Исходные изображения видимых слоев (ключ export_image_key -> QImage или None) для отрисовки вне основного потока.
+
+    Кэш изображений не потокобезопасен, поэтому из него в основном потоке
+    заранее берутся уже декодированные изображения. Остальные (None)
+    декодирует при первом обращении поток отрисовки (export_image), так что
+    основной поток не ждет ни декодирования, ни фоновой загрузки проекта.
+    """
+    images = {}
+    for layer in layers:
+        if layer.type == 'image' and layer.visible:
+            key = export_image_key(layer)
+            if key is not None:
+                images[key] = image_cache.peek_image(layer.path) if layer.path is not None else None
+    return images
+
+
+def export_image(images, layer):
+    """Исходное изображение слоя из словаря export_sources (недостающее декодируется и запоминается в нем)"""
+    key = export_image_key(layer)
+    if key is None:
+        return QImage()
+    image = images.get(key)
+    if image is None:
+        if layer.path is not None:
+            image = QImage(key)
+        else:
+            # Незагруженное изображение читается прямо из файла проекта
+            try:
+                with key.open() as stream:
+                    image = QImage.fromData(stream.read())
+            except Exception:
+                image = QImage()
+        images[key] = image
+    return image
+
+
+def draw_export_layer(painter, layer, rect, font_scale, images=None):
+    """Отрисовка слоя при экспорте: rect - рамка в целевом масштабе"""
+    if not layer.visible:
+        return
+
+    if layer.type == 'image':
+        # Загрузка изображения (из общего кэша или словаря export_sources)
+        if images is not None:
+            source = export_image(images, layer)
+        elif layer.path is not None:
+            source = image_cache.get_image(layer.path)
+        else:
+            return
+        if source.isNull():
+            return
+
+        # Применение трансформаций с учетом масштабирования
+        transform = QTransform()
+        transform.translate(rect.x() + rect.width() / 2,
+                            rect.y() + rect.height() / 2)
+        transform.rotate(layer.rotation)
+        transform.translate(-rect.width() / 2, -rect.height() / 2)
+
+        painter.save()
+        painter.setTransform(transform, True)
+        painter.drawImage(QRect(0, 0, rect.width(), rect.height()),
+                          source,
+                          QRect(0, 0, source.width(), source.height()))
+        painter.restore()
+
+    elif layer.type == 'text':
+        painter.save()
+        font = QFont(layer.font, int(layer.font_size * font_scale))
+        painter.setFont(font)
+        painter.setPen(QColor(layer.color))
+
+        if layer.rotation != 0:
+            painter.translate(rect.center())
+            painter.rotate(layer.rotation)
+            painter.translate(-rect.width() / 2, -rect.height() / 2)
+            painter.drawText(QRect(0, 0, rect.width(), rect.height()),
+                             layer.alignment,
+                             layer.text)
+        else:
+            painter.drawText(rect, layer.alignment, layer.text)
+        painter.restore()
+
+
+EXPORT_STRIP_ROWS = 128  # Высота полосы при экспорте (строк)
+EXPORT_TILE_PIXELS = 32 * 1024 * 1024  # Изображения больше рисуются прямо в файл на диске
+
+
+def export_spans(layers, rects, target_height):
+    """Строки устройства [first, last), которые может задеть каждый слой (повернутая рамка с запасом на сглаживание)"""
+    spans = []
+    for layer, rect in zip(layers, rects):
+        bounds = QRectF(rect)
+        if layer.rotation != 0:
+            transform = QTransform()
+            transform.translate(bounds.center().x(), bounds.center().y())
+            transform.rotate(layer.rotation)
+            transform.translate(-bounds.width() / 2, -bounds.height() / 2)
+            bounds = transform.mapRect(QRectF(0, 0, bounds.width(), bounds.height()))
+        spans.append((max(math.floor(bounds.top()) - 2, 0), min(math.ceil(bounds.bottom()) + 2, target_height)))
+    return spans
+
+
+def render_strips(painter, canvas_size, layers, target_size, strip_height=EXPORT_STRIP_ROWS, images=None,
+                  directory=None):
+    """Отрисовка слоев горизонтальными полосами на устройстве RGB32 целевого размера: генератор верхних строк полос.
+
+    Растеризация Qt масштабированных и повернутых изображений зависит от
+    отсечения (края начинают шагать от его верхней строки), поэтому
+    изображение нельзя рисовать прямо по полосам. Слой с изображением
+    рисуется целиком за один проход в свой буфер (layer_rows) на строки
+    своей повернутой рамки и переносится в полосы готовыми строками; текст
+    от отсечения не зависит и рисуется прямо в полосу. Так результат
+    совпадает с render_project до пикселя. Буфер создается первой полосой,
+    которую пересекает слой, и освобождается после последней. Полоса
+    готова, когда генератор выдает ее верхнюю строку.
+    """
+    target_width, target_height = target_size
+    rects, font_scale = export_rects(canvas_size, layers, target_size)
+    spans = export_spans(layers, rects, target_height)
+
+    buffers = {}  # индекс слоя -> строки слоя с изображением
+    for top in range(0, target_height, strip_height):
+        bottom = min(top + strip_height, target_height)
+        painter.setClipRect(0, top, target_width, bottom - top)
+        painter.fillRect(0, top, target_width, bottom - top, Qt.white)
+        for i in reversed(range(len(layers))):
+            layer = layers[i]
+            first, last = spans[i]
+            if not layer.visible or first >= bottom or last <= top:
+                continue
+            if layer.type != 'image':
+                draw_export_layer(painter, layer, rects[i], font_scale, images)
+                continue
+            if export_image_key(layer) is None:
+                continue
+            rows = buffers.get(i)
+            if rows is None:
+                rows = buffers[i] = layer_rows(layer, rects[i], font_scale, images, target_width, first, last,
+                                               directory)
+            start, end = max(first, top), min(last, bottom)
+            painter.drawImage(0, start, pixels_image(rows[start - first:end - first], QImage.Format_ARGB32_Premultiplied))
+            if last <= bottom:
+                del buffers[i]
+        yield top
+    painter.setClipping(False)
+
+
+def layer_rows(layer, rect, font_scale, images, width, first, last, directory=None):
+    """Слой, нарисованный за один проход в массив строк [first, last) устройства шириной width (ARGB32 premultiplied).
+
+    Изображение над массивом начинается на first строк выше него, поэтому
+    координаты слоя и размеры устройства те же, что при отрисовке
+    render_project, а отсечение по строкам массива не дает рисованию выйти
+    за его пределы. Массивы больше EXPORT_TILE_PIXELS лежат в numpy.memmap
+    во временном файле в каталоге directory.
+    """
+    shape = (last - first, width, 4)
+    if (last - first) * width <= EXPORT_TILE_PIXELS:
+        rows = np.zeros(shape, np.uint8)
+    else:
+        rows = np.memmap(tempfile.TemporaryFile(prefix='postcard_export_', dir=directory), dtype=np.uint8,
+                         mode='w+', shape=shape)
+    image = QImage(sip.voidptr(rows.ctypes.data - first * width * 4), width, last, width * 4,
+                   QImage.Format_ARGB32_Premultiplied)
+    painter = QPainter(image)
+    try:
+        painter.setClipRect(0, first, width, last - first)
+        draw_export_layer(painter, layer, rect, font_scale, images)
+    finally:
+        painter.end()
+    return rows
+
+
+def image_pixels(image):
+    """Пиксели QImage в виде массива numpy (высота x ширина x 4, порядок RGBX)"""
+    image = image.convertToFormat(QImage.Format_RGBX8888)
+    bits = image.constBits()
+    bits.setsize(image.sizeInBytes())
+    return np.frombuffer(bits, np.uint8).reshape(image.height(), image.bytesPerLine() // 4, 4)[:, :image.width()].copy()
+
+
+def pixels_image(pixels, image_format=QImage.Format_RGB32):
+    """QImage формата image_format поверх непрерывного массива пикселей (высота x ширина x 4) без копии.
+
+    Рисование в изображение меняет сам массив; массив должен жить, пока
+    используется изображение.
+    """
+    height, width = pixels.shape[:2]
+    return QImage(sip.voidptr(pixels.ctypes.data), width, height, width * 4, image_format)
+
+
+def render_export(canvas_size, layers, target_size, images=None, progress=None, directory=None):
+    """Отрисовка для экспорта в массив пикселей RGBX (см. image_pixels).
+
+    Слои рисуются прямо в массив (pixels_image) полосами по
+    EXPORT_STRIP_ROWS строк (render_strips), результат совпадает с
+    render_project; готовая полоса переводится из RGB32 в RGBX на месте.
+    Изображения больше EXPORT_TILE_PIXELS рисуются в numpy.memmap во
+    временном файле в каталоге directory: в работе только строки текущей
+    полосы, остальные остаются на диске. progress(готово, всего)
+    вызывается после каждой полосы.
+    """
+    target_width, target_height = target_size
+    shape = (target_height, target_width, 4)
+    if target_width * target_height <= EXPORT_TILE_PIXELS:
+        pixels = np.empty(shape, np.uint8)
+    else:
+        pixels = np.memmap(tempfile.TemporaryFile(prefix='postcard_export_', dir=directory), dtype=np.uint8,
+                           mode='w+', shape=shape)
+
+    total = -(-target_height // EXPORT_STRIP_ROWS)
+    image = pixels_image(pixels)
+    painter = QPainter(image)
+    try:
+        for number, top in enumerate(render_strips(painter, canvas_size, layers, target_size, images=images,
+                                                   directory=directory), 1):
+            strip = pixels[top:top + EXPORT_STRIP_ROWS]
+            strip[:] = image_pixels(pixels_image(strip))
+            if progress is not None:
+                progress(number, total)
+    finally:
+        painter.end()
+    return pixels
+
+
+def save_jpeg(pixels, target, quality, subsampling=-1):
+    """Кодирование массива пикселей RGBX в JPEG (путь или файловый объект).
+
+    Pillow читает строки прямо из массива, без копии изображения, поэтому
+    для массива на диске (render_export) в память целиком оно не попадает.
+    subsampling: -1 - по умолчанию (4:2:0), 0 - 4:4:4, 1 - 4:2:2, 2 - 4:2:0.
+    """
+    height, width = pixels.shape[:2]
+    image = Image.frombuffer('RGBX', (width, height), pixels, 'raw', 'RGBX', 0, 1)
+    image.save(target, 'JPEG', quality=quality, subsampling=subsampling)
+
+
+JPEG_SUBSAMPLING_NAMES = {0: "4:4:4", 1: "4:2:2", 2: "4:2:0"}
+
+
+def fit_jpeg(pixels, max_bytes, max_quality=95, subsamplings=(2,), progress=None):
+    """Самое высокое качество JPEG, при котором файл не больше max_bytes.
+
+    Изображение (массив пикселей RGBX, см. render_export) отрисовано один
+    раз; для каждого варианта субдискретизации качество подбирается
+    двоичным поиском по пробным кодированиям в память. subsamplings
+    перечисляются по убыванию предпочтения: следующий вариант выбирается,
+    только если дает качество строго выше. progress(проб, всего) вызывается
+    после каждой пробы. Возвращает (данные JPEG, качество,
+    субдискретизация); если даже качество 1 не укладывается в размер -
+    ValueError.
+    """
+    height, width = pixels.shape[:2]
+    image = Image.frombuffer('RGBX', (width, height), pixels, 'raw', 'RGBX', 0, 1)
+    total = len(subsamplings) * max_quality.bit_length()
+    probes = 0
+    best = None  # (качество, данные, субдискретизация)
+
+    for subsampling in subsamplings:
+        low, high = (1 if best is None else best[0] + 1), max_quality
+        while low <= high:
+            quality = (low + high) // 2
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=quality, subsampling=subsampling)
+            probes += 1
+            if progress is not None:
+                progress(min(probes, total), total)
+            if buffer.tell() <= max_bytes:
+                best = (quality, buffer.getvalue(), subsampling)
+                low = quality + 1
+            else:
+                high = quality - 1
+
+    if best is None:
+        raise ValueError(f"Изображение не удается сжать до {max_bytes} байт")
+    quality, data, subsampling = best
+    return data, quality, subsampling
+
+
+PLACEHOLDER_PATTERN = re.compile(r'\{(\w+)\}')  # Поле для подстановки в тексте шаблона: {имя}
+
+
+def fill_placeholders(text, row):
+    """Подстановка значений строки данных в поля {имя}; поля без значения остаются как есть"""
+    return PLACEHOLDER_PATTERN.sub(lambda match: str(row.get(match.group(1), match.group(0))), text)
+
+
+class MergeTemplate:
+    """Шаблон открытки для слияния с данными (одна открытка на строку данных).
+
+    Текстовые слои с полями {имя} меняются от строки к строке, остальные -
+    нет. Неизменяемые слои ниже самого нижнего изменяемого один раз
+    отрисовываются в фон целевого размера, а каждый неизменяемый слой выше
+    него - в свой буфер строк (layer_rows). Для каждой строки копируется
+    фон и снизу вверх на него переносятся готовые буферы и рисуются только
+    тексты с подставленными значениями, так что открытка совпадает с
+    экспортом заполненного проекта до пикселя.
+
+    render() не обращается к кэшу изображений и может вызываться из
+    нескольких потоков одновременно.
+    """
+
+    def __init__(self, canvas_size, layers, target_size):
+        self.fields = set()
+        variable = set()
+        for i, layer in enumerate(layers):
+            if layer.type == 'text' and layer.visible and PLACEHOLDER_PATTERN.search(layer.text):
+                self.fields.update(PLACEHOLDER_PATTERN.findall(layer.text))
+                variable.add(i)
+
+        # Слои хранятся сверху вниз, фон - все, что ниже самого нижнего изменяемого слоя
+        bottom = max(variable) + 1 if variable else 0
+        self.background = render_project(canvas_size, layers[bottom:], target_size)
+        rects, self.font_scale = export_rects(canvas_size, layers, target_size)
+        spans = export_spans(layers, rects, target_size[1])
+        # Снизу вверх: (слой, рамка, первая строка буфера, буфер); у текстов с полями буфера нет
+        self.parts = []
+        for i in reversed(range(bottom)):
+            layer = layers[i]
+            first, last = spans[i]
+            if i in variable:
+                self.parts.append((layer, rects[i], first, None))
+            elif layer.visible and first < last and (layer.type != 'image' or export_image_key(layer) is not None):
+                rows = layer_rows(layer, rects[i], self.font_scale, None, target_size[0], first, last)
+                self.parts.append((layer, rects[i], first, rows))
+
+    def render(self, row):
+        """Открытка для строки данных row (словарь поле -> значение)"""
+        image = self.background.copy()
+        painter = QPainter(image)
+        try:
+            for layer, rect, first, rows in self.parts:
+                if rows is not None:
+                    painter.drawImage(0, first, pixels_image(rows, QImage.Format_ARGB32_Premultiplied))
+                    continue
+                layer = layer.copy()
+                layer.text = fill_placeholders(layer.text, row)
+                draw_export_layer(painter, layer, rect, self.font_scale)
+        finally:
+            painter.end()
+        return image
+
+
 class ExportJpgDialog(QDialog):
     """Диалог настройки параметров экспорта JPG"""
 
@@ -850,14 +3153,19 @@ class ExportJpgDialog(QDialog):
 
         # Размер изображения
         self.size_combo = QComboBox()
-        self.size_combo.addItems([
-            "Оригинальный размер",
-            "50% от оригинала",
-            "25% от оригинала",
-            "1920x1080 (Full HD)",
-            "1280x720 (HD)",
-            "800x600"
-        ])
+        self.size_combo.addItems([label for key, label, size in EXPORT_SIZE_PRESETS])
+
+        # Ограничение размера файла: качество подбирается не выше заданного
+        self.max_size_check = QCheckBox("Размер файла не больше:")
+        self.max_size_spin = QSpinBox()
+        self.max_size_spin.setRange(10, 1024 * 1024)
+        self.max_size_spin.setValue(1024)
+        self.max_size_spin.setSuffix(" КБ")
+        self.max_size_spin.setEnabled(False)
+        self.max_size_check.toggled.connect(self.max_size_spin.setEnabled)
+        self.subsampling_check = QCheckBox("Подбирать субдискретизацию цвета")
+        self.subsampling_check.setEnabled(False)
+        self.max_size_check.toggled.connect(self.subsampling_check.setEnabled)
 
         # Кнопки
         self.ok_button = QPushButton("Экспорт")
@@ -871,37 +3179,43 @@ class ExportJpgDialog(QDialog):
         layout.addWidget(self.quality_spin, 0, 1)
         layout.addWidget(QLabel("Размер:"), 1, 0)
         layout.addWidget(self.size_combo, 1, 1)
-        layout.addWidget(self.ok_button, 2, 0)
-        layout.addWidget(self.cancel_button, 2, 1)
+        layout.addWidget(self.max_size_check, 2, 0)
+        layout.addWidget(self.max_size_spin, 2, 1)
+        layout.addWidget(self.subsampling_check, 3, 0, 1, 2)
+        layout.addWidget(self.ok_button, 4, 0)
+        layout.addWidget(self.cancel_button, 4, 1)
 
         self.setLayout(layout)
 
     def get_quality(self):
         return self.quality_spin.value()
 
+    def get_max_bytes(self):
+        """Ограничение размера файла в байтах (None - без ограничения)"""
+        if not self.max_size_check.isChecked():
+            return None
+        return self.max_size_spin.value() * 1024
+
+    def get_subsamplings(self):
+        """Варианты субдискретизации для подбора по размеру (по убыванию предпочтения)"""
+        if self.subsampling_check.isChecked():
+            return (0, 1, 2)
+        return (2,)
+
     def get_target_size(self, original_size):
         """Возвращает целевой размер изображения"""
-        text = self.size_combo.currentText()
-        width, height = original_size
-
-        if text == "Оригинальный размер":
-            return (width, height)
-        elif text == "50% от оригинала":
-            return (int(width * 0.5), int(height * 0.5))
-        elif text == "25% от оригинала":
-            return (int(width * 0.25), int(height * 0.25))
-        elif text == "1920x1080 (Full HD)":
-            return (1920, 1080)
-        elif text == "1280x720 (HD)":
-            return (1280, 720)
-        elif text == "800x600":
-            return (800, 600)
-
-        return (width, height)
+        return export_target_size(self.size_combo.currentText(), original_size)
 
 class PostcardEditor(QMainWindow):
     """Главное окно редактора открыток"""
 
+    HISTORY_MEMORY_BUDGET_MB = 4  # Бюджет памяти истории, сверх него записи выгружаются на диск
+    HISTORY_DISK_BUDGET_MB = 256  # Бюджет временного файла истории, сверх него старые записи удаляются
+    HISTORY_MERGE_WINDOW = 1.0  # Интервал (с), в пределах которого однотипные правки сливаются
+    AUTOSAVE_INTERVAL_MIN = 5  # Интервал автосохранения (мин), 0 - отключено
+    AUTOSAVE_RETRY_SEC = 5  # Повтор автосохранения, отложенного из-за фоновой загрузки или записи
+    AUTOSAVE_DIRECTORY = 'postcard_editor_autosave'  # Автосохранения новых документов (во временном каталоге)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Редактор открыток (" + CODE_VERSION + ")")
@@ -911,11 +3225,58 @@ class PostcardEditor(QMainWindow):
         self.resize_timer.setSingleShot(True)
         self.resize_timer.timeout.connect(self.handle_resize)
         self.layers = []  # Список слоев
-        self.history = []  # История изменений
+        self.layer_store = LayerGeometryStore()  # Геометрия слоев в массивах для векторных запросов
+        self.history = []  # История изменений (команды HistoryCommand)
         self.current_history_index = -1  # Текущая позиция в истории
+        self.history_bytes = 0  # Память, занятая записями истории
+        self.history_spill = HistorySpillStore()
+        self.history_spill_start = 0  # Записи истории до этого индекса уже выгружены на диск
+        self.project_path = None  # Файл открытого проекта
+        self.image_loader = None  # Фоновая загрузка изображений открытого проекта
+        self.revision = 0  # Счетчик изменений документа
+        self.saved_revision = 0  # Изменение, записанное в файл проекта
+        self.autosaved_revision = 0  # Изменение, записанное автосохранением
+        self.project_saver = ProjectSaver(self)
+        self.project_saver.progress.connect(self.show_save_progress)
+        self.project_saver.saved.connect(self.project_saved)
+        self.journal = None  # Журнал правок открытого проекта (ProjectJournal)
+        self.image_exporter = ImageExporter(self)
+        self.image_exporter.progress.connect(self.show_export_progress)
+        self.image_exporter.exported.connect(self.image_exported)
+        self.pending_journal = None  # Журнал к снимку, который сейчас записывается
+        self.image_failures = []  # Имена изображений открытого проекта, которые не удалось загрузить
+
+        # Бюджет памяти кэша изображений (МБ)
+        settings = app_settings()
+        cache_mb = settings.value("cache/image_budget_mb", ImageCache.DEFAULT_BUDGET_MB, type=int)
+        image_cache.set_max_bytes(cache_mb * 1024 * 1024)
+
+        # Бюджеты истории изменений (МБ)
+        self.history_memory_budget = settings.value(
+            "history/memory_budget_mb", self.HISTORY_MEMORY_BUDGET_MB, type=int) * 1024 * 1024
+        self.history_disk_budget = settings.value(
+            "history/disk_budget_mb", self.HISTORY_DISK_BUDGET_MB, type=int) * 1024 * 1024
+
+        # Движок отрисовки холста: 'canvas' (собственная отрисовка) или 'scene' (QGraphicsScene)
+        self.render_engine = settings.value("render/engine", "canvas", type=str)
+
+        # Периодическое автосохранение в фоновом потоке
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosave)
+        autosave_min = settings.value("autosave/interval_min", self.AUTOSAVE_INTERVAL_MIN, type=int)
+        if autosave_min > 0:
+            self.autosave_timer.start(autosave_min * 60 * 1000)
+        self.autosave_retry_timer = QTimer(self)
+        self.autosave_retry_timer.setSingleShot(True)
+        self.autosave_retry_timer.timeout.connect(self.autosave)
+        self.init_autosave_session()
+
         self.init_ui()
         self.setup_shortcuts()
 
+        # Предложение восстановить документ после аварийного завершения - когда окно уже показано
+        QTimer.singleShot(0, self.recover_session_autosave)
+
     def init_ui(self):
         """Инициализация пользовательского интерфейса"""
         # Центральный виджет и основной макет
@@ -925,11 +3286,13 @@ class PostcardEditor(QMainWindow):
         main_layout = QHBoxLayout(central_widget)
 
         # Область холста
-        self.canvas = Canvas(self)
-        scroll_area = QScrollArea()
-        scroll_area.setWidget(self.canvas)
-        scroll_area.setWidgetResizable(True)
-        main_layout.addWidget(scroll_area, 1)
+        self.canvas = SceneCanvas(self) if self.render_engine == 'scene' else Canvas(self)
+        canvas_layout = QGridLayout()
+        canvas_layout.setSpacing(0)
+        canvas_layout.addWidget(self.canvas, 0, 0)
+        canvas_layout.addWidget(self.canvas.v_scrollbar, 0, 1)
+        canvas_layout.addWidget(self.canvas.h_scrollbar, 1, 0)
+        main_layout.addLayout(canvas_layout, 1)
 
         # Правая панель
         right_panel = QVBoxLayout()
@@ -939,16 +3302,23 @@ class PostcardEditor(QMainWindow):
         history_group = QVBoxLayout()
         history_group.addWidget(QLabel("История изменений:"))
 
-        self.history_list = QListWidget()
-        self.history_list.itemClicked.connect(self.history_item_clicked)
+        self.history_model = HistoryListModel(self)
+        self.history_list = RowListView()
+        self.history_list.setModel(self.history_model)
+        self.history_list.clicked.connect(self.history_item_clicked)
         history_group.addWidget(self.history_list)
 
         right_panel.addLayout(history_group)
 
         # Список слоев
-        self.layer_list = QListWidget()
-        self.layer_list.itemSelectionChanged.connect(self.layer_selection_changed)
-        self.layer_list.itemDoubleClicked.connect(self.layer_double_clicked)
+        self.layer_model = LayerListModel(self)
+        if isinstance(self.canvas, SceneCanvas):
+            # Элементы сцены следят за изменениями слоев по сигналам модели
+            self.layer_model.dataChanged.connect(self.canvas.layers_data_changed)
+        self.layer_list = RowListView()
+        self.layer_list.setModel(self.layer_model)
+        self.layer_list.selectionModel().selectionChanged.connect(lambda *args: self.layer_selection_changed())
+        self.layer_list.doubleClicked.connect(self.layer_double_clicked)
         right_panel.addWidget(QLabel("Слои:"))
         right_panel.addWidget(self.layer_list)
 
@@ -1051,7 +3421,15 @@ class PostcardEditor(QMainWindow):
         redo_action.triggered.connect(self.redo)
         toolbar.addAction(redo_action)
 
-        # Строка состояния
+        # Строка состояния с индикатором фонового экспорта
+        self.export_progress = QProgressBar()
+        self.export_progress.setMaximumWidth(150)
+        self.export_cancel_button = QPushButton("Отменить экспорт")
+        self.export_cancel_button.clicked.connect(self.cancel_export)
+        self.statusBar().addPermanentWidget(self.export_progress)
+        self.statusBar().addPermanentWidget(self.export_cancel_button)
+        self.export_progress.setVisible(False)
+        self.export_cancel_button.setVisible(False)
         self.statusBar().showMessage("Готово")
 
     def copy_object(self):
@@ -1062,29 +3440,11 @@ class PostcardEditor(QMainWindow):
         index = self.canvas.current_item
         layer = self.layers[index]
 
-        # Создаем копию слоя, преобразуя сложные объекты в простые типы
-        self.clipboard = {
-            'type': layer['type'],
-            'rect': {
-                'x': layer['rect'].x(),
-                'y': layer['rect'].y(),
-                'width': layer['rect'].width(),
-                'height': layer['rect'].height()
-            },
-            'visible': layer['visible'],
-            'rotation': layer['rotation']
-        }
-
-        if layer['type'] == 'image':
-            self.clipboard['path'] = layer['path']
-        elif layer['type'] == 'text':
-            self.clipboard.update({
-                'text': layer['text'],
-                'font': layer['font'],
-                'font_size': layer['font_size'],
-                'color': layer['color'],
-                'alignment': int(layer['alignment'])  # Преобразуем в int
-            })
+        # Копия не зависит от дальнейших правок исходного слоя и удерживает свой ресурс
+        if self.clipboard is not None:
+            asset_store.release(self.clipboard.asset)
+        self.clipboard = layer.copy()
+        asset_store.retain(self.clipboard.asset)
 
         self.statusBar().showMessage("Объект скопирован в буфер", 2000)
 
@@ -1093,45 +3453,18 @@ class PostcardEditor(QMainWindow):
         if not hasattr(self, 'clipboard') or not self.clipboard:
             return
 
-        # Создаем новый слой из буфера
-        new_layer = {
-            'type': self.clipboard['type'],
-            'rect': QRect(
-                self.clipboard['rect']['x'] + 20,
-                self.clipboard['rect']['y'] + 20,
-                self.clipboard['rect']['width'],
-                self.clipboard['rect']['height']
-            ),
-            'visible': self.clipboard['visible'],
-            'rotation': self.clipboard['rotation']
-        }
-
-        if self.clipboard['type'] == 'image':
-            new_layer['path'] = self.clipboard['path']
-        elif self.clipboard['type'] == 'text':
-            new_layer.update({
-                'text': self.clipboard['text'],
-                'font': self.clipboard['font'],
-                'font_size': self.clipboard['font_size'],
-                'color': self.clipboard['color'],
-                'alignment': self.clipboard['alignment']
-            })
+        # Создаем новый слой из буфера (буфер остается для повторной вставки)
+        new_layer = self.clipboard.copy()
+        new_layer.rect.translate(20, 20)
 
         # Добавляем новый слой
-        self.layers.insert(0, new_layer)
-
-        # Обновляем список слоев
-        if new_layer['type'] == 'image':
-            self.layer_list.insertItem(0, f"Изображение: {os.path.basename(new_layer['path'])}")
-        elif new_layer['type'] == 'text':
-            text = new_layer['text']
-            self.layer_list.insertItem(0, f"Текст: {text[:15] + '...' if len(text) > 15 else text}")
+        self.insert_layer(0, new_layer)
 
         # Выбираем новый слой
         self.layer_list.setCurrentRow(0)
         self.canvas.current_item = 0
         self.canvas.update()
-        self.add_to_history()
+        self.add_to_history(InsertLayerCommand("Вставка", 0, new_layer))
         self.statusBar().showMessage("Объект вставлен из буфера", 2000)
 
     def setup_shortcuts(self):
@@ -1164,15 +3497,11 @@ class PostcardEditor(QMainWindow):
 
     def zoom_in(self):
         """Увеличение масштаба"""
-        event = QWheelEvent(QPointF(), QPointF(), QPoint(0, 120), QPoint(0, 120), Qt.NoButton, Qt.NoModifier,
-                            Qt.NoScrollPhase, False)
-        self.canvas.wheelEvent(event)
+        self.canvas.zoom_to(max(0.1, min(5.0, self.canvas.scale_factor * 1.1)))
 
     def zoom_out(self):
         """Уменьшение масштаба"""
-        event = QWheelEvent(QPointF(), QPointF(), QPoint(0, -120), QPoint(0, -120), Qt.NoButton, Qt.NoModifier,
-                            Qt.NoScrollPhase, False)
-        self.canvas.wheelEvent(event)
+        self.canvas.zoom_to(max(0.1, min(5.0, self.canvas.scale_factor / 1.1)))
 
     def init_menu_bar(self):
         """Инициализация меню"""
@@ -1196,6 +3525,15 @@ class PostcardEditor(QMainWindow):
         save_action.triggered.connect(self.save_project)
         file_menu.addAction(save_action)
 
+        save_as_action = QAction("Сохранить как...", self)
+        save_as_action.setShortcut("Ctrl+Shift+S")
+        save_as_action.triggered.connect(self.save_project_as)
+        file_menu.addAction(save_as_action)
+
+        compact_action = QAction("Сжать проект", self)
+        compact_action.triggered.connect(self.compact_project)
+        file_menu.addAction(compact_action)
+
         export_action = QAction(self.get_icon('export'), "Экспорт в JPG...", self)
         export_action.setShortcut("Ctrl+E")
         export_action.triggered.connect(self.export_jpg)
@@ -1420,16 +3758,12 @@ class PostcardEditor(QMainWindow):
         new_index = current_index - 1
 
         # Перемещение слоя в списке
-        self.layers.insert(new_index, self.layers.pop(current_index))
-
-        # Обновление списка слоев
-        item = self.layer_list.takeItem(current_index)
-        self.layer_list.insertItem(new_index, item)
+        self.move_layer(current_index, new_index)
 
         # Обновление текущего выбранного элемента
         self.canvas.current_item = new_index
         self.layer_list.setCurrentRow(new_index)
-        self.add_to_history()
+        self.add_to_history(ReorderLayerCommand(current_index, new_index))
 
     def move_layer_down(self):
         """Перемещение выбранного слоя вниз"""
@@ -1441,33 +3775,93 @@ class PostcardEditor(QMainWindow):
         new_index = current_index + 1
 
         # Перемещение слоя в списке
-        self.layers.insert(new_index, self.layers.pop(current_index))
-
-        # Обновление списка слоев
-        item = self.layer_list.takeItem(current_index)
-        self.layer_list.insertItem(new_index, item)
+        self.move_layer(current_index, new_index)
 
         # Обновление текущего выбранного элемента
         self.canvas.current_item = new_index
         self.layer_list.setCurrentRow(new_index)
-        self.add_to_history()
+        self.add_to_history(ReorderLayerCommand(current_index, new_index))
 
     def resizeEvent(self, event):
         """Обработка изменения размера окна"""
         super().resizeEvent(event)
         self.resize_timer.start(100)
 
+    def closeEvent(self, event):
+        """Удаление временных файлов ресурсов и истории при закрытии окна"""
+        super().closeEvent(event)
+        if event.isAccepted():
+            self.autosave_timer.stop()
+            self.autosave_retry_timer.stop()
+            self.image_exporter.cancel()
+            self.image_exporter.wait()
+            self.cancel_image_loading()
+            # Начатые сохранения дописываются до удаления файлов ресурсов
+            self.project_saver.wait()
+            self.close_journal()
+            self.history_spill.clear()
+            asset_store.close()
+            # Новый документ, закрытый без сохранения, не восстанавливается
+            if self.session_lock is not None:
+                self.remove_file(self.session_autosave)
+                self.session_lock.unlock()
+
     def handle_resize(self):
         """Обработка завершения изменения размера"""
         if hasattr(self.canvas, 'scale_factor'):
             self.canvas.center_canvas_timer.start(100)
 
-    def update_history_list(self):
-        """Обновление списка истории"""
-        self.history_list.clear()
-        for i, state in enumerate(self.history):
-            self.history_list.addItem(f"Состояние {i + 1}")
+    def insert_layer(self, index, layer):
+        """Вставка слоя в документ"""
+        self.layer_model.beginInsertRows(QModelIndex(), index, index)
+        self.layers.insert(index, layer)
+        self.layer_model.endInsertRows()
+        asset_store.retain(layer.asset)
+        self.layers_changed()
+
+    def remove_layer(self, index):
+        """Удаление слоя из документа (возвращает удаленный слой)"""
+        self.layer_model.beginRemoveRows(QModelIndex(), index, index)
+        layer = self.layers.pop(index)
+        self.layer_model.endRemoveRows()
+        asset_store.release(layer.asset)
+        self.layers_changed()
+        return layer
+
+    def move_layer(self, old_index, new_index):
+        """Перемещение слоя на другую позицию в списке"""
+        # Для beginMoveRows позиция назначения задается до удаления строки
+        destination = new_index + 1 if new_index > old_index else new_index
+        self.layer_model.beginMoveRows(QModelIndex(), old_index, old_index, QModelIndex(), destination)
+        self.layers.insert(new_index, self.layers.pop(old_index))
+        self.layer_model.endMoveRows()
+        self.layers_changed()
+
+    def set_layers(self, layers):
+        """Полная замена списка слоев (новый холст, открытие проекта)"""
+        for layer in self.layers:
+            asset_store.release(layer.asset)
+        self.layer_model.beginResetModel()
+        self.layers = layers
+        self.layer_model.endResetModel()
+        for layer in self.layers:
+            asset_store.retain(layer.asset)
+        self.layers_changed()
 
+    def layers_changed(self):
+        """Уведомление об изменении состава или порядка слоев"""
+        self.layer_store.rebuild(self.layers)
+        self.canvas.sync_layers()
+
+    def layer_changed(self, index):
+        """Уведомление об изменении свойств слоя (положения, поворота, видимости, текста)"""
+        self.layers[index].touch()
+        self.layer_store.update(index, self.layers[index])
+        model_index = self.layer_model.index(index)
+        self.layer_model.dataChanged.emit(model_index, model_index, [Qt.DisplayRole])
+
+    def update_history_list(self):
+        """Выделение текущего состояния в списке истории"""
         if self.current_history_index >= 0:
             self.history_list.setCurrentRow(self.current_history_index)
 
@@ -1476,13 +3870,11 @@ class PostcardEditor(QMainWindow):
         if index < 0 or index >= len(self.history):
             return
 
-        self.current_history_index = index
-        self.restore_from_history()
+        self.go_to_history(index)
 
-    def history_item_clicked(self, item):
+    def history_item_clicked(self, index):
         """Обработка выбора элемента истории"""
-        index = self.history_list.row(item)
-        self.restore_history_state(index)
+        self.restore_history_state(index.row())
 
     def new_canvas(self):
         """Создание нового холста"""
@@ -1491,20 +3883,20 @@ class PostcardEditor(QMainWindow):
             width = dialog.width_spin.value()
             height = dialog.height_spin.value()
 
-            self.layers = []
-            self.history = []
-            self.current_history_index = -1
-            self.layer_list.clear()
+            self.cancel_image_loading()
+            self.close_journal()
+            self.discard_autosave()
+            self.set_layers([])
             self.canvas.current_item = None
-            self.canvas.setMinimumSize(width, height)
+            self.canvas.set_canvas_size(QSize(width, height))
 
             # Центрирование нового холста
-            QApplication.processEvents()
             self.canvas.fit_to_view()
-            self.canvas.center_canvas_timer.start(100)
 
             self.canvas.update()
-            self.add_to_history()
+            self.reset_history("Новый холст")
+            self.project_path = None
+            self.saved_revision = self.revision
 
     def add_image(self):
         """Добавление изображения на холст"""
@@ -1518,85 +3910,71 @@ class PostcardEditor(QMainWindow):
             QMessageBox.warning(self, "Предупреждение", "Не удалось загрузить изображение.")
             return
 
+        # Файл копируется в хранилище ресурсов (одинаковые изображения - один раз)
+        try:
+            asset = asset_store.add_file(file_path)
+        except OSError as e:
+            QMessageBox.warning(self, "Предупреждение", f"Не удалось загрузить изображение: {str(e)}")
+            return
+
+        # Пирамида уменьшенных копий для быстрой отрисовки при малом масштабе
+        image_cache.build_pyramid(asset_store.path(asset), image)
+
         # Если это первый слой, создаем холст с размерами изображения
+        canvas_size = None
         if not self.layers:
-            self.canvas.setMinimumSize(image.width(), image.height())
-            self.canvas.resize(image.width(), image.height())
-
-            # Получаем размеры области просмотра
-            scroll_area = self.findChild(QScrollArea)
-            if scroll_area:
-                viewport_size = scroll_area.viewport().size()
-
-                # Если изображение больше области просмотра, масштабируем
-                if (image.width() > viewport_size.width() or
-                        image.height() > viewport_size.height()):
-                    # Вычисляем коэффициент масштабирования
-                    width_ratio = viewport_size.width() / image.width()
-                    height_ratio = viewport_size.height() / image.height()
-                    scale_factor = min(width_ratio, height_ratio) * 0.9  # 90% от максимального размера
-
-                    # Применяем масштабирование
-                    self.canvas.scale_factor = scale_factor
-                    self.canvas.resize(
-                        int(image.width() * scale_factor),
-                        int(image.height() * scale_factor))
-
-                    # Центрируем холст
-                    self.canvas.center_canvas()
+            canvas_size = (QSize(self.canvas.canvas_size), QSize(image.width(), image.height()))
+            self.canvas.set_canvas_size(canvas_size[1])
+
+            # Если изображение больше области просмотра, масштабируем
+            viewport_size = self.canvas.size()
+            if (image.width() > viewport_size.width() or
+                    image.height() > viewport_size.height()):
+                # Вычисляем коэффициент масштабирования
+                width_ratio = viewport_size.width() / image.width()
+                height_ratio = viewport_size.height() / image.height()
+                scale_factor = min(width_ratio, height_ratio) * 0.9  # 90% от максимального размера
+
+                # Применяем масштабирование и центрируем холст
+                self.canvas.zoom_to(scale_factor)
+                self.canvas.center_canvas()
 
             rect = QRect(0, 0, image.width(), image.height())
         else:
             rect = QRect(50, 50, image.width(), image.height())
 
         # Добавление слоя
-        self.layers.insert(0, {
-            'type': 'image',
-            'path': file_path,
-            'rect': rect,
-            'visible': True,
-            'rotation': 0
-        })
+        layer = ImageLayer(rect, asset, os.path.basename(file_path))
+        self.insert_layer(0, layer)
 
-        # Добавление в список слоев
-        self.layer_list.insertItem(0, f"Изображение: {os.path.basename(file_path)}")
+        # Выбор нового слоя
         self.layer_list.setCurrentRow(0)
         self.canvas.current_item = 0
         self.canvas.update()
-        self.add_to_history()
+        self.add_to_history(InsertLayerCommand("Добавление изображения", 0, layer, canvas_size))
 
     def add_text(self):
         """Добавление текстового слоя"""
-        if not self.layers and not hasattr(self.canvas, 'minimumSize'):
-            self.canvas.setMinimumSize(800, 600)
+        if not self.layers and self.canvas.canvas_size.isEmpty():
+            self.canvas.set_canvas_size(QSize(800, 600))
 
         rect = QRect(100, 100, 200, 100)
         text = "Новый текст"
 
         # Добавление текстового слоя
-        self.layers.insert(0, {
-            'type': 'text',
-            'text': text,
-            'rect': rect,
-            'visible': True,
-            'font': "Monotype Corsiva Bold",
-            'font_size': 24,
-            'color': "#000000",
-            'rotation': 0,
-            'alignment': Qt.AlignLeft | Qt.AlignTop
-        })
+        layer = TextLayer(rect, text)
+        self.insert_layer(0, layer)
 
-        # Добавление в список слоев
-        self.layer_list.insertItem(0, f"Текст: {text[:15] + '...' if len(text) > 15 else text}")
+        # Выбор нового слоя
         self.layer_list.setCurrentRow(0)
         self.canvas.current_item = 0
         self.text_edit.setPlainText(text)
         self.canvas.update()
-        self.add_to_history()
+        self.add_to_history(InsertLayerCommand("Добавление текста", 0, layer))
 
     def layer_selection_changed(self):
         """Обработка изменения выбранного слоя"""
-        if not self.layer_list.selectedItems() or not self.layers:
+        if not self.layer_list.selectionModel().hasSelection() or not self.layers:
             self.canvas.current_item = None
             if hasattr(self.canvas, 'text_edit_widget') and self.canvas.text_edit_widget:
                 self.canvas.text_edit_widget.hide()
@@ -1610,17 +3988,17 @@ class PostcardEditor(QMainWindow):
             self.canvas.current_item = index
             layer = self.layers[index]
 
-            self.visible_checkbox.setChecked(layer['visible'])
-            self.visible_checkbox.setText("Скрыть" if layer['visible'] else "Показать")
+            self.visible_checkbox.setChecked(layer.visible)
+            self.visible_checkbox.setText("Скрыть" if layer.visible else "Показать")
 
-            if layer['type'] == 'text':
+            if layer.type == 'text':
                 self.text_edit.setEnabled(True)
-                self.text_edit.setPlainText(layer['text'])
+                self.text_edit.setPlainText(layer.text)
 
                 # Обновление выравнивания
-                if layer['alignment'] & Qt.AlignHCenter:
+                if layer.alignment & Qt.AlignHCenter:
                     self.alignment_combo.setCurrentIndex(1)
-                elif layer['alignment'] & Qt.AlignRight:
+                elif layer.alignment & Qt.AlignRight:
                     self.alignment_combo.setCurrentIndex(2)
                 else:
                     self.alignment_combo.setCurrentIndex(0)
@@ -1629,14 +4007,14 @@ class PostcardEditor(QMainWindow):
 
             self.canvas.update()
 
-    def layer_double_clicked(self, item):
+    def layer_double_clicked(self, model_index):
         """Обработка двойного клика по слою"""
-        index = self.layer_list.row(item)
+        index = model_index.row()
         if index < 0 or index >= len(self.layers):
             return
 
         layer = self.layers[index]
-        if layer['type'] == 'text':
+        if layer.type == 'text':
             self.layer_list.setCurrentRow(index)
             self.canvas.start_text_edit(layer)
 
@@ -1646,10 +4024,12 @@ class PostcardEditor(QMainWindow):
             return
 
         index = self.canvas.current_item
-        self.layers[index]['visible'] = not self.layers[index]['visible']
-        self.visible_checkbox.setText("Скрыть" if self.layers[index]['visible'] else "Показать")
+        visible = self.layers[index].visible
+        self.layers[index].visible = not visible
+        self.layer_changed(index)
+        self.visible_checkbox.setText("Скрыть" if self.layers[index].visible else "Показать")
         self.canvas.update()
-        self.add_to_history()
+        self.add_to_history(ChangeLayerCommand("Видимость", index, {'visible': visible}, {'visible': not visible}))
 
     def delete_layer(self):
         """Удаление выбранного слоя"""
@@ -1658,8 +4038,7 @@ class PostcardEditor(QMainWindow):
 
         index = self.canvas.current_item
         if 0 <= index < len(self.layers):  # Проверка на корректность индекса
-            self.layers.pop(index)
-            self.layer_list.takeItem(index)
+            layer = self.remove_layer(index)
 
             # Обновляем текущий выбранный элемент
             if self.layers:
@@ -1667,53 +4046,63 @@ class PostcardEditor(QMainWindow):
                 self.layer_list.setCurrentRow(new_index)
                 self.canvas.current_item = new_index
             else:
-                self.layer_list.clear()
                 self.canvas.current_item = None
 
             if hasattr(self.canvas, 'text_edit_widget') and self.canvas.text_edit_widget:
                 self.canvas.text_edit_widget.hide()
             self.canvas.editing_text = None
             self.canvas.update()
-            self.add_to_history()
+            self.add_to_history(DeleteLayerCommand(index, layer))
 
     def update_text_layer(self):
         """Обновление текстового слоя при изменении текста"""
-        if self.canvas.current_item is None or self.layers[self.canvas.current_item]['type'] != 'text':
+        if self.canvas.current_item is None or self.layers[self.canvas.current_item].type != 'text':
             return
 
         index = self.canvas.current_item
-        self.layers[index]['text'] = self.text_edit.toPlainText()
+        before = self.layers[index].text
+        text = self.text_edit.toPlainText()
+        if text == before:
+            return
 
-        # Обновление имени слоя
-        text = self.layers[index]['text']
-        self.layer_list.item(index).setText(f"Текст: {text[:15] + '...' if len(text) > 15 else text}")
+        old_bounds = self.canvas.layer_screen_bounds(index)
+        self.layers[index].text = text
+        self.layer_changed(index)
 
-        self.canvas.update()
+        # Набор текста сливается в одну запись истории, перерисовка - не чаще кадра экрана
+        self.add_to_history(ChangeLayerCommand("Текст", index, {'text': before}, {'text': text}, merge_kind='text'))
+        self.canvas.update_region(old_bounds, self.canvas.layer_screen_bounds(index))
 
     def change_text_alignment(self):
         """Изменение выравнивания текста"""
-        if self.canvas.current_item is None or self.layers[self.canvas.current_item]['type'] != 'text':
+        if self.canvas.current_item is None or self.layers[self.canvas.current_item].type != 'text':
             return
 
         index = self.alignment_combo.currentIndex()
-        alignment = Qt.AlignLeft | Qt.AlignTop
+        alignment = int(Qt.AlignLeft | Qt.AlignTop)
 
         if index == 1:
-            alignment = Qt.AlignHCenter | Qt.AlignTop
+            alignment = int(Qt.AlignHCenter | Qt.AlignTop)
         elif index == 2:
-            alignment = Qt.AlignRight | Qt.AlignTop
+            alignment = int(Qt.AlignRight | Qt.AlignTop)
 
-        self.layers[self.canvas.current_item]['alignment'] = alignment
+        layer = self.layers[self.canvas.current_item]
+        if layer.alignment == alignment:
+            return
+        before = int(layer.alignment)
+        layer.alignment = alignment
+        self.layer_changed(self.canvas.current_item)
         self.canvas.update()
-        self.add_to_history()
+        self.add_to_history(ChangeLayerCommand("Выравнивание", self.canvas.current_item,
+                                               {'alignment': before}, {'alignment': alignment}))
 
     def change_font(self):
         """Изменение шрифта текста"""
-        if self.canvas.current_item is None or self.layers[self.canvas.current_item]['type'] != 'text':
+        if self.canvas.current_item is None or self.layers[self.canvas.current_item].type != 'text':
             return
 
         current_layer = self.layers[self.canvas.current_item]
-        current_font = QFont(current_layer['font'], current_layer['font_size'])
+        current_font = QFont(current_layer.font, current_layer.font_size)
 
         font, ok = QFontDialog.getFont(current_font, self, "Выберите шрифт")
         if ok:
@@ -1722,31 +4111,57 @@ class PostcardEditor(QMainWindow):
 
             if font.family() in available_families:
                 index = self.canvas.current_item
-                self.layers[index]['font'] = font.family()
-                self.layers[index]['font_size'] = font.pointSize()
+                before = {'font': self.layers[index].font, 'font_size': self.layers[index].font_size}
+                self.layers[index].font = font.family()
+                self.layers[index].font_size = font.pointSize()
+                self.layer_changed(index)
 
                 if self.canvas.editing_text == index:
                     self.canvas.text_edit.setFont(font)
 
                 self.canvas.update()
-                self.add_to_history()
+                self.add_to_history(ChangeLayerCommand("Шрифт", index, before,
+                                                       {'font': font.family(), 'font_size': font.pointSize()}))
             else:
                 QMessageBox.warning(self, "Ошибка", "Выбранный шрифт недоступен")
 
     def change_color(self):
         """Изменение цвета текста"""
-        if self.canvas.current_item is None or self.layers[self.canvas.current_item]['type'] != 'text':
+        if self.canvas.current_item is None or self.layers[self.canvas.current_item].type != 'text':
             return
 
         color = QColorDialog.getColor()
         if color.isValid():
             index = self.canvas.current_item
-            self.layers[index]['color'] = color.name()
+            before = self.layers[index].color
+            self.layers[index].color = color.name()
+            self.layer_changed(index)
             self.canvas.update()
-            self.add_to_history()
+            self.add_to_history(ChangeLayerCommand("Цвет", index, {'color': before}, {'color': color.name()}))
 
     def save_project(self):
-        """Сохранение проекта в файл"""
+        """Сохранение проекта: изменения уже записаны в журнал, в него дописывается отметка сохранения"""
+        if self.journal is not None:
+            try:
+                # Правки, сделанные во время записи снимка, сохраняются и в его журнале
+                for journal in (self.journal, self.pending_journal):
+                    if journal is not None and not journal.failed:
+                        journal.save_point()
+            except OSError as e:
+                self.journal_failed(journal, e)
+            else:
+                self.saved_revision = self.revision
+                self.statusBar().showMessage(f"Проект сохранен в {self.project_path}", 5000)
+                return
+
+        # Журнала нет или запись в него не удалась: проект записывается целиком
+        if self.project_path is not None and zipfile.is_zipfile(self.project_path):
+            self.write_snapshot(self.project_path)
+        else:
+            self.save_project_as()
+
+    def save_project_as(self):
+        """Сохранение проекта в новый файл"""
         if not self.layers:
             QMessageBox.warning(self, "Предупреждение", "Нет проекта для сохранения.")
             return
@@ -1759,56 +4174,191 @@ class PostcardEditor(QMainWindow):
         if not file_path.endswith('.pep'):
             file_path += '.pep'
 
-        # Подготовка данных проекта
-        project_data = {
-            'canvas_size': {
-                'width': self.canvas.minimumSize().width(),
-                'height': self.canvas.minimumSize().height()
-            },
-            'layers': []
-        }
+        self.write_snapshot(file_path)
 
-        # Обработка слоев
-        for layer in self.layers:
-            layer_data = {
-                'type': layer['type'],
-                'rect': {
-                    'x': layer['rect'].x(),
-                    'y': layer['rect'].y(),
-                    'width': layer['rect'].width(),
-                    'height': layer['rect'].height()
-                },
-                'visible': layer['visible'],
-                'rotation': layer['rotation']
-            }
-
-            if layer['type'] == 'image':
-                # Чтение данных изображения в base64
-                with open(layer['path'], 'rb') as f:
-                    image_data = f.read()
-                import base64
-                layer_data['image_data'] = base64.b64encode(image_data).decode('utf-8')
-                layer_data['image_format'] = os.path.splitext(layer['path'])[1][1:].lower()
-
-            elif layer['type'] == 'text':
-                layer_data.update({
-                    'text': layer['text'],
-                    'font': layer['font'],
-                    'font_size': layer['font_size'],
-                    'color': layer['color'],
-                    'alignment': int(layer['alignment'])
-                })
-
-            project_data['layers'].append(layer_data)
-
-        # Сохранение файла проекта
+    def compact_project(self):
+        """Перезапись проекта целиком с очисткой журнала правок"""
+        if self.project_path is None or not zipfile.is_zipfile(self.project_path):
+            self.save_project_as()
+            return
+        self.write_snapshot(self.project_path)
+
+    def write_snapshot(self, file_path):
+        """Полная запись проекта в фоне; журнал к новому снимку ведется уже во время записи"""
+        if self.pending_journal is not None:
+            self.statusBar().showMessage("Дождитесь окончания текущего сохранения", 5000)
+            return
+
+        # Загрузку изображений ждать не нужно: еще не загруженные копируются в снимок из прежнего файла
+        # Правки, сделанные во время записи, попадают и в прежний журнал, и в новый
+        token = os.urandom(16).hex()
+        assets = {layer.asset for layer in self.layers
+                  if layer.type == 'image' and (layer.path is not None or layer.source is not None)}
         try:
-            with open(file_path, 'w') as f:
-                json.dump(project_data, f, indent=4)
-        except Exception as e:
+            self.pending_journal = ProjectJournal.create(file_path + '.journal.new', token, assets)
+        except OSError as e:
             QMessageBox.warning(self, "Предупреждение", f"Не удалось сохранить проект: {str(e)}")
             return
 
+        # Запись файла проекта в фоне, редактирование можно продолжать
+        self.project_saver.save(file_path, self.canvas.canvas_size, self.layers,
+                                ('save', self.revision, self.pending_journal), token)
+        self.statusBar().showMessage(f"Сохранение проекта в {file_path}...")
+
+    def autosave(self):
+        """Автосохранение несохраненных изменений рядом с файлом проекта"""
+        if (not self.layers or self.journal is not None or self.autosave_path() is None
+                or self.revision in (self.saved_revision, self.autosaved_revision)):
+            return
+        if self.project_saver.is_busy() or (self.image_loader is not None and not self.image_loader.is_done()):
+            # Автосохранение откладывается, а не пропускается до следующего интервала
+            self.autosave_retry_timer.start(self.AUTOSAVE_RETRY_SEC * 1000)
+            return
+        self.project_saver.save(self.autosave_path(), self.canvas.canvas_size, self.layers,
+                                ('autosave', self.revision, None))
+
+    def autosave_path(self):
+        """Файл автосохранения: рядом с проектом или файл сеанса для нового документа"""
+        if self.project_path is not None:
+            return self.project_path + '.autosave'
+        return self.session_autosave
+
+    def init_autosave_session(self):
+        """Файл автосохранения нового документа, свой у каждого запущенного редактора.
+
+        Файл сеанса защищен блокировкой (QLockFile): блокировка процесса,
+        который завершился аварийно, считается устаревшей, и его
+        автосохранение предлагается восстановить при следующем запуске.
+        """
+        self.session_autosave = None
+        self.session_lock = None
+        directory = os.path.join(tempfile.gettempdir(), self.AUTOSAVE_DIRECTORY)
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            print(f"Ошибка автосохранения: {str(e)}")
+            return
+        path = os.path.join(directory, f"{os.getpid()}_{os.urandom(4).hex()}.pep")
+        lock = QLockFile(path + '.lock')
+        if lock.tryLock(0):
+            self.session_autosave = path
+            self.session_lock = lock
+
+    def orphaned_autosaves(self):
+        """Автосохранения новых документов от сеансов, завершившихся аварийно (новые сначала)"""
+        if self.session_autosave is None:
+            return []
+        directory = os.path.dirname(self.session_autosave)
+        orphans = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not name.endswith('.pep') or path == self.session_autosave:
+                continue
+            lock = QLockFile(path + '.lock')
+            if lock.tryLock(0):
+                lock.unlock()
+                orphans.append(path)
+        return sorted(orphans, key=os.path.getmtime, reverse=True)
+
+    def recover_session_autosave(self):
+        """Предложение восстановить новый документ, не сохраненный до аварийного завершения"""
+        orphans = self.orphaned_autosaves()
+        if not orphans:
+            return
+        path = orphans[0]
+        answer = QMessageBox.question(
+            self, "Восстановление",
+            f"Найден несохраненный документ от {self.format_mtime(path)}: программа была закрыта "
+            f"аварийно. Восстановить его?", QMessageBox.Yes | QMessageBox.No)
+        if answer != QMessageBox.Yes:
+            self.remove_file(path)
+            return
+        # Файл переходит к этому сеансу, чтобы не предлагаться повторно
+        try:
+            os.replace(path, self.session_autosave)
+        except OSError as e:
+            QMessageBox.warning(self, "Предупреждение", f"Не удалось восстановить документ: {str(e)}")
+            return
+        self.open_project_file(None, self.session_autosave)
+
+    def discard_autosave(self):
+        """Удаление автосохранения документа, изменения которого больше не нужны или уже сохранены"""
+        path = self.autosave_path()
+        if path is not None:
+            self.remove_file(path)
+        self.autosaved_revision = -1
+
+    @staticmethod
+    def same_path(first, second):
+        return os.path.normcase(os.path.abspath(first)) == os.path.normcase(os.path.abspath(second))
+
+    @staticmethod
+    def remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def format_mtime(path):
+        return time.strftime("%d.%m.%Y %H:%M", time.localtime(os.path.getmtime(path)))
+
+    def show_save_progress(self, file_path, done, total):
+        if file_path != self.autosave_path():
+            self.statusBar().showMessage(f"Сохранение проекта в {file_path}: {done} из {total}")
+
+    def project_saved(self, file_path, error, tag):
+        """Завершение фонового сохранения"""
+        kind, revision, journal = tag
+        if kind == 'autosave':
+            if file_path != self.autosave_path():
+                # Документ сменился или был сохранен, пока шла запись
+                self.remove_file(file_path)
+            elif error is None:
+                self.autosaved_revision = revision
+            else:
+                print(f"Ошибка автосохранения: {str(error)}")
+            return
+
+        current = journal is self.pending_journal  # Документ не сменился во время записи
+        if current:
+            self.pending_journal = None
+        if error is not None:
+            journal.discard()
+            QMessageBox.warning(self, "Предупреждение", f"Не удалось сохранить проект: {str(error)}")
+            return
+        if journal.failed:
+            # Журнал нового снимка неполон: снимок остается без журнала, прежний журнал файла устарел
+            journal.discard()
+            journal = None
+            self.remove_file(file_path + '.journal')
+        else:
+            # Снимок на месте: его журнал заменяет прежний. Открытый файл
+            # прежнего журнала не дает заменить его в Windows, поэтому он
+            # закрывается заранее (его действия уже есть в новом снимке)
+            if self.journal is not None and self.same_path(self.journal.path, file_path + '.journal'):
+                self.journal.close()
+                self.journal = None
+            try:
+                journal.move(file_path + '.journal')
+            except OSError as e:
+                journal.discard()
+                self.journal_failed(journal, e)
+                journal = None
+        if not current:
+            if journal is not None:
+                journal.close()
+            return
+
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = journal
+        # Автосохранения устарели (и прежнее, и рядом с новым файлом): все изменения уже в проекте
+        self.discard_autosave()
+        self.remove_file(file_path + '.autosave')
+        self.project_path = file_path
+        # Проект мог быть сохранен отметкой в журнале, пока записывался снимок
+        self.saved_revision = max(self.saved_revision, revision)
         self.statusBar().showMessage(f"Проект сохранен в {file_path}", 5000)
 
     def open_project(self):
@@ -1818,70 +4368,266 @@ class PostcardEditor(QMainWindow):
         if not file_path:
             return
 
-        # Чтение файла проекта
+        # Автосохранение новее проекта - несохраненные изменения прошлого сеанса
+        autosave = file_path + '.autosave'
         try:
-            with open(file_path, 'r') as f:
-                project_data = json.load(f)
+            recoverable = os.path.getmtime(autosave) > os.path.getmtime(file_path)
+        except OSError:
+            recoverable = False
+        if recoverable:
+            answer = QMessageBox.question(
+                self, "Восстановление",
+                f"Для проекта найдено автосохранение от {self.format_mtime(autosave)} с несохраненными "
+                f"изменениями. Восстановить их?", QMessageBox.Yes | QMessageBox.No)
+            if answer == QMessageBox.Yes:
+                self.open_project_file(file_path, autosave)
+                return
+            self.remove_file(autosave)
+
+        self.open_project_file(file_path)
+
+    def open_project_file(self, file_path, source_path=None):
+        """Открытие проекта file_path; source_path - автосохранение, из которого он восстанавливается"""
+        recovered = source_path is not None
+        if source_path is None:
+            source_path = file_path
+
+        # Чтение манифеста проекта (изображения извлекаются по одному)
+        try:
+            reader = ProjectReader(source_path)
         except Exception as e:
             QMessageBox.warning(self, "Предупреждение", f"Не удалось открыть проект: {str(e)}")
             return
 
-        # Очистка текущего проекта
-        self.layers = []
-        self.layer_list.clear()
-        self.history = []
-        self.current_history_index = -1
+        layers = []
+        loads = []  # (слой, ключ загрузки, расширение, функция извлечения)
+        self.image_failures = []
+
+        with reader:
+            # Установка размеров холста
+            self.canvas.set_canvas_size(reader.canvas_size)
+
+            # Слои создаются сразу, изображения загружаются в фоне
+            for layer_data in reader.layers:
+                layer = Layer.from_dict(layer_data)
+
+                # Ресурс, уже извлеченный из этого или другого проекта, не извлекается повторно
+                write = reader.image_source(layer_data) if layer.type == 'image' else None
+                if write is not None and layer.asset not in asset_store:
+                    key = layer_data.get('image') or f"layer:{len(layers)}"
+                    # Пока изображение не загружено, сохранение копирует его из этого файла
+                    layer.source = (f".{layer_data['image_format']}", write)
+                    loads.append((layer, key, layer.source[0], write))
+                elif layer.type == 'image' and layer.asset not in asset_store:
+                    self.image_failures.append(f"{layer.name}: изображения нет в файле проекта")
+                layers.append(layer)
+
+        # Замена текущего проекта
+        self.cancel_image_loading()
+        self.close_journal()
+        self.set_layers(layers)
+        if self.layers:
+            self.layer_list.setCurrentRow(0)
+            self.canvas.current_item = 0
 
-        # Установка размеров холста
-        canvas_size = project_data['canvas_size']
-        self.canvas.setMinimumSize(canvas_size['width'], canvas_size['height'])
+        self.canvas.update()
+        self.reset_history("Открытие проекта")
+
+        # Правки, сделанные после записи снимка, восстанавливаются из журнала
+        if reader.journal is not None and not recovered:
+            assets = {layer.asset for layer in layers if layer.type == 'image'}
+            images, recovered = self.replay_journal(file_path, reader.journal, assets)
+            for asset, extension, source in images:
+                if asset in asset_store:
+                    continue
+                # Изображения из журнала загружаются в фоне вместе с изображениями снимка
+                key = f"journal:{asset}"
+                waiting = [layer for layer in self.layers if layer.type == 'image' and layer.asset == asset]
+                for layer in waiting:
+                    layer.source = (extension, source)
+                    loads.append((layer, key, extension, source))
+                if not waiting:
+                    loads.append((None, key, extension, source))
+
+        self.start_image_loading(loads)
+        if self.autosave_path() != source_path:
+            self.discard_autosave()
+        self.project_path = file_path
+        if recovered:
+            # Восстановленные изменения не записаны в проект (но уже лежат в автосохранении или журнале)
+            self.saved_revision = -1
+            self.autosaved_revision = self.revision
+        else:
+            self.saved_revision = self.revision
+        self.show_loading_status()
 
-        # Загрузка слоев
-        for layer_data in project_data['layers']:
-            layer = {
-                'type': layer_data['type'],
-                'rect': QRect(layer_data['rect']['x'], layer_data['rect']['y'],
-                              layer_data['rect']['width'], layer_data['rect']['height']),
-                'visible': layer_data['visible'],
-                'rotation': layer_data['rotation']
-            }
+    def start_image_loading(self, loads):
+        """Фоновая загрузка изображений: сначала видимые в окне слои, затем остальные сверху вниз"""
+        if not loads:
+            return
 
-            if layer_data['type'] == 'image':
-                try:
-                    import base64
-                    import tempfile
+        on_screen = {id(self.layers[i]) for i in self.canvas.layers_in_screen_rect(self.canvas.viewport_rect())}
+        # Слои, удаленные при воспроизведении журнала, загружаются последними (их можно вернуть отменой)
+        positions = {id(layer): i for i, layer in enumerate(self.layers)}
+        loads.sort(key=lambda load: (load[0] is None or not load[0].visible, id(load[0]) not in on_screen,
+                                     positions.get(id(load[0]), len(positions))))
+
+        self.image_loader = ProjectImageLoader(self)
+        self.image_loader.image_loaded.connect(self.image_loaded)
+        self.image_loader.image_failed.connect(self.image_failed)
+        for rank, (layer, key, extension, write) in enumerate(loads):
+            self.image_loader.add(key, extension, write, layer, len(loads) - rank)
+
+    def cancel_image_loading(self):
+        """Остановка фоновой загрузки изображений предыдущего проекта"""
+        if self.image_loader is not None:
+            self.image_loader.cancel()
+            self.image_loader.deleteLater()
+            self.image_loader = None
+
+    def image_loaded(self, asset, layers):
+        """Изображение загружено в фоне: слои, ожидавшие его, перерисовываются"""
+        positions = {id(layer): i for i, layer in enumerate(self.layers)}
+        for layer in layers:
+            i = positions.get(id(layer))
+            layer.source = None
+            # Хэш из манифеста мог не совпасть с содержимым (в старом формате его нет)
+            if layer.asset != asset:
+                if i is not None:
+                    asset_store.release(layer.asset)
+                    asset_store.retain(asset)
+                layer.asset = asset
+            if i is not None:
+                self.layer_changed(i)
+            else:
+                layer.touch()
 
-                    image_data = base64.b64decode(layer_data['image_data'])
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=f".{layer_data['image_format']}") as tmp:
-                        tmp.write(image_data)
-                        tmp_path = tmp.name
+        # Копии слоев с тем же изображением, восстановленные из журнала правок
+        waiting = {id(layer) for layer in layers}
+        for i, layer in enumerate(self.layers):
+            if layer.asset == asset and id(layer) not in waiting:
+                self.layer_changed(i)
+        self.canvas.update()
+        self.show_loading_status()
+
+    def image_failed(self, key, layers, error):
+        """Изображение не удалось загрузить: слой остается с заглушкой, а при сохранении
+        его изображение копируется из прежнего файла как есть"""
+        self.image_failures.append(f"{layers[0].name if layers else key}: {str(error)}")
+        if not layers:
+            self.show_loading_status()
+            return
 
-                    layer['path'] = tmp_path
-                    self.layers.append(layer)
-                    self.layer_list.addItem(f"Изображение: {os.path.basename(tmp_path)}")
+        # Копии слоев с тем же изображением, восстановленные из журнала правок
+        asset, source = layers[0].asset, layers[0].source
+        for layer in self.layers:
+            if asset is not None and layer.type == 'image' and layer.asset == asset and layer.source is None:
+                layer.source = source
+        self.show_loading_status()
+
+    def replay_journal(self, file_path, token, assets):
+        """Воспроизведение журнала правок поверх снимка и продолжение записи в него.
+
+        Документ - это снимок и действия до последнего сохранения. Действия
+        после него (программа закрыта без сохранения или аварийно) применяются,
+        только если пользователь согласится их восстановить, иначе
+        отбрасываются. Возвращает (изображения из журнала, которые еще
+        предстоит загрузить: хэш, расширение, источник; восстановлены ли
+        несохраненные действия).
+        """
+        path = file_path + '.journal'
+        # После сбоя между заменой снимка и журнала актуальным остается журнал .new
+        for candidate in (path, path + '.new'):
+            result = ProjectJournal.read(candidate, token)
+            if result is not None:
+                break
+
+        images = []
+        recovered = False
+        try:
+            if result is None:
+                self.journal = ProjectJournal.create(path, token, assets)
+                return images, recovered
+
+            # Источники изображений ссылаются на смещения в журнале под его окончательным именем
+            if candidate != path:
+                os.replace(candidate, path)
+            records, end = result
+            saved, unsaved = ProjectJournal.split_saved(records)
+            assets = set(assets)
+            applied = 0
+            for part in (saved, unsaved):
+                if part is unsaved:
+                    count = ProjectJournal.count_actions(unsaved)
+                    if not count or QMessageBox.question(
+                            self, "Восстановление",
+                            f"После последнего сохранения проекта в журнале правок записано действий: {count} "
+                            f"(программа была закрыта без сохранения или аварийно). Восстановить их?",
+                            QMessageBox.Yes | QMessageBox.No) != QMessageBox.Yes:
+                        # Несохраненный хвост журнала отбрасывается
+                        break
+                    recovered = True
+                try:
+                    for op, command, record_end in ProjectJournal.actions(path, part, assets, images):
+                        if command is not None:
+                            command.redo(self)
+                            self.add_to_history(command, merge=op == 'merge')
+                            applied += 1
+                        end = record_end
                 except Exception as e:
-                    print(f"Ошибка загрузки изображения: {str(e)}")
-                    continue
+                    # Запись, которую не удалось применить, и все после нее отбрасываются
+                    print(f"Ошибка журнала правок: {str(e)}")
+                    break
+
+            self.journal = ProjectJournal.resume(path, token, assets, end)
+            if applied:
+                self.refresh_after_history(self.history[self.current_history_index].index)
+        except OSError as e:
+            print(f"Ошибка журнала правок: {str(e)}")
+        return images, recovered
+
+    def journal_record(self, op, command):
+        """Дописывание действия в журнал правок (и в журнал записываемого снимка)"""
+        for journal in (self.journal, self.pending_journal):
+            if journal is not None and not journal.failed:
+                try:
+                    journal.record(op, command)
+                except OSError as e:
+                    self.journal_failed(journal, e)
 
-            elif layer_data['type'] == 'text':
-                layer.update({
-                    'text': layer_data['text'],
-                    'font': layer_data['font'],
-                    'font_size': layer_data['font_size'],
-                    'color': layer_data['color'],
-                    'alignment': layer_data.get('alignment', Qt.AlignLeft | Qt.AlignTop)
-                })
-                self.layers.append(layer)
-                text = layer['text']
-                self.layer_list.addItem(f"Текст: {text[:15] + '...' if len(text) > 15 else text}")
+    def journal_failed(self, journal, error):
+        """Запись в журнал не удалась: он больше не ведется, а проект при сохранении записывается целиком.
 
-        if self.layers:
-            self.layer_list.setCurrentRow(0)
-            self.canvas.current_item = 0
-
-        self.canvas.update()
-        self.add_to_history()
-        self.statusBar().showMessage(f"Проект загружен из {file_path}", 5000)
+        Журнал записываемого снимка остается в pending_journal с отметкой
+        failed и удаляется по завершении записи (project_saved).
+        """
+        if journal is self.journal:
+            self.journal.close()
+            self.journal = None
+        QMessageBox.warning(self, "Предупреждение",
+                            f"Не удалось записать журнал правок: {str(error)}\n"
+                            f"Правки больше не записываются в журнал, при сохранении проект будет записан целиком.")
+
+    def close_journal(self):
+        """Прекращение записи журнала при смене документа"""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        # Записываемый снимок получит свой журнал, но новые правки в него уже не попадут
+        self.pending_journal = None
+
+    def show_loading_status(self):
+        loader = self.image_loader
+        if loader is not None and not loader.is_done():
+            self.statusBar().showMessage(f"Загрузка изображений: осталось {len(loader.pending)}")
+        elif self.image_failures:
+            failures, self.image_failures = self.image_failures, []
+            self.statusBar().showMessage(f"Проект загружен из {self.project_path} с ошибками", 5000)
+            QMessageBox.warning(self, "Предупреждение",
+                                "Не удалось загрузить изображения (на холсте вместо них заглушки, "
+                                "в файле проекта они сохранятся без изменений):\n" + "\n".join(failures))
+        else:
+            self.statusBar().showMessage(f"Проект загружен из {self.project_path or 'автосохранения'}", 5000)
 
     def export_jpg(self):
         """Экспорт проекта в JPG с настройками"""
@@ -1889,6 +4635,10 @@ class PostcardEditor(QMainWindow):
             QMessageBox.warning(self, "Предупреждение", "Нет проекта для экспорта.")
             return
 
+        if self.image_exporter.is_busy():
+            self.statusBar().showMessage("Дождитесь окончания текущего экспорта", 5000)
+            return
+
         # Получаем параметры экспорта от пользователя
         dialog = ExportJpgDialog(self)
         if dialog.exec_() != QDialog.Accepted:
@@ -1904,166 +4654,225 @@ class PostcardEditor(QMainWindow):
             file_path += '.jpg'
 
         # Оригинальные размеры холста
-        original_width = self.canvas.minimumSize().width()
-        original_height = self.canvas.minimumSize().height()
+        original_width = self.canvas.canvas_size.width()
+        original_height = self.canvas.canvas_size.height()
 
         # Получаем целевой размер
         target_width, target_height = dialog.get_target_size((original_width, original_height))
         quality = dialog.get_quality()
+        max_bytes = dialog.get_max_bytes()
+        subsamplings = dialog.get_subsamplings()
+
+        # Снимок документа: редактирование можно продолжать, пока идет отрисовка
+        canvas_size = QSize(self.canvas.canvas_size)
+        layers = [layer.copy() for layer in self.layers]
+        images = export_sources(layers)
+
+        def render(progress):
+            return render_export(canvas_size, layers, (target_width, target_height), images, progress,
+                                 os.path.dirname(os.path.abspath(file_path)))
+
+        def encode(pixels, path, progress):
+            if max_bytes is None:
+                save_jpeg(pixels, path, quality)
+                return f"размер: {target_width}x{target_height}, качество: {quality}%"
+
+            # Подбор качества по готовому изображению, без повторной отрисовки
+            data, fitted_quality, subsampling = fit_jpeg(pixels, max_bytes, quality, subsamplings, progress)
+            with open(path, 'wb') as f:
+                f.write(data)
+            return (f"размер: {target_width}x{target_height}, качество: {fitted_quality}%, "
+                    f"субдискретизация: {JPEG_SUBSAMPLING_NAMES[subsampling]}, "
+                    f"файл: {len(data) // 1024} КБ из {max_bytes // 1024} КБ")
+
+        # Отрисовка и запись в фоновом потоке
+        self.image_exporter.export(file_path, render, encode, layers)
+        self.export_progress.setRange(0, len(layers))
+        self.export_progress.setValue(0)
+        self.export_progress.setVisible(True)
+        self.export_cancel_button.setVisible(True)
+        self.statusBar().showMessage(f"Экспорт в {file_path}...")
+
+    def show_export_progress(self, done, total):
+        self.export_progress.setRange(0, total)
+        self.export_progress.setValue(done)
+
+    def cancel_export(self):
+        self.image_exporter.cancel()
+        self.statusBar().showMessage("Отмена экспорта...")
+
+    def image_exported(self, file_path, result, error):
+        """Завершение фонового экспорта"""
+        self.export_progress.setVisible(False)
+        self.export_cancel_button.setVisible(False)
+        if isinstance(error, ExportCancelled):
+            self.statusBar().showMessage("Экспорт отменен", 5000)
+        elif error is not None:
+            QMessageBox.warning(self, "Предупреждение", f"Не удалось экспортировать изображение: {str(error)}")
+        else:
+            self.statusBar().showMessage(f"Изображение экспортировано в {file_path} ({result})", 5000)
+
+    def reset_history(self, label):
+        """Начало новой истории с текущего состояния документа"""
+        self.history_model.beginResetModel()
+        self.history = [HistoryCommand(label)]
+        self.history_model.endResetModel()
+        self.current_history_index = 0
+        self.history_bytes = 0
+        self.history_spill.clear()
+        self.history_spill_start = 0
+        self.update_history_list()
+        self.revision += 1
 
-        # Создаем изображение с целевыми размерами
-        pixmap = QPixmap(target_width, target_height)
-        pixmap.fill(Qt.white)
-
-        # Создаем QPainter для рисования
-        painter = QPainter(pixmap)
-
-        # Масштабирующий коэффициент
-        scale_x = target_width / original_width
-        scale_y = target_height / original_height
-
-        # Отрисовка всех видимых слоев с учетом масштабирования (в обратном порядке)
-        for layer in reversed(self.layers):
-            if not layer['visible']:
-                continue
-
-            if layer['type'] == 'image':
-                # Загрузка изображения
-                image = QImage(layer['path'])
-                if image.isNull():
-                    continue
-
-                # Применение трансформаций с учетом масштабирования
-                rect = QRect(
-                    int(layer['rect'].x() * scale_x),
-                    int(layer['rect'].y() * scale_y),
-                    int(layer['rect'].width() * scale_x),
-                    int(layer['rect'].height() * scale_y)
-                )
-
-                transform = QTransform()
-                transform.translate(rect.x() + rect.width() / 2,
-                                    rect.y() + rect.height() / 2)
-                transform.rotate(layer['rotation'])
-                transform.translate(-rect.width() / 2, -rect.height() / 2)
-
-                painter.save()
-                painter.setTransform(transform)
-                painter.drawImage(QRect(0, 0, rect.width(), rect.height()),
-                                  image,
-                                  QRect(0, 0, image.width(), image.height()))
-                painter.restore()
-
-            elif layer['type'] == 'text':
-                painter.save()
-                font = QFont(layer['font'], int(layer['font_size'] * min(scale_x, scale_y)))
-                painter.setFont(font)
-                painter.setPen(QColor(layer['color']))
-
-                rect = QRect(
-                    int(layer['rect'].x() * scale_x),
-                    int(layer['rect'].y() * scale_y),
-                    int(layer['rect'].width() * scale_x),
-                    int(layer['rect'].height() * scale_y)
-                )
-
-                if layer['rotation'] != 0:
-                    painter.translate(rect.center())
-                    painter.rotate(layer['rotation'])
-                    painter.translate(-rect.width() / 2, -rect.height() / 2)
-                    painter.drawText(QRect(0, 0, rect.width(), rect.height()),
-                                     layer['alignment'],
-                                     layer['text'])
-                else:
-                    painter.drawText(rect, layer['alignment'], layer['text'])
-                painter.restore()
+        # Без прежней истории ресурсы удаленных слоев больше не понадобятся
+        asset_store.purge()
 
-        painter.end()
+    def add_to_history(self, command, merge=None):
+        """Добавление выполненного действия в историю.
 
-        # Сохранение в файл
-        if not pixmap.save(file_path, "JPEG", quality=quality):
-            QMessageBox.warning(self, "Предупреждение", "Не удалось сохранить изображение")
-        else:
-            self.statusBar().showMessage(
-                f"Изображение экспортировано в {file_path} (размер: {target_width}x{target_height}, качество: {quality}%)",
-                5000)
+        merge - слить ли действие с последней записью: None - по ключу и
+        интервалу HISTORY_MERGE_WINDOW, True/False - как при записи журнала,
+        который воспроизводится.
+        """
+        command.nbytes = len(pickle.dumps(command, pickle.HIGHEST_PROTOCOL))
+
+        # Быстрые однотипные правки одного слоя объединяются в одну запись
+        if (merge is not False and command.merge_key is not None and self.history
+                and self.current_history_index == len(self.history) - 1
+                and self.history[-1].merge_key == command.merge_key
+                and (merge or command.timestamp - self.history[-1].timestamp <= self.HISTORY_MERGE_WINDOW)
+                and self.history[-1].merge(command)):
+            # Слитая запись измеряется заново: ее размер - итоговое состояние, а не сумма правок
+            merged = self.history[-1]
+            self.journal_record('merge', merged)
+            nbytes = len(pickle.dumps(merged, pickle.HIGHEST_PROTOCOL))
+            self.history_bytes += nbytes - merged.nbytes
+            merged.nbytes = nbytes
+            self.revision += 1
+            self.trim_history()
+            return
 
-    def add_to_history(self):
-        """Добавление текущего состояния в историю"""
+        self.journal_record('do', command)
         if self.current_history_index < len(self.history) - 1:
-            self.history = self.history[:self.current_history_index + 1]
-
-        # Добавление текущего состояния
-        state = {
-            'layers': [layer.copy() for layer in self.layers],
-            'canvas_size': (self.canvas.minimumSize().width(), self.canvas.minimumSize().height())
-        }
-
-        for i, layer in enumerate(state['layers']):
-            if layer['type'] == 'image':
-                state['layers'][i]['rect'] = QRect(layer['rect'])
-            elif layer['type'] == 'text':
-                state['layers'][i]['rect'] = QRect(layer['rect'])
+            self.drop_history(self.current_history_index + 1, len(self.history))
 
-        self.history.append(state)
+        row = len(self.history)
+        self.history_model.beginInsertRows(QModelIndex(), row, row)
+        self.history.append(command)
+        self.history_model.endInsertRows()
+        self.history_bytes += command.nbytes
         self.current_history_index = len(self.history) - 1
+        self.revision += 1
 
-        # Ограничение размера истории
-        if len(self.history) > 50:
-            self.history.pop(0)
+        self.trim_history()
+        self.update_history_list()
+
+    def drop_history(self, start, end):
+        """Удаление записей истории в диапазоне [start, end)"""
+        if start >= end:
+            return
+        for command in self.history[start:end]:
+            if isinstance(command, SpilledCommand):
+                self.history_spill.forget(command)
+            else:
+                self.history_bytes -= command.nbytes
+        self.history_model.beginRemoveRows(QModelIndex(), start, end - 1)
+        del self.history[start:end]
+        self.history_model.endRemoveRows()
+        if self.history_spill_start > start:
+            self.history_spill_start = max(start, self.history_spill_start - (end - start))
+        if start == 0:
+            self.history_model.rows_renumbered()
+
+    def trim_history(self):
+        """Выгрузка старых записей на диск при превышении бюджета памяти"""
+        # Просмотр начинается с первой невыгруженной записи, а не с начала истории
+        index = self.history_spill_start
+        first_kept = None  # Первая просмотренная запись, оставшаяся в памяти (текущая)
+        while self.history_bytes > self.history_memory_budget and index < len(self.history):
+            command = self.history[index]
+            if isinstance(command, SpilledCommand):
+                pass
+            elif index == self.current_history_index:
+                if first_kept is None:
+                    first_kept = index
+            else:
+                self.history[index] = self.history_spill.spill(command)
+                self.history_bytes -= command.nbytes
+            index += 1
+        self.history_spill_start = first_kept if first_kept is not None else index
+
+        # Самые старые записи удаляются только при переполнении временного файла
+        while (self.history_spill.disk_bytes > self.history_disk_budget
+               and self.current_history_index > 0):
+            self.drop_history(0, 1)
             self.current_history_index -= 1
 
-        self.update_history_list()
+    def history_command(self, index):
+        """Запись истории, при необходимости загруженная с диска"""
+        command = self.history[index]
+        if isinstance(command, SpilledCommand):
+            command = self.history_spill.load(command)
+            self.history[index] = command
+            self.history_spill_start = min(self.history_spill_start, index)
+            self.history_bytes += command.nbytes
+        return command
 
     def undo(self):
         """Отмена последнего действия"""
         if self.current_history_index <= 0:
             return
 
-        self.current_history_index -= 1
-        self.restore_from_history()
+        self.go_to_history(self.current_history_index - 1)
 
     def redo(self):
         """Повтор отмененного действия"""
         if self.current_history_index >= len(self.history) - 1:
             return
 
-        self.current_history_index += 1
-        self.restore_from_history()
+        self.go_to_history(self.current_history_index + 1)
 
-    def restore_from_history(self):
-        """Восстановление состояния из истории"""
-        if not self.history or self.current_history_index < 0:
+    def go_to_history(self, index):
+        """Переход к состоянию после действия с указанным индексом"""
+        if index < 0 or index >= len(self.history) or index == self.current_history_index:
             return
 
-        state = self.history[self.current_history_index]
+        selected = None
+        while self.current_history_index > index:
+            command = self.history_command(self.current_history_index)
+            command.undo(self)
+            self.journal_record('undo', command)
+            selected = command.index
+            self.current_history_index -= 1
+        while self.current_history_index < index:
+            self.current_history_index += 1
+            command = self.history_command(self.current_history_index)
+            command.redo(self)
+            self.journal_record('do', command)
+            selected = command.index
 
-        self.layers = [layer.copy() for layer in state['layers']]
-        for layer in self.layers:
-            if layer['type'] == 'image':
-                layer['rect'] = QRect(layer['rect'])
-            elif layer['type'] == 'text':
-                layer['rect'] = QRect(layer['rect'])
+        self.trim_history()
+        self.refresh_after_history(selected)
 
-        self.canvas.setMinimumSize(state['canvas_size'][0], state['canvas_size'][1])
-
-        # Обновление списка слоев
-        self.layer_list.clear()
-        for layer in self.layers:
-            if layer['type'] == 'image':
-                self.layer_list.addItem(f"Изображение: {os.path.basename(layer['path'])}")
-            elif layer['type'] == 'text':
-                text = layer['text']
-                self.layer_list.addItem(f"Текст: {text[:15] + '...' if len(text) > 15 else text}")
+    def refresh_after_history(self, selected=None):
+        """Обновление панелей и холста после отмены или повтора"""
+        self.canvas.editing_text = None
+        self.canvas.text_edit.setVisible(False)
 
         if self.layers:
-            self.layer_list.setCurrentRow(0)
-            self.canvas.current_item = 0
+            if selected is None or not 0 <= selected < len(self.layers):
+                selected = 0
+            self.layer_list.setCurrentRow(selected)
+            self.canvas.current_item = selected
+            # Панель свойств должна показывать восстановленный текст
+            self.layer_selection_changed()
+        else:
+            self.canvas.current_item = None
 
+        self.revision += 1
         self.canvas.update()
         self.update_history_list()
 
-
 if __name__ == "__main__":
     app = QApplication([])
     editor = PostcardEditor()
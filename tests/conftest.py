@@ -0,0 +1,56 @@
+"""Общие фикстуры тестов: Qt без экрана, QApplication и файлы изображений"""
+
+import os
+import sys
+
+# Отрисовка без экрана: задается до создания QApplication
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from PyQt5.QtCore import QSettings
+from PyQt5.QtGui import QColor, QImage
+from PyQt5.QtWidgets import QApplication, QMessageBox
+
+from postcard_editor import PostcardEditor, asset_store
+
+
+@pytest.fixture(scope='session', autouse=True)
+def qapp(tmp_path_factory):
+    # Настройки редактора пишутся во временный каталог, а не в настройки пользователя
+    QSettings.setPath(QSettings.NativeFormat, QSettings.UserScope, str(tmp_path_factory.mktemp('settings')))
+    QSettings.setPath(QSettings.IniFormat, QSettings.UserScope, str(tmp_path_factory.mktemp('settings')))
+    return QApplication.instance() or QApplication([])
+
+
+@pytest.fixture(autouse=True)
+def clean_asset_store():
+    yield
+    asset_store.purge()
+
+
+@pytest.fixture
+def make_image(tmp_path):
+    """Функция make_image(имя, ширина, высота) -> путь к PNG с узором (разным для разных имен)"""
+    def make_image(name='image.png', width=64, height=48):
+        image = QImage(width, height, QImage.Format_RGB32)
+        seed = sum(name.encode())
+        for y in range(height):
+            for x in range(width):
+                image.setPixel(x, y, QColor((x * 5 + seed) % 256, (y * 3) % 256, (x ^ y) % 256).rgb())
+        path = str(tmp_path / name)
+        image.save(path)
+        return path
+    return make_image
+
+
+@pytest.fixture
+def editor(monkeypatch):
+    """Окно редактора без диалогов: на вопросы отвечается "Нет", предупреждения собираются в editor.warnings"""
+    warnings = []
+    monkeypatch.setattr(QMessageBox, 'question', staticmethod(lambda *args, **kwargs: QMessageBox.No))
+    monkeypatch.setattr(QMessageBox, 'warning', staticmethod(lambda *args, **kwargs: warnings.append(args[2])))
+    editor = PostcardEditor()
+    editor.warnings = warnings
+    yield editor
+    editor.close()
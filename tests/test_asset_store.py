@@ -0,0 +1,98 @@
+"""Хранилище ресурсов: адресация по содержимому, счетчики ссылок и удаление временного каталога"""
+
+import hashlib
+import os
+import shutil
+
+import pytest
+from PyQt5.QtWidgets import QFileDialog
+
+from postcard_editor import AssetStore, asset_store
+
+
+def test_same_content_is_stored_once(make_image, tmp_path):
+    store = AssetStore()
+    path = make_image('photo.png')
+    copy = str(tmp_path / 'copy.PNG')
+    shutil.copyfile(path, copy)
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    asset = store.add_file(path)
+    assert asset == hashlib.sha256(data).hexdigest()
+    assert store.add_file(copy) == asset
+    assert store.add_stream(lambda target: target.write(data), '.png') == asset
+    assert store.path(asset) == os.path.join(os.path.dirname(store.path(asset)), asset + '.png')
+    # Повторы не оставляют во временном каталоге лишних файлов
+    assert os.listdir(os.path.dirname(store.path(asset))) == [asset + '.png']
+    with open(store.path(asset), 'rb') as f:
+        assert f.read() == data
+
+    other = store.add_file(make_image('other.png'))
+    assert other != asset and other in store
+    assert store.path('missing') is None
+    store.close()
+
+
+def test_failed_stream_leaves_no_file():
+    store = AssetStore()
+
+    def write(target):
+        target.write(b'partial')
+        raise OSError("Сбой чтения")
+
+    with pytest.raises(OSError):
+        store.add_stream(write, '.png')
+    assert os.listdir(store._directory) == []
+    store.close()
+
+
+def test_purge_keeps_referenced_assets():
+    store = AssetStore()
+    kept = store.add_stream(lambda target: target.write(b'kept'), '.jpg')
+    dropped = store.add_stream(lambda target: target.write(b'dropped'), '.jpg')
+    store.retain(kept)
+    store.retain(kept)
+    store.retain(dropped)
+    store.release(kept)
+    store.release(dropped)
+    store.release(None)
+    store.purge()
+    assert kept in store and dropped not in store
+    assert os.path.exists(store.path(kept))
+
+    store.release(kept)
+    store.purge()
+    assert kept not in store
+
+    directory = store._directory
+    store.close()
+    assert not os.path.exists(directory)
+    assert store.path(kept) is None
+
+
+def test_editor_keeps_assets_for_undo(editor, make_image, monkeypatch):
+    image_path = make_image('photo.png')
+    monkeypatch.setattr(QFileDialog, 'getOpenFileName', staticmethod(lambda *args, **kwargs: (image_path, '')))
+    editor.add_image()
+    editor.copy_object()
+    editor.add_image()
+    asset = editor.layers[0].asset
+    assert editor.layers[1].asset == asset
+    path = asset_store.path(asset)
+
+    editor.delete_layer()
+    editor.delete_layer()
+    assert not editor.layers
+    # Удаленные слои могут вернуться отменой: ресурс остается, пока жива история
+    editor.reset_history("Новая история")
+    assert os.path.exists(path)
+
+    # Буфер обмена тоже удерживает ресурс
+    editor.paste_object()
+    editor.delete_layer()
+    editor.clipboard = None
+    asset_store.release(asset)
+    assert os.path.exists(path)
+    editor.reset_history("Новая история")
+    assert not os.path.exists(path) and asset not in asset_store
@@ -0,0 +1,42 @@
+"""Автосохранение: отложенный повтор во время фоновой работы и удаление устаревших файлов после сохранения"""
+
+import os
+
+
+def test_busy_autosave_is_retried(editor, monkeypatch):
+    editor.add_text()
+    busy = [True]
+    monkeypatch.setattr(editor.project_saver, 'is_busy', lambda: busy[0])
+
+    editor.autosave()
+    assert editor.autosave_retry_timer.isActive()
+    assert not os.path.exists(editor.autosave_path())
+
+    # Повтор по таймеру записывает файл, как только запись проекта закончилась
+    busy[0] = False
+    editor.autosave_retry_timer.timeout.emit()
+    editor.project_saver.wait()
+    assert os.path.exists(editor.autosave_path())
+    assert editor.autosaved_revision == editor.revision
+
+    editor.autosave_retry_timer.stop()
+    editor.autosave()
+    assert not editor.autosave_retry_timer.isActive()
+
+
+def test_saved_project_discards_autosaves(editor, tmp_path):
+    editor.add_text()
+    editor.autosave()
+    editor.project_saver.wait()
+    session = editor.autosave_path()
+    assert os.path.exists(session)
+
+    file_path = str(tmp_path / 'card.pep')
+    stale = file_path + '.autosave'
+    with open(stale, 'wb') as f:
+        f.write(b'old')
+    editor.write_snapshot(file_path)
+    editor.project_saver.wait()
+    assert editor.project_path == file_path
+    assert not os.path.exists(session) and not os.path.exists(stale)
+    assert editor.saved_revision == editor.revision
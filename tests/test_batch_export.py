@@ -0,0 +1,13 @@
+"""Пакетный экспорт: проверка аргументов командной строки"""
+
+import pytest
+
+from batch_export import main
+
+
+@pytest.mark.parametrize('arguments', [['-q', '0'], ['-q', '101'], ['-q', 'высокое'], ['-m', '0'], ['-m', '-5']])
+def test_out_of_range_options_are_rejected(arguments, capsys):
+    with pytest.raises(SystemExit) as error:
+        main(['card.pep'] + arguments)
+    assert error.value.code == 2
+    assert "ожидается" in capsys.readouterr().err
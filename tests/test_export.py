@@ -0,0 +1,160 @@
+"""Экспорт: изображения для потока отрисовки, подбор качества JPEG и совпадение всех путей отрисовки со слиянием"""
+
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+from PyQt5.QtCore import QRect, QSize
+from PyQt5.QtGui import QColor, QImage, QPainter
+
+import postcard_editor
+from postcard_editor import (ImageLayer, MergeTemplate, TextLayer, asset_store, export_sources, fill_placeholders,
+                             fit_jpeg, image_cache, image_pixels, load_project, render_export, render_project,
+                             render_strips, write_project)
+
+
+def test_unloaded_images_are_decoded_by_export(editor, tmp_path, make_image):
+    paths = [make_image(f'photo{number}.png', 160, 120) for number in range(2)]
+    layers = [TextLayer(QRect(20, 20, 200, 40), "Поздравляю!", font_size=20),
+              ImageLayer(QRect(40, 30, 160, 120), asset_store.add_file(paths[0]), 'photo0.png', rotation=20),
+              ImageLayer(QRect(0, 0, 320, 240), asset_store.add_file(paths[1]), 'photo1.png')]
+    file_path = str(tmp_path / 'card.pep')
+    write_project(file_path, QSize(320, 240), layers)
+    asset_store.purge()
+
+    editor.open_project_file(file_path)
+    editor.cancel_image_loading()
+    copies = [layer.copy() for layer in editor.layers]
+    # Незагруженные изображения не декодируются в основном потоке: их читает поток отрисовки
+    images = export_sources(copies)
+    assert list(images.values()) == [None, None]
+    pixels = render_export(QSize(320, 240), copies, (320, 240), images)
+    assert not any(image.isNull() for image in images.values())
+
+    document = load_project(file_path)
+    image_cache.clear()
+    images = export_sources(document.layers)
+    assert list(images.values()) == [None, None]
+    assert np.array_equal(render_export(document.canvas_size, document.layers, (320, 240), images), pixels)
+
+    # Уже декодированное изображение берется из кэша
+    cached = image_cache.get_image(document.layers[2].path)
+    assert export_sources(document.layers)[document.layers[2].path] is cached
+
+
+@pytest.fixture
+def pixels():
+    # Шум с плавным градиентом: размер JPEG заметно зависит от качества
+    rng = np.random.default_rng(1)
+    gradient = np.linspace(0, 200, 320, dtype=np.uint8)[None, :, None]
+    pixels = (rng.integers(0, 56, (240, 320, 4), dtype=np.uint8) + gradient).astype(np.uint8)
+    pixels[..., 3] = 255
+    return pixels
+
+
+def encoded_size(pixels, quality, subsampling):
+    buffer = io.BytesIO()
+    Image.fromarray(pixels[..., :3]).save(buffer, 'JPEG', quality=quality, subsampling=subsampling)
+    return buffer.tell()
+
+
+@pytest.mark.parametrize('max_quality', [95, 60])
+def test_fit_jpeg_picks_highest_fitting_quality(pixels, max_quality):
+    max_bytes = (encoded_size(pixels, 30, 2) + encoded_size(pixels, 31, 2)) // 2
+    probes = []
+    data, quality, subsampling = fit_jpeg(pixels, max_bytes, max_quality, (2,),
+                                          lambda done, total: probes.append((done, total)))
+    assert len(data) <= max_bytes
+    assert (quality, subsampling) == (30, 2)
+    assert len(data) == encoded_size(pixels, quality, subsampling)
+    assert probes[-1][0] <= probes[-1][1] == max_quality.bit_length()
+    assert Image.open(io.BytesIO(data)).size == (320, 240)
+
+
+def test_fit_jpeg_bounds(pixels):
+    # Предел больше любого результата: качество не выше заданного
+    data, quality, _ = fit_jpeg(pixels, 10 ** 9, 80)
+    assert quality == 80
+    assert data == fit_jpeg(pixels, len(data), 80)[0]
+    # Размер при качестве 1 еще подходит, байтом меньше - нет
+    smallest = encoded_size(pixels, 1, 2)
+    data, quality, _ = fit_jpeg(pixels, smallest)
+    assert len(data) == smallest
+    with pytest.raises(ValueError):
+        fit_jpeg(pixels, smallest - 1)
+
+
+def test_fit_jpeg_prefers_earlier_subsampling(pixels):
+    max_bytes = encoded_size(pixels, 50, 0)
+    data, quality, subsampling = fit_jpeg(pixels, max_bytes, 95, (0, 2))
+    assert len(data) <= max_bytes
+    if subsampling == 0:
+        assert quality == 50
+    else:
+        # 4:2:0 выбирается, только если дает качество строго выше
+        assert quality > 50
+        assert encoded_size(pixels, quality, 0) > max_bytes
+
+
+@pytest.fixture
+def card(make_image, tmp_path):
+    photo = asset_store.add_file(make_image('photo.png', 317, 211))
+    # Полупрозрачное изображение: буферы слоев смешиваются с полосой так же, как рисование прямо в нее
+    overlay = QImage(200, 150, QImage.Format_ARGB32)
+    for y in range(150):
+        for x in range(200):
+            overlay.setPixel(x, y, QColor((x * 3) % 256, (y * 7) % 256, 90, (x + y) % 256).rgba())
+    overlay.save(str(tmp_path / 'overlay.png'))
+    overlay = asset_store.add_file(str(tmp_path / 'overlay.png'))
+    layers = [
+        ImageLayer(QRect(20, 200, 500, 200), overlay, rotation=-71),
+        TextLayer(QRect(200, 100, 250, 90), "Поверх", rotation=20),
+        TextLayer(QRect(40, 300, 300, 80), "Привет, {имя}!", font_size=36, rotation=-7),
+        ImageLayer(QRect(330, 333, 111, 97), overlay),
+        ImageLayer(QRect(250, 50, 300, 260), overlay, rotation=47),
+        ImageLayer(QRect(30, 20, 400, 300), photo, rotation=33),
+        ImageLayer(QRect(100, 150, 350, 330), photo, rotation=-12),
+        ImageLayer(QRect(13, 7, 570, 480), photo),
+    ]
+    return QSize(600, 500), layers
+
+
+@pytest.mark.parametrize('target_size', [(600, 500), (1237, 1031), (333, 291)])
+def test_strips_match_single_pass(card, monkeypatch, target_size):
+    canvas_size, layers = card
+    reference = image_pixels(render_project(canvas_size, layers, target_size))
+    assert reference.shape == (target_size[1], target_size[0], 4)
+
+    # Отсечение по полосам меняет края масштабированных изображений, поэтому сравнение - с отрисовкой без полос
+    for strip_height in (128, 37, 1):
+        image = QImage(target_size[0], target_size[1], QImage.Format_RGB32)
+        painter = QPainter(image)
+        tops = list(render_strips(painter, canvas_size, layers, target_size, strip_height))
+        painter.end()
+        assert tops == list(range(0, target_size[1], strip_height))
+        assert np.array_equal(image_pixels(image), reference)
+
+    assert np.array_equal(render_export(canvas_size, layers, target_size), reference)
+
+    # Изображение и буферы слоев в файлах на диске
+    monkeypatch.setattr(postcard_editor, 'EXPORT_TILE_PIXELS', 1000)
+    on_disk = render_export(canvas_size, layers, target_size)
+    assert isinstance(on_disk, np.memmap)
+    assert np.array_equal(on_disk, reference)
+
+
+@pytest.mark.parametrize('target_size', [(600, 500), (1237, 1031)])
+def test_merge_matches_filled_export(card, target_size):
+    canvas_size, layers = card
+    template = MergeTemplate(canvas_size, layers, target_size)
+    assert template.fields == {'имя'}
+    # Над фоном: готовые буферы двух неизменяемых слоев и текст с полем
+    assert [rows is None for layer, rect, first, rows in template.parts] == [True, False, False]
+
+    for name in ("Анна", "Константин Константинович"):
+        filled = [layer.copy() for layer in layers]
+        filled[2].text = fill_placeholders(filled[2].text, {'имя': name})
+        reference = image_pixels(render_project(canvas_size, filled, target_size))
+        assert np.array_equal(image_pixels(template.render({'имя': name})), reference)
+        assert np.array_equal(render_export(canvas_size, filled, target_size), reference)
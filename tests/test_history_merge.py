@@ -0,0 +1,67 @@
+"""Слияние быстрых однотипных правок одного слоя в одну запись истории"""
+
+from PyQt5.QtCore import QRect
+
+from postcard_editor import ChangeLayerCommand
+
+
+def type_text(editor, text):
+    for length in range(1, len(text) + 1):
+        editor.text_edit.setPlainText(text[:length])
+
+
+def test_typing_is_one_history_entry(editor):
+    editor.add_text()
+    entries = len(editor.history)
+    type_text(editor, "С днем рождения!")
+    assert len(editor.history) == entries + 1
+    assert editor.layers[0].text == "С днем рождения!"
+
+    editor.undo()
+    assert editor.layers[0].text == "Новый текст"
+    editor.redo()
+    assert editor.layers[0].text == "С днем рождения!"
+
+
+def test_pause_starts_new_entry(editor, monkeypatch):
+    editor.add_text()
+    type_text(editor, "Пер")
+    monkeypatch.setattr(editor, 'HISTORY_MERGE_WINDOW', -1)
+    editor.text_edit.setPlainText("Перв")
+    assert [command.label for command in editor.history[-2:]] == ["Текст", "Текст"]
+    editor.undo()
+    assert editor.layers[0].text == "Пер"
+
+
+def test_different_layers_and_kinds_are_not_merged(editor):
+    editor.add_text()
+    editor.add_text()
+    entries = len(editor.history)
+
+    def nudge(index, x):
+        before = QRect(editor.layers[index].rect)
+        editor.layers[index].rect.moveLeft(x)
+        editor.add_to_history(ChangeLayerCommand("Перемещение", index, {'rect': before},
+                                                 {'rect': QRect(editor.layers[index].rect)}, merge_kind='nudge'))
+
+    nudge(0, 110)
+    nudge(0, 120)
+    nudge(1, 130)
+    editor.add_to_history(ChangeLayerCommand("Цвет", 1, {'color': "#000000"}, {'color': "#ff0000"}))
+    editor.add_to_history(ChangeLayerCommand("Цвет", 1, {'color': "#ff0000"}, {'color': "#00ff00"}))
+    assert len(editor.history) == entries + 4
+
+    for _ in range(3):
+        editor.undo()
+    assert (editor.layers[0].rect.left(), editor.layers[1].rect.left()) == (120, 100)
+    # Отмена слитой записи возвращает состояние до первой правки серии
+    editor.undo()
+    assert editor.layers[0].rect.left() == 100
+
+    # Отмененная запись не принимает новые правки: они начинают новую запись
+    editor.redo()
+    editor.undo()
+    nudge(0, 140)
+    assert len(editor.history) == entries + 1
+    editor.undo()
+    assert editor.layers[0].rect.left() == 100
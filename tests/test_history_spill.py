@@ -0,0 +1,97 @@
+"""Выгрузка старых записей истории на диск: загрузка, повторная выгрузка и сжатие файла"""
+
+import os
+import pickle
+
+from PyQt5.QtCore import QRect
+
+from postcard_editor import ChangeLayerCommand, HistorySpillStore, InsertLayerCommand, SpilledCommand, TextLayer
+
+
+def make_command(number):
+    # Неповторяющийся текст плохо сжимается: записи занимают в файле заметное место
+    text = os.urandom(2000).hex()
+    return ChangeLayerCommand(f"Правка {number}", number, {'text': ""}, {'text': text, 'rect': QRect(number, 0, 10, 10)})
+
+
+def test_load_and_respill():
+    store = HistorySpillStore()
+    commands = [make_command(number) for number in range(5)]
+    spilled = [store.spill(command) for command in commands]
+    assert all(isinstance(item, SpilledCommand) for item in spilled)
+    assert [item.label for item in spilled] == [command.label for command in commands]
+    assert store.disk_bytes == store.file_bytes == sum(item.length for item in spilled)
+
+    loaded = store.load(spilled[2])
+    assert (loaded.label, loaded.index, loaded.before, loaded.after) == (
+        commands[2].label, commands[2].index, commands[2].before, commands[2].after)
+    assert store.disk_bytes == store.file_bytes - spilled[2].length
+
+    # Загруженная запись снова уходит на диск в конец файла, остальные не сдвигаются
+    respilled = store.spill(loaded)
+    assert respilled.offset == spilled[-1].offset + spilled[-1].length
+    assert store.load(respilled).after == commands[2].after
+    for item, command in zip(spilled[:2] + spilled[3:], commands[:2] + commands[3:]):
+        assert store.load(item).after == command.after
+    assert store.disk_bytes == 0
+
+    store.clear()
+    assert (store.disk_bytes, store.file_bytes) == (0, 0)
+
+
+def test_layers_survive_spill():
+    store = HistorySpillStore()
+    layer = TextLayer(QRect(1, 2, 3, 4), "Слой", font_size=40, rotation=90)
+    loaded = store.load(store.spill(InsertLayerCommand("Добавление текста", 0, layer)))
+    assert loaded.layer.to_dict() == layer.to_dict()
+    store.clear()
+
+
+def test_compaction_keeps_live_records():
+    store = HistorySpillStore()
+    store.COMPACT_MIN_BYTES = 1
+    commands = [make_command(number) for number in range(20)]
+    spilled = [store.spill(command) for command in commands]
+
+    # Удаление старых записей без загрузки (обрезка истории) оставляет в файле мусор,
+    # пока его не больше, чем живых записей
+    compacted = False
+    for item in spilled[:12]:
+        size = store.file_bytes
+        store.forget(item)
+        if store.file_bytes != size:
+            compacted = True
+            assert store.file_bytes == store.disk_bytes
+        garbage = store.file_bytes - store.disk_bytes
+        assert garbage <= store.disk_bytes
+    assert compacted
+    assert store.disk_bytes == sum(item.length for item in spilled[12:])
+
+    for item, command in zip(spilled[12:], commands[12:]):
+        assert store.load(item).after == command.after
+    store.clear()
+
+
+def test_small_garbage_is_not_compacted():
+    store = HistorySpillStore()
+    spilled = [store.spill(make_command(number)) for number in range(4)]
+    size = store.file_bytes
+    for item in spilled[:3]:
+        store.forget(item)
+    # Мусора больше, чем живых записей, но меньше COMPACT_MIN_BYTES
+    assert store.file_bytes == size
+    assert store.load(spilled[3]).index == 3
+    store.clear()
+
+
+def test_merged_entry_size_is_measured_again(editor):
+    editor.add_text()
+    text = "Поздравляю! " * 125
+    for length in range(1, len(text) + 1):
+        editor.text_edit.setPlainText(text[:length])
+
+    # Размер слитой записи - размер ее итогового состояния, а не сумма размеров всех нажатий
+    merged = editor.history[-1]
+    assert merged.nbytes == len(pickle.dumps(merged, pickle.HIGHEST_PROTOCOL))
+    assert editor.history_bytes == sum(command.nbytes for command in editor.history)
+    assert editor.history_bytes < 10 * len(text.encode())
@@ -0,0 +1,72 @@
+"""Кэш декодированных изображений: вытеснение по LRU, смена файла на диске и пирамида уменьшенных копий"""
+
+import os
+
+from PyQt5.QtCore import QSize
+
+from postcard_editor import ImageCache
+
+
+def image_bytes(cache, path):
+    return cache.get_image(path).sizeInBytes()
+
+
+def test_lru_eviction_keeps_recently_used(make_image):
+    paths = [make_image(f'{name}.png', 100, 100) for name in 'abc']
+    cache = ImageCache()
+    cache.set_max_bytes(image_bytes(ImageCache(), paths[0]) * 2)
+
+    first = cache.get_image(paths[0])
+    cache.get_image(paths[1])
+    # Повторное обращение возвращает тот же объект и делает запись самой свежей
+    assert cache.get_image(paths[0]) is first
+    cache.get_image(paths[2])
+    assert cache.current_bytes <= cache.max_bytes
+    assert cache.get_image(paths[0]) is first
+    assert len(cache._entries) == 2
+    assert ('image', paths[1], os.path.getmtime(paths[1]), None) not in cache._entries
+
+    # Уменьшение бюджета сразу вытесняет лишнее
+    cache.set_max_bytes(0)
+    assert cache.current_bytes == 0 and not cache._entries
+
+
+def test_oversized_image_is_not_cached(make_image):
+    path = make_image('big.png', 200, 200)
+    cache = ImageCache(max_bytes=1000)
+    assert not cache.get_image(path).isNull()
+    assert cache.current_bytes == 0
+
+
+def test_replaced_file_is_decoded_again(make_image, tmp_path):
+    path = make_image('photo.png', 80, 60)
+    cache = ImageCache()
+    assert cache.get_image(path).size() == QSize(80, 60)
+
+    replacement = make_image('other.png', 40, 30)
+    os.replace(replacement, path)
+    os.utime(path, (os.path.getatime(path), os.path.getmtime(path) + 10))
+    assert cache.get_image(path).size() == QSize(40, 30)
+    assert cache.get_image(str(tmp_path / 'missing.png')).isNull()
+
+
+def test_pyramid_levels_and_scaled_pixmaps(make_image):
+    path = make_image('photo.png', 640, 480)
+    cache = ImageCache()
+    cache.build_pyramid(path)
+    mtime = os.path.getmtime(path)
+    # Уровни вдвое меньше предыдущего, меньшая сторона уровня не меньше MIPMAP_MIN_SIZE
+    assert cache._pyramids[(path, mtime)] == [QSize(640, 480), QSize(320, 240), QSize(160, 120)]
+
+    # Для мелкого изображения на экране берется ближайший не меньший уровень
+    assert cache._source_image(path, mtime, QSize(100, 75)).size() == QSize(160, 120)
+    assert cache._source_image(path, mtime, QSize(600, 450)).size() == QSize(640, 480)
+
+    pixmap = cache.get_pixmap(path, QSize(100, 100))
+    assert pixmap.size() == QSize(100, 75)
+    assert cache.get_pixmap(path, QSize(100, 100)).cacheKey() == pixmap.cacheKey()
+    assert cache.get_pixmap(path, QSize(0, 10)).isNull()
+
+    # Вытесненный уровень строится заново
+    cache._entries.pop(('mip', path, mtime, 2))
+    assert cache._source_image(path, mtime, QSize(100, 75)).size() == QSize(160, 120)
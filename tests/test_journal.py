@@ -0,0 +1,217 @@
+"""Журнал правок: воспроизведение до отметки сохранения и отбрасывание оборванного хвоста"""
+
+import io
+import os
+
+import pytest
+from PyQt5.QtCore import QRect, QSize
+
+from postcard_editor import (ChangeLayerCommand, ImageLayer, InsertLayerCommand, ProjectDocument, ProjectJournal,
+                             TextLayer, UndoneCommand, asset_store, load_project, write_project)
+
+TOKEN = 'f' * 32
+
+
+def make_project(tmp_path):
+    """Проект с одним текстовым слоем и пустой журнал к нему: (путь проекта, журнал)"""
+    file_path = str(tmp_path / 'card.pep')
+    write_project(file_path, QSize(400, 300), [TextLayer(QRect(10, 10, 200, 40), "Снимок")], journal=TOKEN)
+    journal = ProjectJournal.create(file_path + '.journal', TOKEN, set())
+    return file_path, journal
+
+
+def record_saved_edits(journal, image_path):
+    layer = ImageLayer(QRect(0, 0, 400, 300), asset_store.add_file(image_path), 'photo.png', rotation=10)
+    journal.record('do', InsertLayerCommand("Добавление изображения", 1, layer))
+    journal.record('do', ChangeLayerCommand("Текст", 0, {'text': "Снимок"}, {'text': "Сохранено"}))
+    journal.save_point()
+    return layer
+
+
+def record_unsaved_edits(journal):
+    change = ChangeLayerCommand("Положение", 0, {'rect': QRect(10, 10, 200, 40)}, {'rect': QRect(50, 60, 200, 40)})
+    journal.record('do', change)
+    journal.record('undo', change)
+    journal.record('do', ChangeLayerCommand("Текст", 0, {'text': "Сохранено"}, {'text': "Не сохранено"}))
+
+
+def replay(file_path, records):
+    document = ProjectDocument(QSize(400, 300), [TextLayer(QRect(10, 10, 200, 40), "Снимок")])
+    images = []
+    for _, command, _ in ProjectJournal.actions(file_path + '.journal', records, set(), images):
+        if command is not None:
+            command.redo(document)
+    return document, images
+
+
+def test_replay_up_to_save_point(tmp_path, make_image):
+    image_path = make_image('photo.png')
+    file_path, journal = make_project(tmp_path)
+    inserted = record_saved_edits(journal, image_path)
+    record_unsaved_edits(journal)
+    journal.close()
+
+    records, start = ProjectJournal.read(file_path + '.journal', TOKEN)
+    assert start > 0
+    assert [record['op'] for record, _, _ in records] == ['asset', 'do', 'do', 'save', 'do', 'undo', 'do']
+    saved, unsaved = ProjectJournal.split_saved(records)
+    assert len(saved) == 4
+    assert ProjectJournal.count_actions(saved) == 2
+    assert ProjectJournal.count_actions(unsaved) == 3
+
+    document, images = replay(file_path, saved)
+    assert [layer.to_dict() for layer in document.layers] == [
+        TextLayer(QRect(10, 10, 200, 40), "Сохранено").to_dict(), inserted.to_dict()]
+    # Изображение не извлекается при чтении, а копируется из журнала по смещению
+    (asset, extension, source), = images
+    assert (asset, extension) == (inserted.asset, '.png')
+    target = io.BytesIO()
+    source(target)
+    with open(image_path, 'rb') as f:
+        assert target.getvalue() == f.read()
+
+    # Отмененное действие восстанавливается как самостоятельная команда
+    actions = [command for _, command, _ in ProjectJournal.actions(file_path + '.journal', unsaved, set(), [])]
+    assert isinstance(actions[1], UndoneCommand)
+    document, _ = replay(file_path, records)
+    assert document.layers[0].text == "Не сохранено"
+    assert document.layers[0].rect == QRect(10, 10, 200, 40)
+
+    # Проект без редактора открывается в сохраненном состоянии
+    asset_store.purge()
+    loaded = load_project(file_path)
+    assert [layer.to_dict() for layer in loaded.layers] == [
+        TextLayer(QRect(10, 10, 200, 40), "Сохранено").to_dict(), inserted.to_dict()]
+    assert loaded.layers[1].path is not None
+
+
+def test_torn_tail_is_truncated(tmp_path, make_image):
+    file_path, journal = make_project(tmp_path)
+    record_saved_edits(journal, make_image('photo.png'))
+    journal.close()
+    path = file_path + '.journal'
+    records, _ = ProjectJournal.read(path, TOKEN)
+    end = records[-1][2]
+    assert end == os.path.getsize(path)
+
+    # Сбой посреди записи действия и посреди файла ресурса
+    for tail in (b'{"op": "do", "comm', b'{"op": "asset", "asset": "0", "extension": ".png", "size": 100}\n12345'):
+        with open(path, 'ab') as f:
+            f.write(tail)
+        torn, _ = ProjectJournal.read(path, TOKEN)
+        assert torn == records
+
+        resumed = ProjectJournal.resume(path, TOKEN, set(), end)
+        assert os.path.getsize(path) == end
+        resumed.record('do', ChangeLayerCommand("Текст", 0, {'text': "Сохранено"}, {'text': "После сбоя"}))
+        resumed.save_point()
+        resumed.close()
+        continued, _ = ProjectJournal.read(path, TOKEN)
+        assert continued[:len(records)] == records
+        assert [record['op'] for record, _, _ in continued[len(records):]] == ['do', 'save']
+        document, _ = replay(file_path, continued)
+        assert document.layers[0].text == "После сбоя"
+
+        # Следующий сбой - после дописанных записей
+        records, end = continued, continued[-1][2]
+
+
+def test_journal_of_another_snapshot_is_ignored(tmp_path):
+    file_path, journal = make_project(tmp_path)
+    journal.record('do', ChangeLayerCommand("Текст", 0, {'text': "Снимок"}, {'text': "Чужой журнал"}))
+    journal.save_point()
+    journal.close()
+
+    assert ProjectJournal.read(file_path + '.journal', 'другой снимок') is None
+    assert ProjectJournal.read(file_path + '.missing', TOKEN) is None
+
+    # Журнал прежнего снимка не применяется к снимку с новой меткой
+    write_project(file_path, QSize(400, 300), [TextLayer(QRect(10, 10, 200, 40), "Снимок")], journal='0' * 32)
+    assert load_project(file_path).layers[0].text == "Снимок"
+
+
+def test_failed_write_keeps_journal_readable(tmp_path):
+    file_path, journal = make_project(tmp_path)
+    journal.record('do', ChangeLayerCommand("Текст", 0, {'text': "Снимок"}, {'text': "Записано"}))
+    journal.save_point()
+    records, _ = ProjectJournal.read(file_path + '.journal', TOKEN)
+
+    class FullDisk:
+        """Файл, в который успевает записаться лишь начало записи"""
+
+        def __init__(self, file):
+            self.file = file
+            self.tell = file.tell
+            self.close = file.close
+
+        @property
+        def closed(self):
+            return self.file.closed
+
+        def write(self, data):
+            self.file.write(data[:7])
+            self.file.flush()
+            raise OSError(28, "No space left on device")
+
+    journal._file = FullDisk(journal._file)
+    with pytest.raises(OSError):
+        journal.record('do', ChangeLayerCommand("Текст", 0, {'text': "Записано"}, {'text': "Потеряно"}))
+    assert journal.failed
+    journal.close()
+
+    assert ProjectJournal.read(file_path + '.journal', TOKEN)[0] == records
+    assert os.path.getsize(file_path + '.journal') == records[-1][2]
+    assert load_project(file_path).layers[0].text == "Записано"
+
+
+def test_merged_edits_rewrite_last_record(tmp_path):
+    file_path, journal = make_project(tmp_path)
+    path = file_path + '.journal'
+    text = ""
+    for letter in "Поздравляю":
+        change = ChangeLayerCommand("Текст", 0, {'text': text}, {'text': text + letter}, merge_kind='text')
+        text += letter
+        if letter == "П":
+            merged = change
+            journal.record('do', merged)
+        else:
+            merged.merge(change)
+            journal.record('merge', merged)
+    size = os.path.getsize(path)
+    # Отметка сохранения не переписывается: продолжение после нее дописывается отдельной записью
+    journal.save_point()
+    merged.merge(ChangeLayerCommand("Текст", 0, {'text': text}, {'text': text + "!"}, merge_kind='text'))
+    journal.record('merge', merged)
+    journal.record('merge', merged)
+    journal.close()
+
+    records, _ = ProjectJournal.read(path, TOKEN)
+    assert [record['op'] for record, _, _ in records] == ['do', 'save', 'merge']
+    assert records[0][2] == size
+    assert records[0][0]['command']['after'] == {'text': "Поздравляю"}
+    actions = list(ProjectJournal.actions(path, records, set(), []))
+    assert actions[0][1].merge_key == ('text', 0)
+    op, command, _ = actions[2]
+    assert (op, command.before, command.after) == ('merge', {'text': ""}, {'text': "Поздравляю!"})
+    document, _ = replay(file_path, records)
+    assert document.layers[0].text == "Поздравляю!"
+
+
+def test_typing_is_replayed_as_one_entry(editor, tmp_path):
+    editor.add_text()
+    file_path = str(tmp_path / 'card.pep')
+    editor.write_snapshot(file_path)
+    editor.project_saver.wait()
+
+    text = "С днем рождения!"
+    for length in range(1, len(text) + 1):
+        editor.text_edit.setPlainText(text[:length])
+    editor.save_project()
+    records, _ = ProjectJournal.read(file_path + '.journal', editor.journal.token)
+    assert [record['op'] for record, _, _ in records] == ['do', 'save']
+
+    editor.open_project_file(file_path)
+    assert editor.layers[0].text == text
+    assert len(editor.history) == 2
+    editor.undo()
+    assert editor.layers[0].text == "Новый текст"
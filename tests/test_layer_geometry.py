@@ -0,0 +1,63 @@
+"""Колоночная геометрия слоев: попадание точки, пересечение с прямоугольником и синхронизация с редактором"""
+
+from PyQt5.QtCore import QPoint, QRect, QRectF
+
+from postcard_editor import LayerGeometryStore, TextLayer
+
+
+def make_store():
+    # Сверху вниз: повернутая полоса, скрытый слой, большой нижний слой
+    layers = [TextLayer(QRect(100, 100, 200, 20), "Полоса", rotation=90),
+              TextLayer(QRect(0, 0, 50, 50), "Скрытый", visible=False),
+              TextLayer(QRect(0, 0, 400, 300), "Фон")]
+    store = LayerGeometryStore()
+    store.rebuild(layers)
+    return store, layers
+
+
+def test_rows_at_point_follow_rotation():
+    store, _ = make_store()
+    assert len(store) == 3
+    # Полоса повернута на 90 градусов вокруг центра (200, 110): теперь она вертикальная
+    assert list(store.rows_at_point(200, 30)) == [0, 2]
+    assert list(store.rows_at_point(120, 110)) == [2]
+    # Скрытый слой не находится, допуск расширяет рамку
+    assert list(store.rows_at_point(10, 10)) == [2]
+    assert list(store.rows_at_point(211, 30)) == [2]
+    assert list(store.rows_at_point(211, 30, tolerance=2)) == [0, 2]
+    assert list(store.rows_at_point(500, 500)) == []
+
+
+def test_rows_in_rect_and_update():
+    store, layers = make_store()
+    assert list(store.rows_in_rect(QRectF(195, 10, 10, 10))) == [0, 2]
+    assert list(store.rows_in_rect(QRectF(5, 5, 10, 10))) == [2]
+    assert list(store.rows_in_rect(QRectF(5, 5, 10, 10), include_hidden=True)) == [1, 2]
+
+    layers[0].rotation = 0
+    layers[0].rect = QRect(500, 400, 100, 20)
+    store.update(0, layers[0])
+    assert list(store.rows_in_rect(QRectF(195, 10, 10, 10))) == [2]
+    assert list(store.rows_at_point(550, 410)) == [0]
+    assert store.scaled_rects(0.5, 0.5)[0].tolist() == [250, 200, 50, 10]
+
+
+def test_editor_hit_testing_uses_store(editor):
+    editor.add_text()
+    editor.add_text()
+    top = editor.layers[0]
+    top.rect = QRect(300, 300, 200, 40)
+    editor.layer_changed(0)
+    canvas = editor.canvas
+    scale = canvas.scale_factor
+
+    def screen(x, y):
+        return QPoint(round(x * scale), round(y * scale))
+
+    assert canvas.layer_at(screen(400, 320)) == 0
+    bottom = editor.layers[1].rect.center()
+    assert canvas.layer_at(screen(bottom.x(), bottom.y())) == 1
+
+    top.visible = False
+    editor.layer_changed(0)
+    assert canvas.layer_at(screen(400, 320)) is None
@@ -0,0 +1,133 @@
+"""Файл проекта: запись write_project и чтение ProjectReader/load_project, прежний формат с base64"""
+
+import base64
+import io
+import json
+import os
+import zipfile
+
+import pytest
+from PyQt5.QtCore import QRect, QSize, Qt
+
+from postcard_editor import (PROJECT_MANIFEST, ImageLayer, ProjectReader, TextLayer, asset_store, load_project,
+                             write_project)
+
+
+def read_source(source):
+    target = io.BytesIO()
+    source(target)
+    return target.getvalue()
+
+
+def test_round_trip(tmp_path, make_image):
+    image_path = make_image('photo.png')
+    asset = asset_store.add_file(image_path)
+    layers = [
+        TextLayer(QRect(10, 20, 200, 50), "Поздравляю!", font_size=30, color="#aa0000",
+                  alignment=int(Qt.AlignCenter), rotation=-5),
+        ImageLayer(QRect(0, 0, 320, 240), asset, 'photo.png', rotation=15),
+        ImageLayer(QRect(50, 60, 100, 80), asset, 'photo.png', visible=False),
+    ]
+    file_path = str(tmp_path / 'card.pep')
+    write_project(file_path, QSize(640, 480), layers, journal='token')
+
+    with zipfile.ZipFile(file_path) as archive:
+        # Изображение, общее для двух слоев, хранится один раз
+        assert sorted(archive.namelist()) == sorted([PROJECT_MANIFEST, f'images/{asset}.png'])
+
+    with ProjectReader(file_path) as reader:
+        assert reader.canvas_size == QSize(640, 480)
+        assert reader.journal == 'token'
+        for layer, layer_data in zip(layers, reader.layers):
+            assert {key: value for key, value in layer_data.items()
+                    if key not in ('image', 'image_format')} == layer.to_dict()
+        with open(image_path, 'rb') as f:
+            assert read_source(reader.image_source(reader.layers[1])) == f.read()
+        assert reader.image_source(reader.layers[0]) is None
+
+    asset_store.purge()
+    document = load_project(file_path)
+    assert document.canvas_size == QSize(640, 480)
+    assert [layer.to_dict() for layer in document.layers] == [layer.to_dict() for layer in layers]
+    assert document.layers[1].path is not None
+
+
+def test_legacy_base64_project(tmp_path, make_image):
+    image_path = make_image('legacy.png')
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    file_path = str(tmp_path / 'legacy.pep')
+    with open(file_path, 'w') as f:
+        json.dump({
+            'canvas_size': {'width': 300, 'height': 200},
+            'layers': [
+                {'type': 'text', 'rect': {'x': 1, 'y': 2, 'width': 100, 'height': 30}, 'visible': True,
+                 'rotation': 0, 'text': "Текст", 'font': "Arial", 'font_size': 12, 'color': "#000000"},
+                {'type': 'image', 'rect': {'x': 0, 'y': 0, 'width': 300, 'height': 200}, 'visible': True,
+                 'rotation': 30, 'image_data': base64.b64encode(data).decode('ascii'), 'image_format': 'png'},
+            ]
+        }, f)
+
+    with ProjectReader(file_path) as reader:
+        assert reader.canvas_size == QSize(300, 200)
+        assert reader.journal is None
+        assert read_source(reader.image_source(reader.layers[1])) == data
+
+    document = load_project(file_path)
+    text, image = document.layers
+    assert (text.text, text.alignment) == ("Текст", int(Qt.AlignLeft | Qt.AlignTop))
+    assert image.rotation == 30
+    assert image.asset == asset_store.add_file(image_path)
+    with open(image.path, 'rb') as f:
+        assert f.read() == data
+
+    # Пересохраненный проект уже в новом формате
+    resaved = str(tmp_path / 'resaved.pep')
+    write_project(resaved, document.canvas_size, document.layers)
+    assert zipfile.is_zipfile(resaved)
+    asset_store.purge()
+    assert [layer.to_dict() for layer in load_project(resaved).layers] == [layer.to_dict()
+                                                                            for layer in document.layers]
+
+
+def test_broken_manifest_closes_archive(tmp_path, monkeypatch):
+    closed = []
+    close = zipfile.ZipFile.close
+    monkeypatch.setattr(zipfile.ZipFile, 'close', lambda archive: (closed.append(archive.filename), close(archive)))
+
+    for name, manifest in (('broken.pep', b'{"canvas_size": '), ('empty.pep', None)):
+        file_path = str(tmp_path / name)
+        with zipfile.ZipFile(file_path, 'w') as archive:
+            if manifest is not None:
+                archive.writestr(PROJECT_MANIFEST, manifest)
+        closed.clear()
+        try:
+            ProjectReader(file_path)
+        except (ValueError, KeyError):
+            # Пока жива трассировка, архив не мог закрыться при сборке мусора
+            assert closed == [file_path]
+        else:
+            pytest.fail("ProjectReader принял проект без манифеста")
+
+
+def test_save_before_images_are_loaded(editor, tmp_path, make_image):
+    paths = [make_image(f'photo{number}.png', 200, 150) for number in range(3)]
+    layers = [ImageLayer(QRect(10 * number, 0, 200, 150), asset_store.add_file(path), os.path.basename(path))
+              for number, path in enumerate(paths)]
+    file_path = str(tmp_path / 'card.pep')
+    write_project(file_path, QSize(400, 300), layers)
+    asset_store.purge()
+
+    editor.open_project_file(file_path)
+    # Загрузка прервана: изображения остаются только в прежнем файле
+    editor.cancel_image_loading()
+    assert all(layer.path is None and layer.source is not None for layer in editor.layers)
+
+    copy_path = str(tmp_path / 'copy.pep')
+    editor.write_snapshot(copy_path)
+    editor.project_saver.wait()
+    assert not editor.warnings
+    with ProjectReader(copy_path) as reader:
+        for layer_data, path in zip(reader.layers, paths):
+            with open(path, 'rb') as f:
+                assert read_source(reader.image_source(layer_data)) == f.read()